@@ -1,27 +1,355 @@
+import calendar
+import json
+import logging
 import math
+import queue
+import threading
+import time
 import types
 import sqlite3
-import pickle
 import os
+import zlib
 
-from alive_progress import alive_bar
-
+from collections import deque, namedtuple
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from sqlite3 import Error as SQLError
 from datetime import date, datetime
 from datetime import timedelta
 
-from OTXv2 import OTXv2
+from otxdb import ReadPool, SQLiteWriter, configure_connection, connect_reader, pathname2url
+from otxfetch import PageCache, PageFetcher, OTX_SERVER
+from otxmetrics import RunMetrics
+from otxrelevance import RELEVANT_PROFILE, RelevanceMatcher
+from otxsimilar import LSH_BANDS, NEAR_DUPLICATE_SIMILARITY, lsh_buckets, minhash_signatures, similarities
 
-pickle.DEFAULT_PROTOCOL = 5
 rootDir = os.getcwd()
 firstInitializationAllPulses = False
 firstInitializationRelPulses = False
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER (999 on older SQLite builds) when binding ID lists
+SQLITE_MAX_VARIABLES = 500
+# Number of pulses normalized and flushed per transaction when streaming into SQLite
+STREAM_BATCH_SIZE = 500
+# Version of the database schema, see SQLiteDBHandler._migrations
+SCHEMA_VERSION = 7
+# Filterable pulse attributes, each stored in its own junction table: attribute -> (junction table, value column)
+PULSE_ATTRIBUTES = {
+    "industry": ("pulse_industry", "industry"),
+    "tag": ("pulse_tag", "tag"),
+    "country": ("pulse_country", "country"),
+    "adversary": ("pulse_adversary", "adversary"),
+    "malware": ("pulse_malware", "malware_family"),
+    "attack": ("pulse_attack", "attack_id"),
+    "tlp": ("pulse_tlp", "tlp"),
+    # Not sent by OTX, the relevance profiles a pulse matched. relevantpulses is derived from the RELEVANT_PROFILE rows.
+    "profile": ("pulse_profile", "profile"),
+}
+# Tables whose rows are rolled into partitions -> their columns, see otxpartition. Everything else (the attribute,
+# profile, search and indicator tables) stays in the pulse database and keeps covering the whole history.
+PARTITION_TABLES = {
+    "allpulses": ("pulse_id", "name", "created", "modified", "description", "author", "created_ts", "modified_ts"),
+    "reference": ("pulse_id", "reference"),
+    "pulse_indicator": ("indicator_id", "pulse_id"),
+}
+# Partitioned table -> TEMP view over it and its partitions, see attach_partitions
+PARTITIONED = {table: f"{table}_all" for table in PARTITION_TABLES}
+# zlib level used for the raw pulse archive, 6 is zlib's own default trade-off
+ARCHIVE_COMPRESSION_LEVEL = 6
+# Number of archived pulses handed to a decompression worker at once during a rebuild
+REBUILD_CHUNK_SIZE = 200
+# Number of fetched pulses allowed to wait between the network thread and the SQLite writer
+STREAM_PREFETCH = 1000
+# Pulses requested per OTX page, backfill checkpoints are kept in pages of this size
+OTX_PAGE_SIZE = 100
+# Earliest modified timestamp a windowed backfill plans windows from, OTX went public in 2012
+OTX_HISTORY_START = "2012-01-01T00:00:00"
+# Codes the changelog stores tables and kinds of change as, the position in each tuple
+CHANGE_TABLES = ("allpulses", "relevantpulses")
+CHANGE_KINDS = ("insert", "update", "delete")
+
+log = logging.getLogger(__name__)
+
+
+class SchemaVersionError(Exception):
+    """
+    Raised by a read-only SQLiteDBHandler on a pulse database that is missing or older than SCHEMA_VERSION, which only
+    a writing handler creates or migrates.
+    """
+
+
+def database_path() -> str:
+    """
+    :return: Path of the pulse database file, shared by every tool that reads it
+    """
+    return rootDir + "\\sqlite\\Relevant_Pulses.sqlite3"
+
+
+def archive_path() -> str:
+    """
+    :return: Path of the raw pulse archive file, attached to the pulse database as "archive"
+    """
+    return rootDir + "\\sqlite\\Pulse_Archive.sqlite3"
+
+
+def partition_path(name: str) -> str:
+    """
+    :param name: name of a partition, e.g. "2019" or "2019q3"
+    :return: Path of the partition file holding the pulses rolled out of the pulse database for that period
+    """
+    return rootDir + f"\\sqlite\\Pulse_Partition_{name}.sqlite3"
+
+
+def remove_database_files(path: str) -> None:
+    """
+    Deletes a database file together with its WAL and shared memory files.
+    """
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def attach_partitions(connection: sqlite3.Connection, names: list = None) -> list:
+    """
+    Attaches partitions to a connection behind allpulses_all, reference_all and pulse_indicator_all TEMP views, which
+    read like the unpartitioned tables: the rows of the pulse database followed by the partition rows of pulses it does
+    not hold. When the partitions are attached already this costs two small reads, so readers call it before each use
+    to follow rolls and drops made since. Must be called outside a transaction.
+    :param connection: connection to the pulse database, read-only ones included
+    :param names: partitions to attach, defaults to every partition in the catalog
+    :return: list of the names of the attached partitions
+    """
+    if names is None:
+        names = [name for (name,) in connection.execute("""SELECT name FROM main.partition_catalog 
+                ORDER BY start_ts""")]
+    names = [name for name in names if os.path.exists(partition_path(name))]
+    schemas = [schema for _, schema, _ in connection.execute("""PRAGMA database_list""")]
+    attached = [schema for schema in schemas if schema.startswith("partition_")]
+    views = connection.execute("""SELECT COUNT(*) FROM temp.sqlite_master WHERE type = 'view' AND name IN 
+            ('allpulses_all', 'reference_all', 'pulse_indicator_all')""").fetchone()[0]
+    if attached == [f"partition_{name}" for name in names] and views == len(PARTITION_TABLES):
+        return names
+
+    # Other attached databases, e.g. the archive, count against the limit too
+    attachable = connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) - len(
+        [schema for schema in schemas if schema not in ("main", "temp") and schema not in attached])
+    if len(names) > attachable:
+        raise ValueError(f"{len(names)} partitions exist but only {attachable} can be attached at once, roll by year "
+                         f"or drop old partitions")
+    # The TEMP views are the only thing written, read-only connections are switched back once they exist
+    queryOnly = connection.execute("""PRAGMA query_only""").fetchone()[0]
+    connection.execute("""PRAGMA query_only = OFF""")
+    try:
+        detach_partitions(connection)
+        for name in names:
+            connection.execute(f"""ATTACH DATABASE ? AS partition_{name}""", (partition_path(name),))
+        for table, columns in PARTITION_TABLES.items():
+            columnList = ", ".join(columns)
+            selects = [f"""SELECT {columnList} FROM main.{table}"""]
+            selects.extend(f"""SELECT {columnList} FROM partition_{name}.{table} 
+                    WHERE pulse_id NOT IN (SELECT pulse_id FROM main.allpulses)""" for name in names)
+            connection.execute(f"""CREATE TEMP VIEW {table}_all AS {" UNION ALL ".join(selects)}""")
+    finally:
+        connection.execute(f"""PRAGMA query_only = {queryOnly}""")
+    return names
+
+
+def detach_partitions(connection: sqlite3.Connection) -> None:
+    """
+    Drops the views of attach_partitions and detaches the partitions, e.g. before their files are rewritten or deleted.
+    Must be called outside a transaction.
+    """
+    for table in PARTITION_TABLES:
+        connection.execute(f"""DROP VIEW IF EXISTS temp.{table}_all""")
+    for _, schema, _ in connection.execute("""PRAGMA database_list""").fetchall():
+        if schema.startswith("partition_"):
+            connection.execute(f"""DETACH DATABASE {schema}""")
+
+
+def profiles_path() -> str:
+    """
+    :return: Path of the relevance rule file read when no other is given, see otxrelevance.load_profiles
+    """
+    return rootDir + "\\relevance.json"
 
 
-def sanitize_description(description: str) -> str:
-    description = description.replace("'", "")
-    description = description.replace('"', "")
-    return description
+def load_relevance(path: str = None) -> RelevanceMatcher:
+    """
+    Compiles the relevance profiles of a rule file, or of profiles_path() if it exists, otherwise the built-in ones.
+    :param path: optional rule file to read
+    :return: RelevanceMatcher
+    """
+    if path is None and os.path.exists(profiles_path()):
+        path = profiles_path()
+    if path is None:
+        return RelevanceMatcher()
+    log.info("Loading relevance profiles from %s", path)
+    matcher = RelevanceMatcher.from_file(path)
+    if RELEVANT_PROFILE not in matcher.profiles:
+        log.warning("%s removes the %s profile, relevantpulses will stay empty", path, RELEVANT_PROFILE)
+    return matcher
+
+
+def compress_pulse(pulse: dict) -> bytes:
+    """
+    :param pulse: OTX pulse dict
+    :return: zlib compressed compact JSON of the pulse
+    """
+    return zlib.compress(json.dumps(pulse, separators = (",", ":")).encode("utf-8"), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def decompress_pulses(blobs: list) -> list:
+    """
+    Decodes archived pulses. zlib releases the GIL while inflating, so chunks decode in parallel on a thread pool.
+    :param blobs: list of compressed pulses from compress_pulse
+    :return: list of OTX pulse dicts
+    """
+    return [json.loads(zlib.decompress(blob)) for blob in blobs]
+
+
+DigestedPulse = namedtuple("DigestedPulse", ["row", "references", "attributes", "indicators", "pulse"])
+
+
+def epoch_seconds(timestamp: str) -> int:
+    """
+    Parses an OTX timestamp into integer seconds since the Unix epoch. OTX sends naive UTC timestamps with or without
+    fractional seconds, both of which fromisoformat reads directly.
+    :param timestamp: iso formatted timestamp
+    :return: seconds since the epoch, None if the timestamp is missing or malformed
+    """
+    if not timestamp:
+        return None
+    try:
+        parsed = datetime.fromisoformat(timestamp[:-1] + "+00:00" if timestamp.endswith("Z") else timestamp)
+    except (TypeError, ValueError):
+        log.debug("Timestamp %r is not iso formatted, storing it without an epoch", timestamp)
+        return None
+    # utctimetuple converts aware timestamps and leaves naive ones, which OTX sends in UTC, as they are
+    return calendar.timegm(parsed.utctimetuple())
+
+
+def _attribute_values(values) -> list:
+    """
+    Flattens an OTX pulse attribute into a list of distinct strings. OTX sends some attributes as a single string
+    (adversary, tlp) and others as lists of strings or of objects with an id/display_name (malware_families,
+    attack_ids).
+    :param values: raw attribute value from the pulse
+    :return: list of non-empty strings
+    """
+    if not values:
+        return []
+    if isinstance(values, (str, dict)):
+        values = [values]
+    flattened = []
+    for value in values:
+        if isinstance(value, dict):
+            value = value.get("id") or value.get("display_name") or value.get("name")
+        if value and value not in flattened:
+            flattened.append(str(value))
+    return flattened
+
+
+def digest_pulse(pulse: dict, relevance: RelevanceMatcher = None) -> DigestedPulse:
+    """
+    Normalizes a single OTX pulse into an SQL Insertable pulse row and the attributes stored alongside it.
+    :param pulse: OTX pulse dict
+    :param relevance: matcher that fills the profile attribute, no profiles are recorded without one
+    :return: DigestedPulse of the pulse row, the list of references, a dict of attribute to list of values, the
+             list of (type, indicator) tuples and the raw pulse itself
+    """
+    pulseId = pulse.get("id")
+    created = pulse.get("created")
+    modified = pulse.get("modified")
+    row = (pulseId, pulse.get("name"), created, modified, pulse.get("description"), pulse.get("author_name"),
+           epoch_seconds(created), epoch_seconds(modified))
+    malware = [family.get("display_name") or family.get("id") if isinstance(family, dict) else family
+               for family in pulse.get("malware_families") or []]
+    attributes = {
+        "industry": _attribute_values(pulse.get("industries")),
+        "tag": _attribute_values(pulse.get("tags")),
+        "country": _attribute_values(pulse.get("targeted_countries")),
+        "adversary": _attribute_values(pulse.get("adversary")),
+        "malware": _attribute_values(malware),
+        "attack": _attribute_values(pulse.get("attack_ids")),
+        "tlp": _attribute_values(pulse.get("tlp")),
+        "profile": sorted(relevance.match(pulse)) if relevance else [],
+    }
+    indicators = {(indicator.get("type"), indicator.get("indicator")) for indicator in pulse.get("indicators") or []
+                  if indicator.get("type") and indicator.get("indicator")}
+    return DigestedPulse(row, pulse.get("references") or [], attributes, list(indicators), pulse)
+
+
+def prefetch(iterable, maxsize: int = STREAM_PREFETCH) -> types.GeneratorType:
+    """
+    Drains an iterable on a background thread into a bounded queue, so producing items (e.g. network fetching) overlaps
+    with consuming them. Exceptions raised by the iterable are re-raised in the consumer.
+    :param iterable: Iterable to drain
+    :param maxsize: Maximum number of items buffered between producer and consumer
+    :return: Generator yielding the items of iterable in order
+    """
+    buffer = queue.Queue(maxsize = maxsize)
+    done = object()
+    errors = []
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                buffer.put(item)
+        except BaseException as e:
+            errors.append(e)
+        buffer.put(done)
+
+    producer = threading.Thread(target = produce, name = "otx-prefetch", daemon = True)
+    producer.start()
+    try:
+        while (item := buffer.get()) is not done:
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        # Unblock the producer if the consumer stops early
+        stop.set()
+        while producer.is_alive():
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                producer.join(timeout = 0.1)
+
+
+def backfill_windows(since: str = None, window_days: int = None, now: datetime = None) -> list:
+    """
+    Splits the pulse history into backfill windows of modified time. The first window is open towards the past and
+    the last one towards the future, so nothing published while the backfill runs falls between windows.
+    :param since: iso formatted timestamp the windows start from, defaults to OTX_HISTORY_START
+    :param window_days: length of each window in days, None for a single window over the whole history
+    :param now: end of the last closed window, defaults to the current time
+    :return: list of (window_start, window_end), '' for an open bound
+    """
+    if not window_days:
+        return [(since or "", "")]
+    start = datetime.fromisoformat(since or OTX_HISTORY_START)
+    now = now or datetime.today()
+    windows = []
+    windowStart = "" if since is None else start.isoformat()
+    while (start := start + timedelta(days = window_days)) < now:
+        windows.append((windowStart, start.isoformat()))
+        windowStart = start.isoformat()
+    windows.append((windowStart, ""))
+    return windows
+
+
+def progress_bar(enabled: bool = True):
+    """
+    :param enabled: False for headless runs, e.g. under cron or when stdout is a log file
+    :return: context manager of an alive_progress bar, or of None when disabled
+    """
+    if enabled:
+        from alive_progress import alive_bar
+        return alive_bar(force_tty = True)
+    return nullcontext()
 
 
 def convert_seconds(seconds):
@@ -43,10 +371,17 @@ class OTXHandler:
     """
     relevantPulses = []
 
-    def __init__(self, otx_key: str):
+    def __init__(self, otx_key: str, server: str = OTX_SERVER, max_workers: int = 8, progress: bool = True,
+                 relevance: RelevanceMatcher = None, page_cache: PageCache = None):
         self.relevantPulses = []
         self.typeOfPulses = None
-        self.otxObj = OTXv2(api_key = otx_key)
+        self.progress = progress
+        self.relevance = relevance or load_relevance()
+        # Imported on first use so commands that never reach OTX do not pay for the requests stack
+        from OTXv2 import OTXv2
+        self.otxObj = OTXv2(api_key = otx_key, server = server)
+        # Concurrent fetcher used for walking the subscribed pulse feed
+        self.pageFetcher = PageFetcher(otx_key, server = server, max_workers = max_workers, cache = page_cache)
 
     def __str__(self):
         returnStr = f"//==><==OTX Handler Object==><==\\\\\n//==>Number of Pulses in List: " \
@@ -75,7 +410,7 @@ class OTXHandler:
             timeD = timedelta(days = days)
             dateObj = dateObj - timeD
             # Return List of all OTX Pulses in last number days
-            return self.otxObj.getall(modified_since = dateObj, limit = 100, max_page = 1)
+            return self.otxObj.getall(modified_since = dateObj, limit = 100)
         else:
             return self.otxObj.getall()
 
@@ -91,41 +426,67 @@ class OTXHandler:
             timeD = timedelta(days = days)
             dateObj = dateObj - timeD
             # Return OTX Pulse Generator
-            return self.otxObj.getall_iter(modified_since = dateObj, limit = 100, max_page = 1)
+            return self.pageFetcher.getall_iter(modified_since = dateObj, limit = OTX_PAGE_SIZE)
         else:
             # Return OTX Pulse Generator
-            return self.otxObj.getall_iter()
+            return self.pageFetcher.getall_iter()
+
+    def _get_modified_since_pulses_gen(self, modified_since: str) -> types.GeneratorType:
+        """
+        Returns a Generator object that gets every pulse modified at or after an exact point in time, across all pages.
+        :param modified_since: iso formatted timestamp, typically the stored watermark of a table
+        :return: OTX Pulse generator object
+        """
+        return self.pageFetcher.getall_iter(modified_since = modified_since, limit = OTX_PAGE_SIZE)
+
+    def iter_backfill(self, modified_since: str = None, first_page: int = 1,
+                      limit: int = OTX_PAGE_SIZE) -> types.GeneratorType:
+        """
+        Returns a Generator object that walks the pulse feed from a given page onwards, to resume a backfill.
+        :param modified_since: iso formatted lower bound of the backfill window, None for the full history
+        :param first_page: 1-based page to start from
+        :param limit: page size, must be the one the backfill was checkpointed with
+        :return: OTX Pulse generator object
+        """
+        return self.pageFetcher.getall_iter(modified_since = modified_since or None, limit = limit,
+                                            first_page = first_page)
+
+    def iter_relevantpulses(self, last_numdays: int = None, profile: str = RELEVANT_PROFILE) -> types.GeneratorType:
+        """
+        Yields the pulses of a relevance profile from AlienVault one at a time, without keeping them in relevantPulses.
+        :param last_numdays: Maximum number of days ago you want pulses to be, defaults to all pulses
+        :param profile: relevance profile to yield the pulses of, defaults to aviation
+        :return: Generator of OTX Pulses
+        """
+        for pulse in self.iter_allpulses(last_numdays = last_numdays):
+            if profile in self.relevance.match(pulse):
+                yield pulse
+
+    def iter_allpulses(self, last_numdays: int = None, modified_since: str = None) -> types.GeneratorType:
+        """
+        Yields all pulses from AlienVault one at a time, without keeping them in relevantPulses.
+        :param last_numdays: Maximum number of days ago you want pulses to be, defaults to all pulses
+        :param modified_since: iso formatted timestamp to fetch from instead, takes precedence over last_numdays
+        :return: Generator of OTX Pulses
+        """
+        if modified_since:
+            return self._get_modified_since_pulses_gen(modified_since)
+        return self._get_lastnumdays_pulses_gen(days = last_numdays)
 
     def updatelist_relevantpulses(self, last_numdays: int = None) -> None:
         """
-        Updates object variable list, relevantPulses, with Aerospace related pulses from AlienVault
+        Updates object variable list, relevantPulses, with aviation related pulses from AlienVault
         :param last_numdays: Maximum number of days ago you want pulses to be, defaults to last 30 days
         :return: None
         """
         # Make sure list is clear
         self.relevantPulses.clear()
 
-        if last_numdays:
-            with alive_bar(force_tty = True) as bar:
-                # For each Pulse created in the last 30 days
-                for pulse in self._get_lastnumdays_pulses_gen(days = last_numdays):
-                    # Get the industries list, if one of them is "Aerospace", add to relevantPulses list
-                    if pulse.get("industries").count("Aerospace") > 0:
-                        # Make sure to sanitize description
-                        updatedDescription = sanitize_description(pulse.get("description"))
-                        pulse["description"] = updatedDescription
-                        self.relevantPulses.append(pulse)
-                        bar()
-        else:
-            with alive_bar(force_tty = True) as bar:
-                for pulse in self._get_lastnumdays_pulses_gen():
-                    # Get the industries list, if one of them is "Aerospace", add to relevantPulses list
-                    if pulse.get("industries").count("Aerospace") > 0:
-                        # Make sure to sanitize description
-                        updatedDescription = sanitize_description(pulse.get("description"))
-                        pulse["description"] = updatedDescription
-                        self.relevantPulses.append(pulse)
-                        bar()
+        with progress_bar(self.progress) as bar:
+            for pulse in self.iter_relevantpulses(last_numdays = last_numdays):
+                self.relevantPulses.append(pulse)
+                if bar:
+                    bar()
 
         self.typeOfPulses = "relevant"
 
@@ -138,141 +499,303 @@ class OTXHandler:
         # Make sure list is clear
         self.relevantPulses.clear()
 
-        if last_numdays:
-            with alive_bar(force_tty = True) as bar:
-                # For each Pulse created in the last number of days
-                for pulse in self._get_lastnumdays_pulses_gen(days = last_numdays):
-                    # Make sure to sanitize description
-                    updatedDescription = sanitize_description(pulse.get("description"))
-                    pulse["description"] = updatedDescription
-                    self.relevantPulses.append(pulse)
-                    bar()
-        else:
-            with alive_bar(force_tty = True) as bar:
-                # For each Pulse created ever since AV was created
-                for pulse in self._get_lastnumdays_pulses_gen():
-                    # Make sure to sanitize description
-                    updatedDescription = sanitize_description(pulse.get("description"))
-                    pulse["description"] = updatedDescription
-                    self.relevantPulses.append(pulse)
+        with progress_bar(self.progress) as bar:
+            for pulse in self.iter_allpulses(last_numdays = last_numdays):
+                self.relevantPulses.append(pulse)
+                if bar:
                     bar()
 
         self.typeOfPulses = "all"
 
-    def sort_pulses(self):
-        def key_sort(entry):
-            try:
-                return datetime.strptime(entry.get("created"), "%Y-%m-%dT%H:%M:%S.%f")
-            except ValueError as e:
-                print(f"WARNING: Data {entry.get('created')} has violated format. Alleviating.")
-                if "does not match format" in str(e):
-                    problemString = entry.get("created")
-                    problemString += ".000000"
-                    return datetime.strptime(problemString, "%Y-%m-%dT%H:%M:%S.%f")
-        self.relevantPulses.sort(key = key_sort)
-
 
 def integrity_pulses_insert(cursor: sqlite3.Cursor, table: str, pulselist: list):
     for pulse in pulselist:
         try:
-            cursor.execute(f"""INSERT INTO {table} VALUES {pulse}""")
+            cursor.execute(f"""INSERT INTO {table} (pulse_id, name, created, modified, description, author, 
+                    created_ts, modified_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", pulse)
         except sqlite3.IntegrityError as e:
             if e == "datatype mismatch":
-                print("CRITICAL ERROR: Datatype Mismatched! Check Code.")
+                log.critical("Datatype Mismatched! Check Code.")
                 return
             pulseId, *_ = pulse
-            print(f"WARNING: Data - {pulseId} - already exists in table")
+            log.debug("Data - %s - already exists in table", pulseId)
             continue
         except SQLError as e:
-            pulseId, _, _, name, description, author_name = pulse
-            print(f"ERROR: {e} has occurred! Data: {pulseId}, {name}, {description}, {author_name}")
+            pulseId, name, _, _, description, author_name, *_ = pulse
+            log.error("%s has occurred! Data: %s, %s, %s, %s", e, pulseId, name, description, author_name)
             continue
 
 
 def integrity_references_insert(cursor: sqlite3.Cursor, referencelist: list):
-    for entry in referencelist:
-        pulseId, refs = entry
-        for ref in refs:
-            try:
-                cursor.execute(f"""INSERT INTO reference (pulse_id, reference) VALUES ("{pulseId}", "{ref}")""")
-            except sqlite3.IntegrityError:
-                print(f"WARNING: Data - {pulseId} - already exists in table")
-                continue
+    # References already stored for a pulse are skipped by the UNIQUE (pulse_id, reference) index
+    cursor.executemany("""INSERT OR IGNORE INTO reference (pulse_id, reference) VALUES (?, ?)""",
+                       ((pulseId, ref) for pulseId, refs in referencelist for ref in refs))
+
+
+def delete_signatures(cursor: sqlite3.Cursor, pulse_ids: list) -> None:
+    """
+    Removes pulses from the MinHash index. Their LSH rows are found by recomputing the buckets of their stored
+    signatures, so pulse_lsh needs no index beyond its primary key. Must be called inside a transaction.
+    :param cursor: cursor of the pulse database
+    :param pulse_ids: list of pulse IDs
+    :return: None
+    """
+    stored = []
+    for start in range(0, len(pulse_ids), SQLITE_MAX_VARIABLES):
+        chunk = pulse_ids[start:start + SQLITE_MAX_VARIABLES]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"""SELECT pulse_key, signature FROM pulse_minhash WHERE pulse_id IN ({placeholders})""", chunk)
+        stored.extend(cursor.fetchall())
+    if not stored:
+        return
+    cursor.executemany("""DELETE FROM pulse_lsh WHERE band = ? AND bucket = ? AND pulse_key = ?""",
+                       [(band, bucket, pulseKey) for (pulseKey, _), buckets
+                        in zip(stored, lsh_buckets([signature for _, signature in stored]))
+                        for band, bucket in enumerate(buckets)])
+    cursor.executemany("""DELETE FROM pulse_minhash WHERE pulse_key = ?""", [(pulseKey,) for pulseKey, _ in stored])
+
+
+def store_signatures(cursor: sqlite3.Cursor, indicator_sets: dict) -> int:
+    """
+    Computes the MinHash signatures of pulses and files them into the LSH buckets, replacing what the pulses had in the
+    index. Pulses without indicators are left out of the index. Must be called inside a transaction.
+    :param cursor: cursor of the pulse database
+    :param indicator_sets: dict of pulse ID to list of its indicator values
+    :return: number of pulses indexed
+    """
+    delete_signatures(cursor, list(indicator_sets))
+    pulseIds = [pulseId for pulseId, indicators in indicator_sets.items() if indicators]
+    if not pulseIds:
+        return 0
+    signatures = minhash_signatures([indicator_sets[pulseId] for pulseId in pulseIds])
+    cursor.executemany("""INSERT INTO pulse_minhash (pulse_id, indicators, signature) VALUES (?, ?, ?)""",
+                       [(pulseId, len(set(indicator_sets[pulseId])), signature)
+                        for pulseId, signature in zip(pulseIds, signatures)])
+    cursor.executemany("""INSERT OR IGNORE INTO pulse_lsh (band, bucket, pulse_key) 
+            SELECT ?, ?, pulse_key FROM pulse_minhash WHERE pulse_id = ?""",
+                       [(band, bucket, pulseId) for pulseId, buckets in zip(pulseIds, lsh_buckets(signatures))
+                        for band, bucket in enumerate(buckets)])
+    return len(pulseIds)
+
+
+def index_stored_signatures(cursor: sqlite3.Cursor) -> int:
+    """
+    Indexes every pulse that has indicators but no signature yet, from its stored indicators, including the pulses
+    rolled into partitions. Must be called inside a "with connection:" block before anything in it is written: it
+    attaches the partitions, which cannot happen once the transaction has begun.
+    :param cursor: cursor of the pulse database
+    :return: number of pulses indexed
+    """
+    indexed = 0
+    attach_partitions(cursor.connection)
+    reader = cursor.connection.cursor()
+    reader.execute(f"""SELECT l.pulse_id, i.indicator FROM {PARTITIONED["pulse_indicator"]} l 
+            JOIN indicator i ON i.indicator_id = l.indicator_id 
+            WHERE l.pulse_id NOT IN (SELECT pulse_id FROM pulse_minhash) ORDER BY l.pulse_id""")
+    indicatorSets = {}
+    for pulseId, indicator in reader:
+        if pulseId not in indicatorSets and len(indicatorSets) >= STREAM_BATCH_SIZE:
+            indexed += store_signatures(cursor, indicatorSets)
+            indicatorSets = {}
+        indicatorSets.setdefault(pulseId, []).append(indicator)
+    return indexed + store_signatures(cursor, indicatorSets)
 
 
 class SQLiteDBHandler:
     # Root Directory
     global rootDir
 
-    def __init__(self):
+    def __init__(self, archive: bool = True, relevance: RelevanceMatcher = None, read_only: bool = False):
         global firstInitializationAllPulses, firstInitializationRelPulses
         # SQLite variables
+        self.archive = archive
+        # Sorts ingested pulses into relevance profiles
+        self.relevance = relevance or load_relevance()
         self.pulseList = []
         self.typeOfPulses = None
         self.references = []
+        # Stage timings and counters, ApplicationDirector swaps in a fresh RunMetrics for every sync run
+        self.metrics = RunMetrics("db")
+        # Writer thread of streams and pool of read-only query connections, both created on first use
+        self.writer = None
+        self.readPool = None
+        # ID of the sync run in progress, changelog entries are tagged with it
+        self.syncRun = None
+        # Table names of the main database, read once by _check_table_exists
+        self._schemaTables = None
+        # Indicator type name -> integer type code, filled lazily from indicator_type
+        self.indicatorTypes = {}
+        self.readOnly = read_only
+        if read_only:
+            self._init_read_only()
+            return
 
-        self.allPulsesMeta = AllPulsesMetadata()
-        self.relevantPulsesMeta = RelevantPulsesMetadata()
-
-        # Check for Metadata Files
-        allPulseMetadata = rootDir + "\\sqlite\\allpulsemeta.p"
-        relPulseMetadata = rootDir + "\\sqlite\\relpulsemeta.p"
-        print("Checking SQLite Directory and Files -")
+        log.debug("Checking SQLite Directory and Files")
         if not os.path.exists(rootDir + "\\sqlite"):
-            print("\tSqlite Directory does not exist, creating ... ", end = "")
+            log.info("Sqlite Directory does not exist, creating it")
             os.mkdir(rootDir + "\\sqlite")
-            print("Success")
-        if not os.path.exists(allPulseMetadata):
-            print("\tAll Pulses Metadata File does not exist, creating ... ", end = "")
-            temp = open(allPulseMetadata, "x")
-            temp.close()
-            print("Success")
-        if not os.path.exists(relPulseMetadata):
-            print("\tRelevant Pulses Metadata File does not exist, creating ... ", end = "")
-            temp = open(relPulseMetadata, "x")
-            temp.close()
-            print("Success")
-        self.allPulsesMetaFile = allPulseMetadata
-        self.relPulsesMetaFile = relPulseMetadata
-        print("Status: OK")
 
         # Check for Initial DB Connection
         if not self._init_pulsesdb_connect():
-            print("Cannot connect to local SQLite DB.")
+            log.error("Cannot connect to local SQLite DB.")
             raise Exception("Cannot Connect to Relevant_Pulses Database, ensure .db file is in correct directory.")
-        print("SQLite DB Connected. Status: OK")
+        log.debug("SQLite DB Connected. Status: OK")
         self.currentCursor = self.currentConnection.cursor()
-        print("Connection Cursor Set. Status: OK")
 
         # Check for pulses table in DB
         if not self._check_table_exists("allpulses"):
-            print("All Pulses table does not exist. Initializing table.")
+            log.info("All Pulses table does not exist. Initializing table.")
             self._init_pulse_table("allpulses")
             firstInitializationAllPulses = True
-        print("All Pulses table exists. Status: OK")
+        log.debug("All Pulses table exists. Status: OK")
         if not self._check_table_exists("relevantpulses"):
-            print("Relevant Pulses table does not exist. Initializing table.")
+            log.info("Relevant Pulses table does not exist. Initializing table.")
             self._init_pulse_table("relevantpulses")
             firstInitializationRelPulses = True
-        print("Relevant Pulses table exists. Status: OK")
+        log.debug("Relevant Pulses table exists. Status: OK")
         if not self._check_table_exists("reference"):
-            print("Reference table does not exist. Initializing table.")
+            log.info("Reference table does not exist. Initializing table.")
             self._init_reference_table()
-        print("Reference table exists. Status: OK")
-
-    def _check_table_exists(self, table: str) -> bool:
+        log.debug("Reference table exists. Status: OK")
+        for junctionTable, column in PULSE_ATTRIBUTES.values():
+            if not self._check_table_exists(junctionTable):
+                log.info(f"{junctionTable} table does not exist. Initializing table.")
+                self._init_junction_table(junctionTable, column)
+        log.debug("Pulse Attribute tables exist. Status: OK")
+        if not self._check_table_exists("sync_state"):
+            log.info("Sync State table does not exist. Initializing table.")
+            self._init_sync_state_table()
+        log.debug("Sync State table exists. Status: OK")
+        if not self._check_table_exists("backfill_window"):
+            log.info("Backfill table does not exist. Initializing table.")
+            self._init_backfill_table()
+        log.debug("Backfill table exists. Status: OK")
+        if not self._check_table_exists("relevance_profile"):
+            log.info("Relevance Profile table does not exist. Initializing table.")
+            self._init_profile_table()
+        log.debug("Relevance Profile table exists. Status: OK")
+        if not self._check_table_exists("export_state"):
+            log.info("Export State table does not exist. Initializing table.")
+            self._init_export_state_table()
+        log.debug("Export State table exists. Status: OK")
+        if not self._check_table_exists("changelog"):
+            log.info("Changelog tables do not exist. Initializing tables.")
+            self._init_changelog_tables()
+        log.debug("Changelog tables exist. Status: OK")
+        if not self._check_table_exists("partition_catalog"):
+            log.info("Partition Catalog table does not exist. Initializing table.")
+            self._init_partition_table()
+        log.debug("Partition Catalog table exists. Status: OK")
+        if not self._check_table_exists("indicator"):
+            log.info("Indicator tables do not exist. Initializing tables.")
+            self._init_indicator_tables()
+        log.debug("Indicator tables exist. Status: OK")
+        if not self._check_table_exists("pulse_fts"):
+            log.info("Search tables do not exist. Initializing tables.")
+            self._init_search_tables()
+        log.debug("Search tables exist. Status: OK")
+        if not self._check_table_exists("pulse_lsh"):
+            log.info("Similarity tables do not exist. Initializing tables.")
+            self._init_similarity_tables()
+        log.debug("Similarity tables exist. Status: OK")
+        self._init_archive()
+        log.debug("Pulse Archive attached. Status: OK")
+
+        # Bring databases created by older versions up to the current schema
+        self._migrate_schema()
+        log.debug(f"Schema Version {SCHEMA_VERSION}. Status: OK")
+
+    def _migrate_schema(self) -> None:
+        """
+        Applies every schema migration newer than the database's PRAGMA user_version, in order. Migrations are written to
+        be harmless on tables that were just created with the current schema.
+        :return: None
+        """
         cursor = self.currentCursor
+        cursor.execute("""PRAGMA user_version""")
+        version = cursor.fetchone()[0]
+        for migrationVersion, migration in enumerate(self._migrations(), start = 1):
+            if migrationVersion <= version:
+                continue
+            log.info("Migrating database schema to version %d (%s)", migrationVersion, migration.__name__)
+            with self.currentConnection:
+                migration(cursor)
+                cursor.execute(f"""PRAGMA user_version = {migrationVersion}""")
 
-        # Check if pulses table exists
-        cursor.execute(f"""SELECT count(name) FROM sqlite_master WHERE type= 'table' AND name= '{table}'""")
-        result = cursor.fetchone()[0]
+    @staticmethod
+    def _migrations() -> list:
+        """
+        :return: list of migrations, migration N (1-based) takes the schema from version N - 1 to version N
+        """
+        def index_modified(cursor: sqlite3.Cursor) -> None:
+            for table in ("allpulses", "relevantpulses"):
+                cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_{table}_modified ON {table} (modified)""")
+
+        def index_search(cursor: sqlite3.Cursor) -> None:
+            # Pulses stored before full-text search existed, references are grouped once rather than per pulse
+            cursor.execute("""INSERT OR IGNORE INTO pulse_search_doc (pulse_id) SELECT pulse_id FROM allpulses""")
+            cursor.execute("""INSERT INTO pulse_fts (rowid, name, description, refs) 
+                    SELECT d.docid, a.name, a.description, r.refs FROM allpulses a 
+                    JOIN pulse_search_doc d ON d.pulse_id = a.pulse_id 
+                    LEFT JOIN (SELECT pulse_id, group_concat(reference, ' ') AS refs FROM reference GROUP BY pulse_id) r 
+                    ON r.pulse_id = a.pulse_id WHERE d.docid NOT IN (SELECT rowid FROM pulse_fts)""")
+
+        def unique_references(cursor: sqlite3.Cursor) -> None:
+            # Every re-sync used to append the same references again, keep the first copy of each
+            cursor.execute("""DELETE FROM reference WHERE rowid NOT IN 
+                    (SELECT MIN(rowid) FROM reference GROUP BY pulse_id, reference)""")
+            cursor.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_reference_pulse_reference 
+                    ON reference (pulse_id, reference)""")
+
+        def epoch_timestamps(cursor: sqlite3.Cursor) -> None:
+            # created/modified are kept as OTX sent them, the indexed epoch columns answer ordering and time ranges
+            cursor.connection.create_function("epoch_seconds", 1, epoch_seconds, deterministic = True)
+            for table in ("allpulses", "relevantpulses"):
+                cursor.execute(f"""PRAGMA table_info({table})""")
+                columns = {row[1] for row in cursor.fetchall()}
+                # Both pulse tables gain the columns in the same order, relevantpulses is filled with SELECT a.*
+                for column in ("created_ts", "modified_ts"):
+                    if column not in columns:
+                        cursor.execute(f"""ALTER TABLE {table} ADD COLUMN {column} INTEGER""")
+                cursor.execute(f"""UPDATE {table} SET created_ts = epoch_seconds(created), 
+                        modified_ts = epoch_seconds(modified) WHERE created_ts IS NULL OR modified_ts IS NULL""")
+                cursor.execute(f"""DROP INDEX IF EXISTS idx_{table}_modified""")
+                cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_{table}_created_ts ON {table} (created_ts)""")
+                cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_{table}_modified_ts ON {table} (modified_ts)""")
+
+        def relevant_profile(cursor: sqlite3.Cursor) -> None:
+            # Pulses stored before profiles existed are only known to be relevant by being in relevantpulses, many of
+            # them by industries that were never stored. refresh_profiles keeps the rows of pulses without attributes.
+            cursor.execute("""INSERT OR IGNORE INTO pulse_profile (profile, pulse_id) SELECT ?, pulse_id
+                    FROM relevantpulses""", (RELEVANT_PROFILE,))
+
+        def export_cursor(cursor: sqlite3.Cursor) -> None:
+            # Incremental exports follow the changelog, exports last run before it start over with a full export
+            cursor.execute("""PRAGMA table_info(export_state)""")
+            if "change_cursor" not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute("""ALTER TABLE export_state ADD COLUMN change_cursor INTEGER""")
+
+        def minhash_index(cursor: sqlite3.Cursor) -> None:
+            # Pulses stored before the MinHash index existed, from the indicators they were stored with
+            index_stored_signatures(cursor)
+
+        return [index_modified, index_search, unique_references, epoch_timestamps, relevant_profile, export_cursor,
+                minhash_index]
 
-        if result == 1:
+    def _check_table_exists(self, table: str) -> bool:
+        """
+        Answers from one read of the table names in sqlite_master, kept until the schema changes. A table found missing
+        is about to be created by the caller, so the names are read again on the next check.
+        :param table: name of the table
+        :return: Boolean if the table exists
+        """
+        if self._schemaTables is None:
+            self.currentCursor.execute("""SELECT name FROM sqlite_master WHERE type = 'table'""")
+            self._schemaTables = {name for (name,) in self.currentCursor.fetchall()}
+        if table in self._schemaTables:
             return True
-        elif result == 0:
-            return False
-        else:
-            raise Exception(f"Checking for the existance of {table} produced not a 0 or 1 result for count")
+        self._schemaTables = None
+        return False
 
     def _init_pulsesdb_connect(self) -> bool:
         """
@@ -286,19 +809,43 @@ class SQLiteDBHandler:
             try:
                 os.mkdir(path)
             except OSError:
-                print("Failed to create directory for sqlite DB. Functionality Disabled.")
+                log.error("Failed to create directory for sqlite DB. Functionality Disabled.")
                 return False
 
         # Attempt to connect to SQL Database
         try:
-            relPulsesDBConnect = sqlite3.connect(path + "\\Relevant_Pulses.sqlite3")
+            # Shared with the writer thread during streams, never used by both at once
+            relPulsesDBConnect = sqlite3.connect(database_path(), check_same_thread = False)
+            configure_connection(relPulsesDBConnect)
         except SQLError as e:
-            print(f"Failed to connect to SQLite DB.\nError: {e}")
+            log.error("Failed to connect to SQLite DB. Error: %s", e)
             return False
         else:
             self.currentConnection = relPulsesDBConnect
             return True
 
+    def _init_read_only(self) -> None:
+        """
+        Opens the pulse database and, if there is one, the archive read-only, for the tools that only query. Nothing is
+        created, migrated or refreshed, so they never take the write lock of a running sync.
+        :return: None
+        """
+        path = database_path()
+        if not os.path.exists(path):
+            raise SchemaVersionError(f"No pulse database at {path}, run a sync first")
+        self.currentConnection = connect_reader(path)
+        self.currentCursor = self.currentConnection.cursor()
+        self.currentCursor.execute("""PRAGMA user_version""")
+        version = self.currentCursor.fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.currentConnection.close()
+            raise SchemaVersionError(f"The pulse database has schema version {version}, this version of otx reads "
+                                     f"{SCHEMA_VERSION}. Run a sync or rebuild to migrate it.")
+        if os.path.exists(archive_path()):
+            self.currentCursor.execute("""ATTACH DATABASE ? AS archive""",
+                                       (f"file:{pathname2url(archive_path())}?mode=ro",))
+        log.debug("SQLite DB opened read-only. Status: OK")
+
     def _init_pulse_table(self, table: str) -> None:
         """
         Initial query into database, handles first connection into DB. Creates selected table if does not exist.
@@ -307,9 +854,11 @@ class SQLiteDBHandler:
         cursor = self.currentCursor
 
         if not self._check_table_exists(table):
-            print(f"Table does not exist. Creating {table} table.")
+            log.debug(f"Table does not exist. Creating {table} table.")
             cursor.execute(f"""CREATE TABLE {table} (pulse_id TEXT PRIMARY KEY NOT NULL, name TEXT, created TEXT, 
-                    modified TEXT, description TEXT, author TEXT)""")
+                    modified TEXT, description TEXT, author TEXT, created_ts INTEGER, modified_ts INTEGER)""")
+            cursor.execute(f"""CREATE INDEX idx_{table}_created_ts ON {table} (created_ts)""")
+            cursor.execute(f"""CREATE INDEX idx_{table}_modified_ts ON {table} (modified_ts)""")
             self.currentConnection.commit()
             # print("Created table. Returning True.")
 
@@ -319,11 +868,467 @@ class SQLiteDBHandler:
         #if result == 1:
         # print("Table Exists, returning True")
         if not self._check_table_exists("reference"):
-            print("Table does not exist. Creating references table.")
+            log.debug("Table does not exist. Creating references table.")
             cursor.execute("""CREATE TABLE reference (pulse_id text NOT NULL, reference text)""")
+            # Doubles as the pulse_id index, lookups by pulse_id use its leading column
+            cursor.execute("""CREATE UNIQUE INDEX idx_reference_pulse_reference ON reference (pulse_id, reference)""")
             self.currentConnection.commit()
             # print("Created table. Returning True.")
 
+    def _init_junction_table(self, table: str, column: str) -> None:
+        """
+        Creates a pulse attribute junction table, one row per (value, pulse). Keyed on the value first so filtering by an
+        attribute (and deriving relevantpulses from pulse_industry) is an index range scan that never touches the pulse
+        table, with a second index on pulse_id for rebuilding the rows of a single pulse.
+        :param table: junction table to create, see PULSE_ATTRIBUTES
+        :param column: name of the value column
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists(table):
+            log.debug(f"Table does not exist. Creating {table} table.")
+            cursor.execute(f"""CREATE TABLE {table} ({column} TEXT NOT NULL, pulse_id TEXT NOT NULL, 
+                    PRIMARY KEY ({column}, pulse_id)) WITHOUT ROWID""")
+            cursor.execute(f"""CREATE INDEX idx_{table}_pulse ON {table} (pulse_id)""")
+            self.currentConnection.commit()
+
+    def _init_indicator_tables(self) -> None:
+        """
+        Creates the indicator tables. Each distinct (type, indicator) is stored once in indicator under an integer ID,
+        types are stored once in indicator_type under an integer code, and pulse_indicator links the two with nothing
+        but integer IDs and the pulse ID. The unique key leads with the value, so looking an indicator up with or
+        without its type is an index search. Indicator IDs are never reused, so readers can load new ones incrementally.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("indicator_type"):
+            log.debug("Table does not exist. Creating indicator_type table.")
+            cursor.execute("""CREATE TABLE indicator_type (type_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)""")
+        if not self._check_table_exists("indicator"):
+            log.debug("Table does not exist. Creating indicator table.")
+            cursor.execute("""CREATE TABLE indicator (indicator_id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                    type_id INTEGER NOT NULL, indicator TEXT NOT NULL, UNIQUE (indicator, type_id))""")
+        if not self._check_table_exists("pulse_indicator"):
+            log.debug("Table does not exist. Creating pulse_indicator table.")
+            cursor.execute("""CREATE TABLE pulse_indicator (indicator_id INTEGER NOT NULL, pulse_id TEXT NOT NULL, 
+                    PRIMARY KEY (indicator_id, pulse_id)) WITHOUT ROWID""")
+            cursor.execute("""CREATE INDEX idx_pulse_indicator_pulse ON pulse_indicator (pulse_id)""")
+        self.currentConnection.commit()
+
+    def _init_search_tables(self) -> None:
+        """
+        Creates the FTS5 full-text index over pulse names, descriptions and references. FTS5 rows are addressed by an
+        integer rowid, so pulse_search_doc gives every pulse a stable docid to key its index row on.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("pulse_search_doc"):
+            log.debug("Table does not exist. Creating pulse_search_doc table.")
+            cursor.execute("""CREATE TABLE pulse_search_doc (docid INTEGER PRIMARY KEY, pulse_id TEXT UNIQUE NOT NULL)""")
+        if not self._check_table_exists("pulse_fts"):
+            log.debug("Table does not exist. Creating pulse_fts table.")
+            cursor.execute("""CREATE VIRTUAL TABLE pulse_fts USING fts5(name, description, refs, 
+                    tokenize = 'unicode61 remove_diacritics 2')""")
+        self.currentConnection.commit()
+
+    def _init_similarity_tables(self) -> None:
+        """
+        Creates the MinHash index over the indicator sets of the pulses, see otxsimilar. pulse_minhash holds the
+        signature of every pulse with indicators under an integer key, and pulse_lsh files the key under the bucket of
+        each band of the signature, pulses sharing any bucket being candidates for similar indicator sets.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("pulse_minhash"):
+            log.debug("Table does not exist. Creating pulse_minhash table.")
+            cursor.execute("""CREATE TABLE pulse_minhash (pulse_key INTEGER PRIMARY KEY, pulse_id TEXT UNIQUE NOT NULL, 
+                    indicators INTEGER NOT NULL, signature BLOB NOT NULL)""")
+        if not self._check_table_exists("pulse_lsh"):
+            log.debug("Table does not exist. Creating pulse_lsh table.")
+            cursor.execute("""CREATE TABLE pulse_lsh (band INTEGER NOT NULL, bucket INTEGER NOT NULL, 
+                    pulse_key INTEGER NOT NULL, PRIMARY KEY (band, bucket, pulse_key)) WITHOUT ROWID""")
+        self.currentConnection.commit()
+
+    def _index_search(self, documents: list) -> None:
+        """
+        Adds pulses to the full-text index, replacing any index rows they already have (modified pulses, or pulses
+        ingested again after their table was reset). Must be called inside the ingest transaction.
+        :param documents: list of (pulse_id, name, description, references text) tuples
+        :return: None
+        """
+        cursor = self.currentCursor
+        cursor.executemany("""DELETE FROM pulse_fts WHERE rowid = (SELECT docid FROM pulse_search_doc 
+                WHERE pulse_id = ?)""", [(document[0],) for document in documents])
+        cursor.executemany("""INSERT OR IGNORE INTO pulse_search_doc (pulse_id) VALUES (?)""",
+                           [(document[0],) for document in documents])
+        cursor.executemany("""INSERT INTO pulse_fts (rowid, name, description, refs) 
+                SELECT docid, ?2, ?3, ?4 FROM pulse_search_doc WHERE pulse_id = ?1""", documents)
+
+    def _init_archive(self) -> None:
+        """
+        Attaches the raw pulse archive as "archive" and creates its table. The archive is append-only: every version of
+        every pulse ingested, keyed by pulse ID and modified time, as compressed JSON. It lives in its own file so the
+        pulse database stays small, but being attached it is written in the same transaction as the pulses.
+        :return: None
+        """
+        cursor = self.currentCursor
+        cursor.execute("""ATTACH DATABASE ? AS archive""", (archive_path(),))
+        # The archive is only ever appended to, it needs no more than SQLite's default cache. In WAL mode a transaction
+        # is atomic per database file, the archive insert is idempotent should a crash split one.
+        configure_connection(self.currentConnection, schema = "archive", cache_size_kib = 2000)
+        cursor.execute("""CREATE TABLE IF NOT EXISTS archive.pulse_archive (archive_id INTEGER PRIMARY KEY, 
+                pulse_id TEXT NOT NULL, modified TEXT NOT NULL, data BLOB NOT NULL, UNIQUE (pulse_id, modified))""")
+        self.currentConnection.commit()
+
+    def _indicator_type_ids(self, names) -> dict:
+        """
+        Resolves indicator type names to their integer codes, registering unseen types. Must be called inside the
+        ingest transaction.
+        :param names: iterable of indicator type names, e.g. "IPv4", "domain", "FileHash-SHA256"
+        :return: dict of type name to type code
+        """
+        missing = [name for name in set(names) if name not in self.indicatorTypes]
+        if missing:
+            self.currentCursor.executemany("""INSERT OR IGNORE INTO indicator_type (name) VALUES (?)""",
+                                           [(name,) for name in missing])
+            self.currentCursor.execute("""SELECT name, type_id FROM indicator_type""")
+            self.indicatorTypes.update(self.currentCursor.fetchall())
+        return self.indicatorTypes
+
+    def _insert_indicators(self, links: list) -> None:
+        """
+        Bulk inserts indicators, deduplicated against every pulse already stored, and links them to their pulses. Must
+        be called inside the ingest transaction.
+        :param links: list of (type, indicator, pulse_id) tuples
+        :return: None
+        """
+        if not links:
+            return
+        typeIds = self._indicator_type_ids(link[0] for link in links)
+        rows = [(typeIds[indicatorType], indicator, pulseId) for indicatorType, indicator, pulseId in links]
+        self.currentCursor.executemany("""INSERT OR IGNORE INTO indicator (type_id, indicator) VALUES (?, ?)""",
+                                       {row[:2] for row in rows})
+        self.currentCursor.executemany("""INSERT OR IGNORE INTO pulse_indicator (indicator_id, pulse_id) 
+                SELECT indicator_id, ?3 FROM indicator WHERE type_id = ?1 AND indicator = ?2""", rows)
+
+    def _init_sync_state_table(self) -> None:
+        """
+        Creates the sync_state table, which holds the modified watermark and last update time of each pulse table. It is
+        written in the same transaction as the pulses it describes, so it can never run ahead of the data.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("sync_state"):
+            log.debug("Table does not exist. Creating sync_state table.")
+            cursor.execute("""CREATE TABLE sync_state (table_name TEXT PRIMARY KEY NOT NULL, watermark TEXT, 
+                    last_updated TEXT)""")
+            self.currentConnection.commit()
+
+    def _init_export_state_table(self) -> None:
+        """
+        Creates the export_state table, which holds the changelog cursor and the modified watermark each named export
+        last exported up to, so an incremental export only writes what was added or modified since.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("export_state"):
+            log.debug("Table does not exist. Creating export_state table.")
+            cursor.execute("""CREATE TABLE export_state (export_name TEXT PRIMARY KEY NOT NULL, table_name TEXT, 
+                    watermark TEXT, last_exported TEXT, rows INTEGER, change_cursor INTEGER)""")
+            self.currentConnection.commit()
+
+    def get_export_state(self, name: str) -> tuple:
+        """
+        :param name: name of the export
+        :return: tuple of the watermark the export last exported up to, the time it ran and the change_id of the last
+                 change it covered, any can be None
+        """
+        self.currentCursor.execute("""SELECT watermark, last_exported, change_cursor FROM export_state 
+                WHERE export_name = ?""", (name,))
+        return self.currentCursor.fetchone() or (None, None, None)
+
+    def set_export_state(self, name: str, table: str, watermark: str, rows: int, change_cursor: int = None) -> None:
+        """
+        Records a finished export. The watermark only ever moves forward.
+        :param name: name of the export
+        :param table: table that was exported
+        :param watermark: newest modified timestamp of the exported snapshot
+        :param rows: number of rows written
+        :param change_cursor: change_id of the last change in the exported snapshot
+        :return: None
+        """
+        with self.currentConnection:
+            self.currentCursor.execute("""INSERT INTO export_state (export_name, table_name, watermark, last_exported, 
+                    rows, change_cursor) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (export_name) DO UPDATE SET 
+                    table_name = excluded.table_name, last_exported = excluded.last_exported, rows = excluded.rows, 
+                    change_cursor = excluded.change_cursor, 
+                    watermark = CASE WHEN export_state.watermark IS NULL OR excluded.watermark > export_state.watermark 
+                    THEN excluded.watermark ELSE export_state.watermark END""",
+                                       (name, table, watermark, datetime.today().isoformat(), rows, change_cursor))
+
+    def _init_backfill_table(self) -> None:
+        """
+        Creates the backfill_window table, the checkpoints of the allpulses backfill. The history is split into windows
+        of modified time, '' standing for an open bound, and each window records how many pulses of its feed walk are
+        committed, in the same transaction as those pulses.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("backfill_window"):
+            log.debug("Table does not exist. Creating backfill_window table.")
+            cursor.execute("""CREATE TABLE backfill_window (window_start TEXT NOT NULL, window_end TEXT NOT NULL, 
+                    page_size INTEGER NOT NULL, consumed INTEGER NOT NULL DEFAULT 0, watermark TEXT, started TEXT, 
+                    completed TEXT, PRIMARY KEY (window_start, window_end))""")
+            self.currentConnection.commit()
+
+    def _init_profile_table(self) -> None:
+        """
+        Creates the relevance_profile table, which holds a fingerprint of the rules each profile's pulse_profile rows were
+        matched with. A profile whose rules no longer hash to its fingerprint is matched again by refresh_profiles.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("relevance_profile"):
+            log.debug("Table does not exist. Creating relevance_profile table.")
+            cursor.execute("""CREATE TABLE relevance_profile (profile TEXT PRIMARY KEY NOT NULL, 
+                    fingerprint TEXT NOT NULL, evaluated TEXT)""")
+            self.currentConnection.commit()
+
+    def _init_changelog_tables(self) -> None:
+        """
+        Creates the sync_run and changelog tables. Every sync run gets a row in sync_run, and every pulse it inserts,
+        updates or removes from allpulses or relevantpulses a row in changelog, written in the transaction of the change
+        itself. Consumers poll changelog after the last change_id they have seen instead of diffing the tables.
+        Changes made outside a sync run, e.g. by a profile refresh, have no run_id.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("sync_run"):
+            log.debug("Table does not exist. Creating sync_run table.")
+            cursor.execute("""CREATE TABLE sync_run (run_id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT NOT NULL, 
+                    finished TEXT, status TEXT NOT NULL, inserted INTEGER, updated INTEGER)""")
+        if not self._check_table_exists("changelog"):
+            log.debug("Table does not exist. Creating changelog table.")
+            # Tables and kinds of change are stored as their index in CHANGE_TABLES and CHANGE_KINDS. AUTOINCREMENT
+            # keeps change IDs from ever being handed out twice, so a consumer's cursor stays valid.
+            cursor.execute("""CREATE TABLE changelog (change_id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER, 
+                    table_code INTEGER NOT NULL, pulse_id TEXT NOT NULL, change INTEGER NOT NULL, old_modified TEXT, 
+                    new_modified TEXT)""")
+        self.currentConnection.commit()
+
+    def start_sync_run(self) -> int:
+        """
+        Records the start of a sync run, the changes written until finish_sync_run are tagged with its ID.
+        :return: ID of the run
+        """
+        with self.currentConnection:
+            self.currentCursor.execute("""INSERT INTO sync_run (started, status) VALUES (?, 'running')""",
+                                       (datetime.today().isoformat(),))
+        self.syncRun = self.currentCursor.lastrowid
+        return self.syncRun
+
+    def finish_sync_run(self, status: str, inserted: int = 0, updated: int = 0) -> None:
+        """
+        :param status: outcome of the run, "completed" or "failed"
+        :param inserted: number of pulses the run inserted
+        :param updated: number of pulses the run updated
+        :return: None
+        """
+        with self.currentConnection:
+            self.currentCursor.execute("""UPDATE sync_run SET finished = ?, status = ?, inserted = ?, updated = ? 
+                    WHERE run_id = ?""", (datetime.today().isoformat(), status, inserted, updated, self.syncRun))
+        self.syncRun = None
+
+    def log_changes(self, changes: list) -> None:
+        """
+        Appends changes to the changelog. Must be called inside the transaction that made them, on the handler's
+        connection.
+        :param changes: list of (table, pulse_id, kind, old modified, new modified) tuples, table and kind as named in
+                        CHANGE_TABLES and CHANGE_KINDS
+        :return: None
+        """
+        if not changes:
+            return
+        self.currentCursor.executemany("""INSERT INTO changelog (run_id, table_code, pulse_id, change, old_modified, 
+                new_modified) VALUES (?, ?, ?, ?, ?, ?)""",
+                                       [(self.syncRun, CHANGE_TABLES.index(table), pulseId, CHANGE_KINDS.index(kind),
+                                         oldModified, newModified)
+                                        for table, pulseId, kind, oldModified, newModified in changes])
+        self.metrics.count("changes_logged", len(changes))
+
+    def changes_since(self, cursor: int = 0, table: str = "relevantpulses", limit: int = 1000) -> list:
+        """
+        Reads the changelog after a cursor, in the order the changes were committed. Costs O(changes returned) whatever
+        the size of the tables.
+        :param cursor: change_id of the last change already seen, 0 to read from the start
+        :param table: only changes of this table, one of CHANGE_TABLES, None for both
+        :param limit: Maximum number of changes to return
+        :return: list of (change_id, run_id, table, pulse_id, kind, old modified, new modified) tuples, the change_id
+                 of the last one being the cursor to continue from
+        """
+        query = """SELECT change_id, run_id, table_code, pulse_id, change, old_modified, new_modified FROM changelog 
+                WHERE change_id > ?"""
+        params = [cursor]
+        if table:
+            if table not in CHANGE_TABLES:
+                raise ValueError(f"Invalid table {table}, choose from {', '.join(CHANGE_TABLES)}")
+            query += " AND table_code = ?"
+            params.append(CHANGE_TABLES.index(table))
+        return [(changeId, runId, CHANGE_TABLES[tableCode], pulseId, CHANGE_KINDS[change], oldModified, newModified)
+                for changeId, runId, tableCode, pulseId, change, oldModified, newModified
+                in self._read(query + " ORDER BY change_id LIMIT ?", [*params, limit])]
+
+    def sync_runs(self, limit: int = 20) -> list:
+        """
+        :param limit: Maximum number of runs to return
+        :return: list of (run_id, started, finished, status, inserted, updated) tuples, newest first
+        """
+        return self._read("""SELECT run_id, started, finished, status, inserted, updated FROM sync_run 
+                ORDER BY run_id DESC LIMIT ?""", (limit,))
+
+    def _init_partition_table(self) -> None:
+        """
+        Creates the partition_catalog table, one row per partition file the older allpulses, reference and
+        pulse_indicator rows were rolled into, with the modified_ts range it covers. See otxpartition.
+        :return: None
+        """
+        cursor = self.currentCursor
+
+        if not self._check_table_exists("partition_catalog"):
+            log.debug("Table does not exist. Creating partition_catalog table.")
+            cursor.execute("""CREATE TABLE partition_catalog (name TEXT PRIMARY KEY NOT NULL, period TEXT NOT NULL, 
+                    start_ts INTEGER NOT NULL, end_ts INTEGER NOT NULL, pulses INTEGER NOT NULL DEFAULT 0, 
+                    updated TEXT)""")
+            self.currentConnection.commit()
+
+    def remove_partitions(self, names: list = None) -> None:
+        """
+        Forgets partitions and deletes their files.
+        :param names: partitions to remove, defaults to every partition
+        :return: None
+        """
+        cursor = self.currentCursor
+        if names is None:
+            cursor.execute("""SELECT name FROM partition_catalog""")
+            names = [row[0] for row in cursor.fetchall()]
+        with self.currentConnection:
+            cursor.executemany("""DELETE FROM partition_catalog WHERE name = ?""", [(name,) for name in names])
+        # Attached files cannot be deleted on every platform, the next attach_partitions picks up the rest again
+        detach_partitions(self.currentConnection)
+        for name in names:
+            remove_database_files(partition_path(name))
+
+    def vacuum(self, full: bool = False) -> int:
+        """
+        Returns the free pages of the pulse database and the archive to the file system. Databases created with
+        auto_vacuum=INCREMENTAL give them back in place, older ones are only switched over (a full VACUUM rewriting the
+        file) when full is set.
+        :param full: switch databases without incremental auto vacuum over
+        :return: number of pages returned to the file system
+        """
+        cursor = self.currentCursor
+        self.currentConnection.commit()
+        freed = 0
+        for schema in ("main", "archive"):
+            before = cursor.execute(f"""PRAGMA {schema}.page_count""").fetchone()[0]
+            if cursor.execute(f"""PRAGMA {schema}.auto_vacuum""").fetchone()[0] == 2:
+                # execute() only steps the pragma once, freeing a single page, executescript runs it to completion
+                self.currentConnection.executescript(f"""PRAGMA {schema}.incremental_vacuum""")
+            elif full:
+                log.info("Switching %s to incremental auto vacuum, rewriting the file", schema)
+                cursor.execute(f"""PRAGMA {schema}.auto_vacuum = INCREMENTAL""")
+                cursor.execute(f"""VACUUM {schema}""")
+            freed += before - cursor.execute(f"""PRAGMA {schema}.page_count""").fetchone()[0]
+        return freed
+
+    def plan_backfill(self, windows: list, page_size: int = OTX_PAGE_SIZE) -> None:
+        """
+        Plans a backfill of the given windows. Windows already planned keep their progress, completed ones from an
+        earlier backfill are dropped.
+        :param windows: list of (window_start, window_end) iso formatted timestamps, '' for an open bound
+        :param page_size: OTX page size the windows are walked and checkpointed with
+        :return: None
+        """
+        with self.currentConnection:
+            self.currentCursor.execute("""DELETE FROM backfill_window WHERE completed IS NOT NULL""")
+            self.currentCursor.executemany("""INSERT OR IGNORE INTO backfill_window (window_start, window_end, 
+                    page_size, started) VALUES (?, ?, ?, ?)""",
+                                           [(start, end, page_size, datetime.today().isoformat())
+                                            for start, end in windows])
+
+    def pending_backfill(self) -> list:
+        """
+        :return: list of (window_start, window_end, page_size, consumed) of every unfinished backfill window, oldest
+                 window first
+        """
+        self.currentCursor.execute("""SELECT window_start, window_end, page_size, consumed FROM backfill_window 
+                WHERE completed IS NULL ORDER BY window_start""")
+        return self.currentCursor.fetchall()
+
+    def checkpoint_backfill(self, window_start: str, window_end: str, consumed: int, watermark: str = None,
+                             completed: bool = False) -> None:
+        """
+        Records the progress of a backfill window. Must be called inside the transaction that wrote the pulses. When
+        the last window completes, the newest modified timestamp seen by any window becomes the allpulses watermark.
+        :param window_start: start of the window
+        :param window_end: end of the window
+        :param consumed: number of pulses of the window's feed walk that are committed
+        :param watermark: newest modified timestamp written by the window so far
+        :param completed: whether the whole window is committed
+        :return: None
+        """
+        cursor = self.currentCursor
+        cursor.execute("""UPDATE backfill_window SET consumed = ?, 
+                watermark = CASE WHEN watermark IS NULL OR ? > watermark THEN ? ELSE watermark END, 
+                completed = ? WHERE window_start = ? AND window_end = ?""",
+                       (consumed, watermark, watermark, datetime.today().isoformat() if completed else None,
+                        window_start, window_end))
+        if completed:
+            cursor.execute("""SELECT SUM(completed IS NULL), MAX(watermark) FROM backfill_window""")
+            pending, newest = cursor.fetchone()
+            if not pending:
+                self._set_sync_state("allpulses", newest)
+
+    def get_sync_state(self, table: str) -> tuple:
+        """
+        Returns the sync state of a pulse table. Databases that predate sync_state fall back to the newest modified
+        timestamp stored in the table.
+        :param table: Table to get the state of, either "allpulses" or "relevantpulses"
+        :return: tuple of the modified watermark and the last update time, either can be None
+        """
+        cursor = self.currentCursor
+        cursor.execute("""SELECT watermark, last_updated FROM sync_state WHERE table_name = ?""", (table,))
+        watermark, lastUpdated = cursor.fetchone() or (None, None)
+        if watermark is None:
+            # Read off the end of the modified_ts index, only pulses within the newest second are compared as text
+            cursor.execute(f"""SELECT modified FROM {table} WHERE modified_ts = (SELECT MAX(modified_ts) FROM {table}) 
+                    ORDER BY modified DESC LIMIT 1""")
+            watermark = (cursor.fetchone() or (None,))[0]
+        return watermark, lastUpdated
+
+    def _set_sync_state(self, table: str, watermark: str = None) -> None:
+        """
+        Records a completed sync of a table. Must be called inside the transaction that wrote the synced data. The
+        watermark only ever moves forward.
+        :param table: Table that was synced
+        :param watermark: newest modified timestamp that was synced, None keeps the current watermark
+        :return: None
+        """
+        self.currentCursor.execute("""INSERT INTO sync_state (table_name, watermark, last_updated) VALUES (?, ?, ?) 
+                ON CONFLICT (table_name) DO UPDATE SET last_updated = excluded.last_updated, 
+                watermark = CASE WHEN sync_state.watermark IS NULL OR excluded.watermark > sync_state.watermark 
+                THEN excluded.watermark ELSE sync_state.watermark END""",
+                                   (table, watermark, datetime.today().isoformat()))
+
     def digest_pulses(self, otx_object: OTXHandler) -> None:
         """
         Digests the pulses from OTX object into an SQL Insertable form to insert into a pulse table.
@@ -335,17 +1340,405 @@ class SQLiteDBHandler:
         self.references.clear()
 
         for pulse in otx_object.relevantPulses:
-            pulseId = pulse.get("id")
-            name = pulse.get("name")
-            created = pulse.get("created")
-            modified = pulse.get("modified")
-            description = pulse.get("description")
-            author = pulse.get("author_name")
-            references = pulse.get("references")
-            self.pulseList.append((pulseId, name, created, modified, description, author))
-            self.references.append((pulseId, references))
+            digested = digest_pulse(pulse, self.relevance)
+            self.pulseList.append(digested.row)
+            self.references.append((digested.row[0], digested.references))
         self.typeOfPulses = otx_object.typeOfPulses
 
+    def stored_modified(self, table: str, pulse_ids) -> dict:
+        """
+        Probes the primary key index of the selected table for the given pulse IDs.
+        :param table: string of the table to probe, has to be either 'allpulses' or 'relevantpulses'
+        :param pulse_ids: iterable of pulse IDs to look up
+        :return: dict of pulse ID to stored modified timestamp, for the pulse IDs that already exist in the table
+        """
+        stored = {}
+        pulseIds = list(pulse_ids)
+        for start in range(0, len(pulseIds), SQLITE_MAX_VARIABLES):
+            chunk = pulseIds[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            self.currentCursor.execute(f"""SELECT pulse_id, modified FROM {table} WHERE pulse_id IN ({placeholders})""",
+                                       chunk)
+            stored.update(self.currentCursor.fetchall())
+        return stored
+
+    def partitioned_modified(self, pulse_ids) -> dict:
+        """
+        Looks up pulses that are stored, but not in allpulses since they were rolled into partitions. The search index
+        covers every stored pulse, so the partition files are only opened for the pulse IDs it knows.
+        :param pulse_ids: iterable of pulse IDs missing from allpulses
+        :return: dict of pulse ID to the modified timestamp stored in its partition, None if no partition holds it,
+                 for the pulse IDs that are stored
+        """
+        known = {}
+        pulseIds = list(pulse_ids)
+        for start in range(0, len(pulseIds), SQLITE_MAX_VARIABLES):
+            chunk = pulseIds[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            self.currentCursor.execute(f"""SELECT pulse_id FROM pulse_search_doc WHERE pulse_id IN ({placeholders})""",
+                                       chunk)
+            known.update(dict.fromkeys(pulseId for (pulseId,) in self.currentCursor.fetchall()))
+        if not known:
+            return known
+        self.currentCursor.execute("""SELECT name FROM partition_catalog ORDER BY start_ts DESC""")
+        for (name,) in self.currentCursor.fetchall():
+            missing = [pulseId for pulseId, modified in known.items() if modified is None]
+            if not missing:
+                break
+            if not os.path.exists(partition_path(name)):
+                continue
+            # Read on a connection of its own, attaching is not possible inside the ingest transaction
+            connection = connect_reader(partition_path(name))
+            try:
+                for start in range(0, len(missing), SQLITE_MAX_VARIABLES):
+                    chunk = missing[start:start + SQLITE_MAX_VARIABLES]
+                    placeholders = ", ".join("?" * len(chunk))
+                    known.update(connection.execute(f"""SELECT pulse_id, modified FROM allpulses
+                            WHERE pulse_id IN ({placeholders})""", chunk))
+            finally:
+                connection.close()
+        return known
+
+    def existing_pulse_ids(self, table: str, pulse_ids) -> set:
+        """
+        Probes the primary key index of the selected table for the given pulse IDs.
+        :param table: string of the table to probe, has to be either 'allpulses' or 'relevantpulses'
+        :param pulse_ids: iterable of pulse IDs to look up
+        :return: set of the pulse IDs that already exist in the table
+        """
+        return set(self.stored_modified(table, pulse_ids))
+
+    def _delete_pulse_rows(self, table: str, pulse_ids: list) -> None:
+        for start in range(0, len(pulse_ids), SQLITE_MAX_VARIABLES):
+            chunk = pulse_ids[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            self.currentCursor.execute(f"""DELETE FROM {table} WHERE pulse_id IN ({placeholders})""", chunk)
+
+    def filter_new_pulses(self, table: str, pulses: list) -> list:
+        """
+        Diffs a batch of fetched pulses against the selected table. Cost tracks the size of the batch, not the table.
+        :param table: string of the table to diff against, has to be either 'allpulses' or 'relevantpulses'
+        :param pulses: list of OTX pulses
+        :return: list of the pulses not yet in the table, without duplicates, in their original order
+        """
+        existing = self.existing_pulse_ids(table, {pulse.get("id") for pulse in pulses})
+        newPulses = []
+        for pulse in pulses:
+            pulseId = pulse.get("id")
+            if pulseId not in existing:
+                # Also guards against the same pulse showing up twice within the batch
+                existing.add(pulseId)
+                newPulses.append(pulse)
+        return newPulses
+
+    def stream_pulses(self, table: str, pulses, batch_size: int = STREAM_BATCH_SIZE, bar = None,
+                      archive: bool = True, until: str = None, checkpoint = None) -> tuple:
+        """
+        Streams pulses into the selected SQL table. Pulses are normalized one at a time and flushed in fixed-size batches,
+        each batch in its own transaction, so memory stays flat regardless of how many pulses come through. New pulses
+        are inserted, pulses OTX has modified since they were stored are updated, and the table's watermark is advanced
+        in the transaction of the final batch.
+        :param table: string of the table to insert pulses into, has to be either 'allpulses' or 'relevantpulses'
+        :param pulses: iterable of OTX pulses, e.g. OTXHandler.iter_allpulses()
+        :param batch_size: number of pulses per transaction
+        :param bar: optional alive_progress bar to advance per pulse
+        :param archive: also append new and modified pulses to the raw pulse archive
+        :param until: skip pulses modified at or after this iso formatted timestamp
+        :param checkpoint: called as checkpoint(consumed, watermark, final) inside every batch's transaction, with the
+                           number of pulses consumed from pulses so far, skipped ones included. When given, the
+                           checkpoint rather than the stream decides when the table's watermark is recorded.
+        :return: tuple of the number of pulses inserted and updated
+        """
+        if not self._check_table_exists(table):
+            log.warning("Table %s does not exist, returning", table)
+            return 0, 0
+
+        inserted = updated = 0
+        watermark = None
+        consumed = 0
+        batch = []
+        metrics = self.metrics
+        # Batches are written on the writer thread while the next one is digested here
+        writer = self._get_writer()
+        writer.metrics = metrics
+        pending = deque()
+
+        def collect(wait: bool = False) -> None:
+            nonlocal inserted, updated
+            while pending and (wait or pending[0].done()):
+                batchInserted, batchUpdated = pending.popleft().result()
+                inserted += batchInserted
+                updated += batchUpdated
+
+        pulses = iter(pulses)
+        try:
+            while True:
+                # Time spent blocked on the producer, i.e. on OTX when fetching runs ahead on the prefetch thread
+                start = time.perf_counter()
+                pulse = next(pulses, None)
+                digestStart = time.perf_counter()
+                metrics.add_time("fetch_wait", digestStart - start)
+                if pulse is None:
+                    break
+                # Flush lazily so the last batch is always left over for the watermark transaction
+                if len(batch) >= batch_size:
+                    pending.append(writer.submit(
+                        lambda connection, batch = batch, consumed = consumed, watermark = watermark:
+                        self._write_batch(table, batch, archive = archive,
+                                          checkpoint = checkpoint and (lambda: checkpoint(consumed, watermark, False)))))
+                    batch = []
+                    # Surfaces a failed write before more is fetched
+                    collect()
+                    digestStart = time.perf_counter()
+                consumed += 1
+                metrics.count("pulses_received")
+                if until and (pulse.get("modified") or "") >= until:
+                    continue
+                digested = digest_pulse(pulse, self.relevance)
+                modified = digested.row[3]
+                if modified and (watermark is None or modified > watermark):
+                    watermark = modified
+                batch.append(digested)
+                metrics.add_time("digest", time.perf_counter() - digestStart)
+                if bar:
+                    bar()
+            if checkpoint:
+                pending.append(writer.submit(lambda connection: self._write_batch(
+                    table, batch, archive = archive, checkpoint = lambda: checkpoint(consumed, watermark, True))))
+            else:
+                pending.append(writer.submit(lambda connection: self._write_batch(
+                    table, batch, watermark = watermark, final = True, archive = archive)))
+            collect(wait = True)
+        finally:
+            # Whatever happened, the connection is only handed back once the writer is done with it
+            futures.wait(pending)
+        return inserted, updated
+
+    def _get_writer(self) -> SQLiteWriter:
+        if self.writer is None:
+            self.writer = SQLiteWriter(self.currentConnection)
+        return self.writer
+
+    def _write_batch(self, table: str, batch: list, watermark: str = None, final: bool = False,
+                     archive: bool = True, checkpoint = None) -> tuple:
+        """
+        Upserts a batch of digested pulses and their references. Runs on the writer thread, which commits it, possibly
+        together with the batches queued behind it. Pulses already present are only rewritten when the incoming
+        modified timestamp is newer than the stored one. Batches going into allpulses also record their attributes and
+        bring relevantpulses up to date in the same transaction.
+        :param table: string of the table to insert pulses into
+        :param batch: list of DigestedPulse from digest_pulse
+        :param watermark: newest modified timestamp of the whole stream, recorded when final is set
+        :param final: whether this is the last batch of the stream
+        :param archive: also append the raw pulses written to the raw pulse archive
+        :param checkpoint: optional callable run at the end of the transaction, to record progress with the batch
+        :return: tuple of the number of pulses inserted and updated
+        """
+        metrics = self.metrics
+        with metrics.stage("diff"):
+            batchIds = {digested.row[0] for digested in batch}
+            stored = self.stored_modified(table, batchIds)
+            if table == "allpulses":
+                # Partitioned pulses are updates too, their attribute and relevantpulses rows are in the pulse database
+                stored.update(self.partitioned_modified(batchIds - stored.keys()))
+        prepareStart = time.perf_counter()
+        seen = set()
+        rows = []
+        updatedIds = []
+        references = []
+        documents = []
+        archived = []
+        indicators = []
+        indicatorSets = {}
+        relevant = set()
+        attributes = {attribute: [] for attribute in PULSE_ATTRIBUTES}
+        for digested in batch:
+            pulseId = digested.row[0]
+            modified = digested.row[3]
+            if pulseId in seen:
+                continue
+            seen.add(pulseId)
+            if pulseId in stored:
+                if not modified or (stored[pulseId] and modified <= stored[pulseId]):
+                    continue
+                updatedIds.append(pulseId)
+            rows.append(digested.row)
+            references.extend((pulseId, ref) for ref in digested.references)
+            documents.append((pulseId, digested.row[1], digested.row[4], " ".join(digested.references)))
+            if archive and self.archive:
+                archived.append((pulseId, modified or "", compress_pulse(digested.pulse)))
+            for attribute, values in digested.attributes.items():
+                attributes[attribute].extend((value, pulseId) for value in values)
+            if RELEVANT_PROFILE in digested.attributes.get("profile", ()):
+                relevant.add(pulseId)
+            indicators.extend((indicatorType, indicator, pulseId) for indicatorType, indicator in digested.indicators)
+            indicatorSets[pulseId] = [indicator for _, indicator in digested.indicators]
+        metrics.add_time("prepare", time.perf_counter() - prepareStart)
+
+        sqlStart = time.perf_counter()
+        minhashSeconds = 0.0
+        self.currentCursor.executemany(f"""INSERT INTO {table} (pulse_id, name, created, modified, description, 
+                author, created_ts, modified_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (pulse_id) DO UPDATE SET 
+                name = excluded.name, created = excluded.created, modified = excluded.modified, 
+                description = excluded.description, author = excluded.author, created_ts = excluded.created_ts, 
+                modified_ts = excluded.modified_ts 
+                WHERE {table}.modified IS NULL OR excluded.modified > {table}.modified""", rows)
+        changes = [(table, row[0], "update" if row[0] in stored else "insert", stored.get(row[0]), row[3])
+                   for row in rows]
+        if table == "allpulses":
+            # Membership of relevantpulses before the batch, to tell its inserts, updates and removals apart
+            relevantBefore = self.stored_modified("relevantpulses", [row[0] for row in rows])
+            for pulseId, _, _, modified, *_ in rows:
+                if pulseId in relevant:
+                    changes.append(("relevantpulses", pulseId, "update" if pulseId in relevantBefore else "insert",
+                                    relevantBefore.get(pulseId), modified))
+                elif pulseId in relevantBefore:
+                    changes.append(("relevantpulses", pulseId, "delete", relevantBefore[pulseId], None))
+            # Modified pulses get their derived rows rebuilt from the new version
+            for derivedTable in ("reference", "relevantpulses", "pulse_indicator",
+                                 *(t for t, _ in PULSE_ATTRIBUTES.values())):
+                self._delete_pulse_rows(derivedTable, updatedIds)
+            self.currentCursor.executemany("""INSERT OR IGNORE INTO reference (pulse_id, reference) 
+                                           VALUES (?, ?)""", references)
+            for attribute, (junctionTable, column) in PULSE_ATTRIBUTES.items():
+                self.currentCursor.executemany(f"""INSERT OR IGNORE INTO {junctionTable} ({column}, pulse_id) 
+                                               VALUES (?, ?)""", attributes[attribute])
+            self._insert_indicators(indicators)
+            minhashStart = time.perf_counter()
+            metrics.count("pulses_minhashed", store_signatures(self.currentCursor, indicatorSets))
+            minhashSeconds = time.perf_counter() - minhashStart
+            metrics.add_time("minhash", minhashSeconds)
+            self._index_search(documents)
+            self.currentCursor.executemany("""INSERT OR IGNORE INTO archive.pulse_archive (pulse_id, modified, 
+                                           data) VALUES (?, ?, ?)""", archived)
+            self._derive_relevantpulses([row[0] for row in rows])
+        self.log_changes(changes)
+        if final:
+            self._set_sync_state(table, watermark)
+        if checkpoint:
+            checkpoint()
+        # The commit is timed by the writer, the MinHash index has a stage of its own
+        metrics.add_time("sql", time.perf_counter() - sqlStart - minhashSeconds)
+        metrics.count("batches")
+        metrics.count("pulses_inserted", len(rows) - len(updatedIds))
+        metrics.count("pulses_updated", len(updatedIds))
+        metrics.count("pulses_unchanged", len(batch) - len(rows))
+        metrics.count("references_written", len(references))
+        metrics.count("indicator_links_written", len(indicators))
+        return len(rows) - len(updatedIds), len(updatedIds)
+
+    def _derive_relevantpulses(self, pulse_ids: list = None) -> int:
+        """
+        Materializes relevantpulses from allpulses through the pulse_profile index, no pulses are fetched. Deriving
+        every pulse records the pulses it adds in the changelog, _write_batch records the changes of the pulses it
+        passes.
+        :param pulse_ids: Only consider these pulses, which were just written to allpulses. Defaults to every stored
+                          pulse, partitions included, which needs attach_partitions on the handler's connection.
+        :return: number of pulses added to relevantpulses
+        """
+        cursor = self.currentCursor
+        before = self.currentConnection.total_changes
+        if pulse_ids is None:
+            cursor.execute("""SELECT a.pulse_id, a.modified FROM pulse_profile r JOIN allpulses_all a 
+                           ON a.pulse_id = r.pulse_id WHERE r.profile = ? 
+                           AND a.pulse_id NOT IN (SELECT pulse_id FROM relevantpulses)""", (RELEVANT_PROFILE,))
+            self.log_changes([("relevantpulses", pulseId, "insert", None, modified)
+                               for pulseId, modified in cursor.fetchall()])
+            cursor.execute("""INSERT OR IGNORE INTO relevantpulses SELECT a.* FROM pulse_profile r 
+                           JOIN allpulses_all a ON a.pulse_id = r.pulse_id WHERE r.profile = ?""", (RELEVANT_PROFILE,))
+        else:
+            for start in range(0, len(pulse_ids), SQLITE_MAX_VARIABLES):
+                chunk = pulse_ids[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(f"""INSERT OR IGNORE INTO relevantpulses SELECT a.* FROM pulse_profile r 
+                               JOIN allpulses a ON a.pulse_id = r.pulse_id 
+                               WHERE r.profile = ? AND r.pulse_id IN ({placeholders})""", [RELEVANT_PROFILE, *chunk])
+        return self.currentConnection.total_changes - before
+
+    def _iter_stored_pulses(self) -> types.GeneratorType:
+        """
+        Yields every stored pulse in chunks, partitions included, each rebuilt from its pulse row and its attribute tables
+        as a dict of the OTX keys relevance rules read. Needs attach_partitions on the handler's connection.
+        :return: Generator of lists of pulse dicts
+        """
+        cursor = self.currentCursor
+        # Attribute -> OTX pulse key
+        keys = {"industry": "industries", "tag": "tags", "country": "targeted_countries", "adversary": "adversary"}
+        # One pass in storage order on a cursor of its own, the view has no index to seek a sorted position in
+        pulses = self.currentConnection.execute("""SELECT pulse_id, name FROM allpulses_all""")
+        while True:
+            chunk = {pulseId: {"id": pulseId, "name": name, **{key: [] for key in keys.values()}}
+                     for pulseId, name in pulses.fetchmany(SQLITE_MAX_VARIABLES)}
+            if not chunk:
+                return
+            placeholders = ", ".join("?" * len(chunk))
+            for attribute, key in keys.items():
+                junctionTable, column = PULSE_ATTRIBUTES[attribute]
+                cursor.execute(f"""SELECT pulse_id, {column} FROM {junctionTable} WHERE pulse_id IN ({placeholders})""",
+                               list(chunk))
+                for pulseId, value in cursor.fetchall():
+                    chunk[pulseId][key].append(value)
+            yield list(chunk.values())
+
+    def refresh_profiles(self) -> dict:
+        """
+        Brings pulse_profile in line with the current relevance rules. New profiles and profiles whose rules changed are
+        matched against every stored pulse, from the DB alone, and the rows of removed profiles are dropped. Adding a
+        sector costs no API calls. relevantpulses follows its profile. Only the sync and the rebuild call this, with the
+        rules they were given, so handlers opened to read never rewrite what a sync stored.
+        Pulses stored before their attributes were, without a row in any attribute table, cannot be matched again and
+        keep the profiles they have until OTX modifies them.
+        :return: dict of profile name to number of members, for every profile that was matched again
+        """
+        cursor = self.currentCursor
+        cursor.execute("""SELECT profile, fingerprint FROM relevance_profile""")
+        stored = dict(cursor.fetchall())
+        fingerprints = self.relevance.fingerprints
+        changed = [name for name, fingerprint in fingerprints.items() if stored.get(name) != fingerprint]
+        removed = [name for name in stored if name not in fingerprints]
+        if not changed and not removed:
+            return {}
+
+        log.info("Matching stored pulses against changed relevance profiles: %s", ", ".join(changed) or "none")
+        matcher = RelevanceMatcher({name: self.relevance.profiles[name] for name in changed})
+        attach_partitions(self.currentConnection)
+        # One index probe per attribute table and profile row, on the pulse_id index of the table
+        attributed = " OR ".join(f"EXISTS (SELECT 1 FROM {junctionTable} a WHERE a.pulse_id = pulse_profile.pulse_id)"
+                                 for attribute, (junctionTable, _) in PULSE_ATTRIBUTES.items() if attribute != "profile")
+        with self.currentConnection:
+            cursor.executemany("""DELETE FROM pulse_profile WHERE profile = ?""", [(name,) for name in removed])
+            cursor.executemany(f"""DELETE FROM pulse_profile WHERE profile = ? AND ({attributed})""",
+                               [(name,) for name in changed])
+            for pulses in self._iter_stored_pulses():
+                cursor.executemany("""INSERT OR IGNORE INTO pulse_profile (profile, pulse_id) VALUES (?, ?)""",
+                                   [(name, pulse["id"]) for pulse in pulses for name in matcher.match(pulse)])
+            members = {name: cursor.execute("""SELECT COUNT(*) FROM pulse_profile WHERE profile = ?""",
+                                            (name,)).fetchone()[0] for name in changed}
+            cursor.executemany("""DELETE FROM relevance_profile WHERE profile = ?""", [(name,) for name in removed])
+            cursor.executemany("""INSERT OR REPLACE INTO relevance_profile (profile, fingerprint, evaluated) 
+                    VALUES (?, ?, ?)""", [(name, fingerprints[name], datetime.today().isoformat()) for name in changed])
+            if RELEVANT_PROFILE in changed or RELEVANT_PROFILE in removed:
+                cursor.execute("""SELECT pulse_id, modified FROM relevantpulses WHERE pulse_id NOT IN 
+                        (SELECT pulse_id FROM pulse_profile WHERE profile = ?)""", (RELEVANT_PROFILE,))
+                self.log_changes([("relevantpulses", pulseId, "delete", modified, None)
+                                   for pulseId, modified in cursor.fetchall()])
+                cursor.execute("""DELETE FROM relevantpulses WHERE pulse_id NOT IN 
+                        (SELECT pulse_id FROM pulse_profile WHERE profile = ?)""", (RELEVANT_PROFILE,))
+                self._derive_relevantpulses()
+        log.info("Relevance profile members: %s", members)
+        return members
+
+    def derive_relevantpulses(self) -> int:
+        """
+        Brings relevantpulses up to date with every relevant pulse already stored in allpulses.
+        :return: number of pulses added to relevantpulses
+        """
+        attach_partitions(self.currentConnection)
+        with self.currentConnection:
+            added = self._derive_relevantpulses()
+            self._set_sync_state("relevantpulses")
+        return added
+
     def insert_pulses(self, table: str) -> None:
         """
         Inserts pulses into the selected SQL table.
@@ -355,15 +1748,15 @@ class SQLiteDBHandler:
         if len(self.pulseList) <= 0:
             return
         if not self._check_table_exists(table):
-            print("Table does not exist, returning")
+            log.warning("Table %s does not exist, returning", table)
             return
 
         try:
-            self.currentCursor.executemany(f"""INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?)""", self.pulseList)
+            self.currentCursor.executemany(f"""INSERT INTO {table} (pulse_id, name, created, modified, description, 
+                    author, created_ts, modified_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", self.pulseList)
             self.currentConnection.commit()
         except sqlite3.IntegrityError:
-            print("WARNING: Data in Pulse List violates Integrity. Manually running SQL Statements on each piece of "
-                  "data.")
+            log.warning("Data in Pulse List violates Integrity. Manually running SQL Statements on each piece of data.")
             integrity_pulses_insert(self.currentCursor, table, self.pulseList)
             self.currentConnection.commit()
 
@@ -372,7 +1765,7 @@ class SQLiteDBHandler:
             return
 
         if not self._check_table_exists("reference"):
-            print("Reference Table does not exist, returning")
+            log.warning("Reference Table does not exist, returning")
             return
 
         integrity_references_insert(self.currentCursor, self.references)
@@ -385,15 +1778,355 @@ class SQLiteDBHandler:
             self.insert_pulses("allpulses")
         self.insert_references()
 
+    def iter_archived_pulses(self, workers: int = os.cpu_count() or 4) -> types.GeneratorType:
+        """
+        Yields the newest archived version of every pulse. The archive is read on its own connection in chunks, and up
+        to twice as many chunks as there are workers are decompressed in parallel, in order.
+        :param workers: number of decompression threads
+        :return: Generator of OTX pulse dicts
+        """
+        archiveConnection = sqlite3.connect(archive_path())
+        # MAX() makes SQLite return the data of the newest version of each pulse
+        rows = archiveConnection.execute("""SELECT data, MAX(modified) FROM pulse_archive GROUP BY pulse_id""")
+        try:
+            with ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "otx-rebuild") as executor:
+                pending = deque()
+                while True:
+                    chunk = [row[0] for row in rows.fetchmany(REBUILD_CHUNK_SIZE)]
+                    if chunk:
+                        pending.append(executor.submit(decompress_pulses, chunk))
+                    if pending and (not chunk or len(pending) >= workers * 2):
+                        yield from pending.popleft().result()
+                    elif not chunk:
+                        return
+        finally:
+            archiveConnection.close()
+
+    def rebuild_from_archive(self, workers: int = os.cpu_count() or 4, bar = None) -> int:
+        """
+        Regenerates every derived table (pulses, references, attributes, indicators, search and MinHash indexes, sync
+        state) from the raw pulse archive, without touching the network. Use after a schema change instead of
+        re-downloading OTX.
+        :param workers: number of decompression threads
+        :param bar: optional alive_progress bar to advance per pulse
+        :return: number of pulses rebuilt
+        """
+        # Backfill progress describes what was fetched from OTX, which the archive holds as well, so it survives
+        self.currentCursor.execute("""SELECT * FROM backfill_window""")
+        backfill = self.currentCursor.fetchall()
+        for table in ["allpulses", "relevantpulses", "reference", "pulse_indicator", "indicator", "indicator_type",
+                      "pulse_fts", "pulse_search_doc", "pulse_minhash", "sync_state", *dict(PULSE_ATTRIBUTES.values())]:
+            self.reset_table(table)
+        # Records the fingerprints of the current rules, the pulses are matched against them as they stream in
+        self.refresh_profiles()
+        with self.currentConnection:
+            self.currentCursor.executemany("""INSERT INTO backfill_window VALUES (?, ?, ?, ?, ?, ?, ?)""", backfill)
+        inserted, _ = self.stream_pulses("allpulses", self.iter_archived_pulses(workers), bar = bar, archive = False)
+        return inserted
+
+    def read_pool(self) -> ReadPool:
+        """
+        :return: the pool of read-only connections used by the query methods, safe to share between threads. Readers
+                 see the last committed state and never wait for a running sync.
+        """
+        if self.readPool is None:
+            # Every borrowed connection sees the partitions of the moment behind the *_all views
+            self.readPool = ReadPool(database_path(), prepare = attach_partitions)
+        return self.readPool
+
+    def _read(self, query: str, params = ()) -> list:
+        with self.read_pool().connection() as connection:
+            return connection.execute(query, params).fetchall()
+
+    def close(self) -> None:
+        """
+        Commits pending writes and closes every connection of the handler.
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.readPool is not None:
+            self.readPool.close()
+            self.readPool = None
+        self.currentConnection.close()
+
+    def find_pulses(self, table: str = "allpulses", since: str = None, until: str = None, limit: int = 100,
+                    after: tuple = None, **filters) -> list:
+        """
+        Finds pulses by their attributes, e.g. find_pulses(industry="Aerospace", tag="ransomware", since="2023-01-01").
+        Every filter is answered from the value-first index of its junction table and the filters are intersected.
+        The time range comes from the modified_ts index. allpulses includes the pulses rolled into partitions.
+        :param table: Table to search, either "allpulses" or "relevantpulses"
+        :param since: iso formatted timestamp, only return pulses modified at or after it
+        :param until: iso formatted timestamp, only return pulses modified before it
+        :param limit: Maximum number of pulses to return, newest modified first
+        :param after: (modified_ts, pulse_id) of the last pulse of the previous page, to continue after it
+        :param filters: attribute=value pairs, attribute being one of the keys of PULSE_ATTRIBUTES
+        :return: list of (pulse_id, name, created, modified, author, modified_ts) tuples
+        """
+        conditions = []
+        params = []
+        for attribute, value in filters.items():
+            if attribute not in PULSE_ATTRIBUTES:
+                raise ValueError(f"Cannot filter pulses on {attribute}, choose from {', '.join(PULSE_ATTRIBUTES)}")
+            junctionTable, column = PULSE_ATTRIBUTES[attribute]
+            conditions.append(f"p.pulse_id IN (SELECT pulse_id FROM {junctionTable} WHERE {column} = ?)")
+            params.append(value)
+        for bound, operator in ((since, ">="), (until, "<")):
+            if bound:
+                seconds = epoch_seconds(bound)
+                if seconds is None:
+                    raise ValueError(f"{bound} is not an iso formatted timestamp")
+                conditions.append(f"p.modified_ts {operator} ?")
+                params.append(seconds)
+        if after:
+            # Keyset pagination instead of skipping the pages before. Pulses whose modified could not be parsed have no
+            # modified_ts, the key and the ORDER BY both sort them as -1 so they page after every dated pulse.
+            conditions.append("(COALESCE(p.modified_ts, -1), p.pulse_id) < (COALESCE(?, -1), ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        return self._read(f"""SELECT p.pulse_id, p.name, p.created, p.modified, p.author, p.modified_ts 
+                FROM {PARTITIONED.get(table, table)} p {where} 
+                ORDER BY COALESCE(p.modified_ts, -1) DESC, p.pulse_id DESC LIMIT ?""", 
+                [*params, limit])
+
+    def get_pulse(self, pulse_id: str, table: str = "allpulses") -> tuple:
+        """
+        :param pulse_id: ID of the pulse
+        :param table: Table to look in, either "allpulses" (partitions included) or "relevantpulses"
+        :return: (pulse_id, name, created, modified, description, author) tuple, None if the pulse is not stored
+        """
+        rows = self._read(f"""SELECT pulse_id, name, created, modified, description, author 
+                FROM {PARTITIONED.get(table, table)} WHERE pulse_id = ?""", (pulse_id,))
+        return rows[0] if rows else None
+
+    def find_references(self, pulse_id: str = None, limit: int = 100, after: tuple = None) -> list:
+        """
+        Lists stored references, partitions included, in (pulse_id, reference) order, off the unique reference index of
+        each database.
+        :param pulse_id: only list the references of this pulse
+        :param limit: Maximum number of references to return, negative for all of them
+        :param after: (pulse_id, reference) of the last reference of the previous page, to continue after it
+        :return: list of (pulse_id, reference) tuples
+        """
+        conditions = []
+        params = []
+        if pulse_id:
+            conditions.append("pulse_id = ?")
+            params.append(pulse_id)
+        if after:
+            conditions.append("(pulse_id, reference) > (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._read(f"""SELECT pulse_id, reference FROM reference_all {where} ORDER BY pulse_id, reference 
+                LIMIT ?""", [*params, limit])
+
+    def get_pulse_attributes(self, pulse_id: str) -> dict:
+        """
+        Returns every stored attribute of a pulse.
+        :param pulse_id: ID of the pulse
+        :return: dict of attribute to list of values, see PULSE_ATTRIBUTES
+        """
+        attributes = {}
+        with self.read_pool().connection() as connection:
+            for attribute, (junctionTable, column) in PULSE_ATTRIBUTES.items():
+                rows = connection.execute(f"""SELECT {column} FROM {junctionTable} WHERE pulse_id = ?""", (pulse_id,))
+                attributes[attribute] = [row[0] for row in rows]
+        return attributes
+
+    def search(self, query: str, table: str = "allpulses", limit: int = 20, raw: bool = False,
+               after: tuple = None) -> list:
+        """
+        Ranked full-text search over pulse names, descriptions and references. Matches in the name weigh the most.
+        :param query: keywords, e.g. 'ADS-B ACARS'. Every keyword has to match, each is matched as a phrase so terms
+                      like ADS-B need no quoting
+        :param table: Table to search, either "allpulses" or "relevantpulses"
+        :param limit: Maximum number of results
+        :param raw: pass query through as FTS5 query syntax (OR, NEAR, prefix*, column filters, ...)
+        :param after: (rank, pulse_id) of the last result of the previous page, to continue after it
+        :return: list of (pulse_id, name, snippet, rank) tuples, best match (lowest rank) first
+        """
+        if not raw:
+            query = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+        join = f"JOIN {table} p ON p.pulse_id = d.pulse_id" if table != "allpulses" else ""
+        params = [query]
+        where = ""
+        if after:
+            where = "WHERE (rank, pulse_id) > (?, ?)"
+            params.extend(after)
+        return self._read(f"""SELECT * FROM (SELECT d.pulse_id AS pulse_id, f.name, 
+                snippet(pulse_fts, -1, '[', ']', '...', 16), bm25(pulse_fts, 10.0, 1.0, 0.5) AS rank 
+                FROM pulse_fts f JOIN pulse_search_doc d ON d.docid = f.rowid {join} WHERE pulse_fts MATCH ?) 
+                {where} ORDER BY rank, pulse_id LIMIT ?""", [*params, limit])
+
+    def find_indicator(self, indicator: str, indicator_type: str = None) -> list:
+        """
+        Looks up which pulses an indicator appears in, partitions included.
+        :param indicator: indicator value, e.g. an IP address, domain or file hash
+        :param indicator_type: optionally restrict to one OTX indicator type, e.g. "IPv4"
+        :return: list of (type, pulse_id) tuples
+        """
+        query = """SELECT t.name, l.pulse_id FROM indicator i JOIN indicator_type t ON t.type_id = i.type_id 
+                JOIN pulse_indicator_all l ON l.indicator_id = i.indicator_id WHERE i.indicator = ?"""
+        params = [indicator]
+        if indicator_type:
+            query += " AND t.name = ?"
+            params.append(indicator_type)
+        return self._read(query, params)
+
+    def get_pulse_indicators(self, pulse_id: str) -> list:
+        """
+        :param pulse_id: ID of the pulse
+        :return: list of (type, indicator) tuples of every indicator stored for the pulse
+        """
+        return self._read("""SELECT t.name, i.indicator FROM pulse_indicator_all l 
+                JOIN indicator i ON i.indicator_id = l.indicator_id JOIN indicator_type t ON t.type_id = i.type_id 
+                WHERE l.pulse_id = ?""", (pulse_id,))
+
+    def related_pulses(self, pulse_id: str, table: str = "allpulses", limit: int = 20,
+                       min_similarity: float = 0.0) -> list:
+        """
+        Finds the pulses whose indicator sets are most like a pulse's. Candidates come from the LSH buckets of the
+        pulse's MinHash signature, a few index lookups whatever the number of pulses, and are ranked by the similarity
+        their signatures estimate. Pulses sharing less than about half of their indicators are mostly not found.
+        :param pulse_id: ID of the pulse
+        :param table: only return pulses of this table, either "allpulses" or "relevantpulses"
+        :param limit: Maximum number of pulses to return
+        :param min_similarity: only return pulses with at least this estimated Jaccard similarity
+        :return: list of (pulse_id, name, similarity) tuples, most similar first, empty if the pulse has no indicators
+        """
+        with self.read_pool().connection() as connection:
+            row = connection.execute("""SELECT pulse_key, signature FROM pulse_minhash WHERE pulse_id = ?""",
+                                     (pulse_id,)).fetchone()
+            if row is None:
+                return []
+            pulseKey, signature = row
+            candidates = self._lsh_candidates(connection, lsh_buckets([signature])[0], table)
+            candidates = [(key, candidateId, candidateSignature)
+                          for key, candidateId, candidateSignature in candidates if key != pulseKey]
+            ranked = sorted(((-similarity, candidateId) for (_, candidateId, _), similarity
+                             in zip(candidates, similarities(signature, [c[2] for c in candidates]))
+                             if similarity >= min_similarity))[:limit]
+            names = self._pulse_names(connection, [candidateId for _, candidateId in ranked])
+        return [(candidateId, names.get(candidateId), -negated) for negated, candidateId in ranked]
+
+    def near_duplicates(self, threshold: float = NEAR_DUPLICATE_SIMILARITY, table: str = "allpulses",
+                        since: str = None) -> list:
+        """
+        Clusters pulses whose indicator sets are near-copies of each other, e.g. the same campaign re-posted by several
+        authors. Only pulses sharing an LSH bucket are compared: within a bucket each pulse not yet placed leads a
+        group of the others at or above the threshold, and groups that share a pulse are merged.
+        :param threshold: estimated Jaccard similarity at or above which two pulses are near-duplicates
+        :param table: only cluster pulses of this table, either "allpulses" or "relevantpulses"
+        :param since: iso formatted timestamp, only the clusters of pulses modified at or after it. Looks up the
+                      buckets of those pulses alone, so clustering what the last sync brought in stays cheap.
+        :return: list of clusters, largest first, each a list of (pulse_id, name) tuples
+        """
+        with self.read_pool().connection() as connection:
+            if since:
+                seconds = epoch_seconds(since)
+                if seconds is None:
+                    raise ValueError(f"{since} is not an iso formatted timestamp")
+                seeds = connection.execute(f"""SELECT m.signature FROM {PARTITIONED.get(table, table)} p 
+                        JOIN pulse_minhash m ON m.pulse_id = p.pulse_id WHERE p.modified_ts >= ?""",
+                                           (seconds,)).fetchall()
+                bucketKeys = list({(band, bucket) for buckets in lsh_buckets([signature for (signature,) in seeds])
+                                   for band, bucket in enumerate(buckets)})
+                members = {}
+                for start in range(0, len(bucketKeys), SQLITE_MAX_VARIABLES // 2):
+                    chunk = bucketKeys[start:start + SQLITE_MAX_VARIABLES // 2]
+                    values = ", ".join("(?, ?)" for _ in chunk)
+                    for band, bucket, pulseKey in connection.execute(f"""SELECT l.band, l.bucket, l.pulse_key 
+                            FROM (VALUES {values}) v CROSS JOIN pulse_lsh l ON l.band = v.column1 
+                            AND l.bucket = v.column2""", [value for key in chunk for value in key]):
+                        members.setdefault((band, bucket), []).append(pulseKey)
+                groups = [keys for keys in members.values() if len(keys) > 1]
+            else:
+                groups = [[int(key) for key in keys.split(",")] for (keys,) in connection.execute(
+                    """SELECT group_concat(pulse_key) FROM pulse_lsh GROUP BY band, bucket HAVING COUNT(*) > 1""")]
+            if table != "allpulses":
+                allowed = {pulseKey for (pulseKey,) in connection.execute(f"""SELECT m.pulse_key FROM {table} p 
+                        JOIN pulse_minhash m ON m.pulse_id = p.pulse_id""")}
+                groups = [[key for key in keys if key in allowed] for keys in groups]
+                groups = [keys for keys in groups if len(keys) > 1]
+
+            signatures = {}
+            pending = list({key for keys in groups for key in keys})
+            for start in range(0, len(pending), SQLITE_MAX_VARIABLES):
+                chunk = pending[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ", ".join("?" * len(chunk))
+                signatures.update((pulseKey, (pulseId, signature))
+                                  for pulseKey, pulseId, signature in connection.execute(f"""SELECT pulse_key, pulse_id, 
+                                  signature FROM pulse_minhash WHERE pulse_key IN ({placeholders})""", chunk))
+
+            # Union-find over pulse keys
+            parents = {}
+
+            def root(key: int) -> int:
+                parents.setdefault(key, key)
+                while parents[key] != key:
+                    parents[key] = parents[parents[key]]
+                    key = parents[key]
+                return key
+
+            for keys in groups:
+                while len(keys) > 1:
+                    leader, *rest = keys
+                    scores = similarities(signatures[leader][1], [signatures[key][1] for key in rest])
+                    keys = []
+                    for key, similarity in zip(rest, scores):
+                        if similarity >= threshold:
+                            parents[root(key)] = root(leader)
+                        else:
+                            keys.append(key)
+
+            clusters = {}
+            for key in parents:
+                clusters.setdefault(root(key), []).append(signatures[key][0])
+            names = self._pulse_names(connection, [pulseId for cluster in clusters.values() for pulseId in cluster])
+        return sorted(([(pulseId, names.get(pulseId)) for pulseId in sorted(cluster)] for cluster in clusters.values()),
+                      key = lambda cluster: (-len(cluster), cluster[0][0]))
+
+    @staticmethod
+    def _lsh_candidates(connection: sqlite3.Connection, buckets: list, table: str = "allpulses") -> list:
+        """
+        :param connection: connection to read with
+        :param buckets: LSH_BANDS bucket keys of a signature, band order
+        :param table: only return pulses of this table, either "allpulses" or "relevantpulses"
+        :return: list of (pulse_key, pulse_id, signature) of every pulse filed under any of the buckets
+        """
+        values = ", ".join("(?, ?)" for _ in range(LSH_BANDS))
+        join = f"JOIN {table} p ON p.pulse_id = m.pulse_id" if table != "allpulses" else ""
+        # CROSS JOIN keeps the bucket list as the outer loop, a primary key lookup into pulse_lsh per bucket
+        return connection.execute(f"""SELECT m.pulse_key, m.pulse_id, m.signature FROM pulse_minhash m {join} 
+                WHERE m.pulse_key IN (SELECT l.pulse_key FROM (VALUES {values}) v CROSS JOIN pulse_lsh l 
+                ON l.band = v.column1 AND l.bucket = v.column2)""",
+                                  [value for band, bucket in enumerate(buckets) for value in (band, bucket)]).fetchall()
+
+    @staticmethod
+    def _pulse_names(connection: sqlite3.Connection, pulse_ids: list) -> dict:
+        """
+        :return: dict of pulse ID to name, read from the search index, which also covers the pulses in partitions
+        """
+        names = {}
+        for start in range(0, len(pulse_ids), SQLITE_MAX_VARIABLES):
+            chunk = pulse_ids[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            names.update(connection.execute(f"""SELECT d.pulse_id, f.name FROM pulse_search_doc d 
+                    JOIN pulse_fts f ON f.rowid = d.docid WHERE d.pulse_id IN ({placeholders})""", chunk))
+        return names
+
     def purge_table(self, table: str) -> None:
         """
         Purges a table in the database specified by the string, either "allpulses", "relevantpulses", or "reference".
+        The table is dropped outright, its pages go to the freelist for vacuum() to return.
         :param table: String of the table to delete
         :return: None
         """
+        self._schemaTables = None
         try:
-            self.currentCursor.execute(f"""DELETE FROM {table}""")
-            self.currentConnection.commit()
             self.currentCursor.execute(f"""DROP TABLE {table}""")
             self.currentConnection.commit()
         except sqlite3.OperationalError:
@@ -408,6 +2141,25 @@ class SQLiteDBHandler:
         self.purge_table("allpulses")
         self.purge_table("relevantpulses")
         self.purge_table("reference")
+        for junctionTable, _ in PULSE_ATTRIBUTES.values():
+            self.purge_table(junctionTable)
+        self.purge_table("pulse_indicator")
+        self.purge_table("indicator")
+        self.purge_table("indicator_type")
+        self.indicatorTypes.clear()
+        self.purge_table("pulse_fts")
+        self.purge_table("pulse_search_doc")
+        self.purge_table("pulse_lsh")
+        self.purge_table("pulse_minhash")
+        self.purge_table("sync_state")
+        self.purge_table("backfill_window")
+        self.purge_table("relevance_profile")
+        self.purge_table("export_state")
+        self.purge_table("sync_run")
+        self.purge_table("changelog")
+        self.remove_partitions()
+        self.purge_table("partition_catalog")
+        self.vacuum()
 
     def reset_table(self, table: str) -> None:
         """
@@ -417,207 +2169,282 @@ class SQLiteDBHandler:
         if table in ["allpulses", "relevantpulses"]:
             self.purge_table(table)
             self._init_pulse_table(table)
+            # A reset table starts over from the full history
+            with self.currentConnection:
+                self.currentCursor.execute("""DELETE FROM sync_state WHERE table_name = ?""", (table,))
+                if table == "allpulses":
+                    self.currentCursor.execute("""DELETE FROM backfill_window""")
+            if table == "allpulses":
+                # The partitions hold older rows of the same table
+                self.remove_partitions()
         elif table == "reference":
             self.purge_table(table)
             self._init_reference_table()
-
-
-class AllPulsesMetadata:
-    lastUpdated: datetime
-
-
-class RelevantPulsesMetadata:
-    lastUpdated: datetime
+        elif table in dict(PULSE_ATTRIBUTES.values()):
+            self.purge_table(table)
+            self._init_junction_table(table, dict(PULSE_ATTRIBUTES.values())[table])
+            if table == "pulse_profile":
+                # Every profile has to be matched again
+                with self.currentConnection:
+                    self.currentCursor.execute("""DELETE FROM relevance_profile""")
+        elif table in ["indicator", "indicator_type", "pulse_indicator"]:
+            self.purge_table(table)
+            if table == "indicator_type":
+                self.indicatorTypes.clear()
+            self._init_indicator_tables()
+        elif table in ["pulse_fts", "pulse_search_doc"]:
+            self.purge_table(table)
+            self._init_search_tables()
+        elif table in ["pulse_minhash", "pulse_lsh"]:
+            # Either table is meaningless without the other
+            self.purge_table("pulse_lsh")
+            self.purge_table("pulse_minhash")
+            self._init_similarity_tables()
+            with self.currentConnection:
+                index_stored_signatures(self.currentCursor)
+        elif table == "sync_state":
+            self.purge_table(table)
+            self._init_sync_state_table()
+        elif table == "backfill_window":
+            self.purge_table(table)
+            self._init_backfill_table()
+        elif table == "relevance_profile":
+            self.purge_table(table)
+            self._init_profile_table()
+        elif table == "export_state":
+            self.purge_table(table)
+            self._init_export_state_table()
+        elif table in ["sync_run", "changelog"]:
+            self.purge_table(table)
+            self._init_changelog_tables()
+        elif table == "partition_catalog":
+            self.remove_partitions()
+            self.purge_table(table)
+            self._init_partition_table()
 
 
 class ApplicationDirector:
-    def __init__(self, otx_key: str):
-        self.otxHandler = OTXHandler(otx_key)
-        self.dbHandler = SQLiteDBHandler()
+    def __init__(self, otx_key: str, server: str = OTX_SERVER, max_workers: int = 8, progress: bool = True,
+                 profiles: str = None, page_cache: PageCache = None):
+        self.progress = progress
+        # Relevance rules, compiled once and shared by both handlers
+        relevance = load_relevance(profiles)
+        self.otxHandler = OTXHandler(otx_key, server = server, max_workers = max_workers, progress = progress,
+                                     relevance = relevance, page_cache = page_cache)
+        self.dbHandler = SQLiteDBHandler(relevance = relevance)
         self.currentCursor = self.dbHandler.currentCursor
-        self.apMeta = self.dbHandler.allPulsesMeta
-        self.rpMeta = self.dbHandler.relevantPulsesMeta
-        self.apMetaFile = self.dbHandler.allPulsesMetaFile
-        self.rpMetaFile = self.dbHandler.relPulsesMetaFile
+        # RunMetrics of the last update_alltables run
+        self.lastRun = None
 
     def reset_allpulses(self, days: int = None):
-        print("Initializing All Pulses")
-        print("Purging All Pulse table if exists")
-        self.dbHandler.purge_table("allpulses")
-        print("Purge Complete")
-        print("Obtaining Pulses")
-        self.otxHandler.updatelist_allpulses(last_numdays = days)
-        print("Pulses Obtained, Digesting Pulses")
-        self.dbHandler.digest_pulses(self.otxHandler)
-        print("Digest Complete")
-        print("Incerting Pulses")
-        self.dbHandler.insert_everything()
-        print("Incerting Complete")
-        print("Dumping current time into All Pulses Metadata file")
-        self.apMeta.lastUpdated = datetime.today()
-        with open(self.apMetaFile, 'wb') as f:
-            pickle.dump(self.apMeta, file = f)
-            print("Metadata dumping complete")
-
-    def reset_relevantpulses(self, days: int = None):
-        self.dbHandler.purge_table("relevantpulses")
-        self.otxHandler.updatelist_relevantpulses(last_numdays = days)
-        self.dbHandler.digest_pulses(self.otxHandler)
-        self.dbHandler.insert_everything()
-        print("Dumping current time into Relevant Pulses Metadata file")
-        self.rpMeta.lastUpdated = datetime.today()
-        with open(self.rpMetaFile, 'wb') as f:
-            pickle.dump(self.rpMeta, file = f)
-            print("Metadata dumping complete")
+        log.info("Initializing All Pulses")
+        log.info("Purging All Pulse table if exists")
+        self.dbHandler.reset_table("allpulses")
+        log.info("Purge Complete")
+        log.info("Streaming Pulses into All Pulses table")
+        self.stream_allpulses(days = days)
+        log.info("Streaming Complete")
+
+    def reset_relevantpulses(self):
+        self.dbHandler.reset_table("relevantpulses")
+        log.info("Deriving Relevant Pulses from All Pulses table")
+        self.dbHandler.derive_relevantpulses()
+        log.info("Deriving Complete")
+
+    def stream_allpulses(self, days: int = None, modified_since: str = None) -> tuple:
+        """
+        Streams pulses from OTX straight into allpulses, relevantpulses is kept up to date from the same pass. Fetching
+        runs on a background thread while batches are upserted, and no more than a bounded number of pulses is held in
+        memory at any time.
+        :param days: Maximum number of days ago you want pulses to be, defaults to all pulses
+        :param modified_since: iso formatted timestamp to sync from instead, takes precedence over days
+        :return: tuple of the number of pulses inserted and updated
+        """
+        pulses = self.otxHandler.iter_allpulses(last_numdays = days, modified_since = modified_since)
+        with progress_bar(self.progress) as bar:
+            return self.dbHandler.stream_pulses("allpulses", prefetch(pulses), bar = bar)
+
+    def backfill(self, since: str = None, window_days: int = None) -> tuple:
+        """
+        Backfills allpulses with the pulse history, committing and checkpointing every batch. An unfinished backfill is
+        resumed rather than planned again. OTX can only filter on the start of a window, so every window walks the feed
+        from its start to the present and drops what is past its end; more windows mean smaller units of work but
+        more pages fetched in total.
+        :param since: iso formatted timestamp to backfill from, defaults to the full history
+        :param window_days: split the history into windows of this many days, each checkpointed on its own
+        :return: tuple of the number of pulses inserted and updated
+        """
+        self.plan_backfill(since, window_days)
+        return self.resume_backfill()
+
+    def plan_backfill(self, since: str = None, window_days: int = None) -> bool:
+        """
+        Plans a backfill that the next update_alltables (or resume_backfill) runs, unless one is unfinished already.
+        :param since: iso formatted timestamp to backfill from, defaults to the full history
+        :param window_days: split the history into windows of this many days, each checkpointed on its own
+        :return: whether a new backfill was planned
+        """
+        if self.dbHandler.pending_backfill():
+            log.info("A backfill is unfinished, resuming it instead of planning a new one")
+            return False
+        self.dbHandler.plan_backfill(backfill_windows(since, window_days))
+        return True
+
+    def resume_backfill(self) -> tuple:
+        """
+        Continues every unfinished backfill window from its last checkpoint. A window resumes at the start of the page
+        its checkpoint falls in, pulses stored already are seen as unchanged and skipped.
+        :return: tuple of the number of pulses inserted and updated
+        """
+        # Profiles added or edited since the last run are matched against the stored pulses first
+        self.dbHandler.refresh_profiles()
+        inserted = updated = 0
+        for windowStart, windowEnd, pageSize, consumed in self.dbHandler.pending_backfill():
+            firstPage = consumed // pageSize + 1
+            offset = (firstPage - 1) * pageSize
+            log.info("Backfilling pulses modified from %s to %s, starting at page %d", windowStart or "the beginning",
+                     windowEnd or "now", firstPage)
+
+            def checkpoint(window_consumed, watermark, final, window_start = windowStart, window_end = windowEnd,
+                           offset = offset):
+                self.dbHandler.checkpoint_backfill(window_start, window_end, offset + window_consumed, watermark, final)
+
+            pulses = self.otxHandler.iter_backfill(windowStart, first_page = firstPage, limit = pageSize)
+            with progress_bar(self.progress) as bar:
+                windowInserted, windowUpdated = self.dbHandler.stream_pulses(
+                    "allpulses", prefetch(pulses), bar = bar, until = windowEnd or None, checkpoint = checkpoint)
+            inserted += windowInserted
+            updated += windowUpdated
+        return inserted, updated
 
     def check_for_initialization(self, table: str) -> bool:
         global firstInitializationAllPulses, firstInitializationRelPulses
         if firstInitializationAllPulses and table == "allpulses":
-            print("All Pulses table has not been initially populated. Populating All Pulses table with current data. "
-                  "This may take a while. Please wait...")
-            self.otxHandler.updatelist_allpulses()
-            self.dbHandler.digest_pulses(self.otxHandler)
-            self.dbHandler.insert_everything()
+            log.info("All Pulses table has not been initially populated. Populating All Pulses table with current "
+                     "data. This may take a while. Please wait...")
+            self.backfill()
             firstInitializationAllPulses = False
             return True
 
         if firstInitializationRelPulses and table == "relevantpulses":
-            print("Relevant Pulses table has not been initially populated. Populating Relevant Pulses table with "
-                  "current data. This may take a while. Please wait...")
-            self.otxHandler.updatelist_relevantpulses()
-            self.dbHandler.digest_pulses(self.otxHandler)
-            self.dbHandler.insert_everything()
+            log.info("Relevant Pulses table has not been initially populated. Deriving Relevant Pulses from All Pulses "
+                     "table.")
+            self.dbHandler.derive_relevantpulses()
             firstInitializationRelPulses = False
             return True
 
         return False
 
-    def update_alltables(self) -> None:
+    def update_alltables(self) -> RunMetrics:
         """
-        Updates all the current pulse tables in the DB which is "allpulses" and "relevantpulses".
-        :return: None
+        Updates all the current pulse tables in the DB which is "allpulses" and "relevantpulses". OTX is only walked
+        once, for allpulses, relevantpulses is derived from it in SQL.
+        :return: RunMetrics of the run, also kept as lastRun
         """
-        self._update_table("allpulses")
-        self._update_table("relevantpulses")
+        metrics = RunMetrics("sync")
+        fetcher = self.otxHandler.pageFetcher
+        before = (fetcher.pagesFetched, fetcher.bytesReceived, fetcher.retries, fetcher.requestSeconds,
+                  fetcher.decodeSeconds, fetcher.cacheHits, fetcher.cacheRevalidated)
+        self.dbHandler.metrics = metrics
+        runId = self.dbHandler.start_sync_run()
+        status = "failed"
+        try:
+            # Profiles added or edited since the last run are matched against the stored pulses first
+            with metrics.stage("profiles"):
+                self.dbHandler.refresh_profiles()
+            with metrics.stage("allpulses"):
+                self._update_table("allpulses")
+            with metrics.stage("relevantpulses"):
+                self._update_table("relevantpulses")
+            status = "completed"
+        finally:
+            self.dbHandler.finish_sync_run(status, metrics.counters.get("pulses_inserted", 0),
+                                           metrics.counters.get("pulses_updated", 0))
+            pages, received, retries, requestSeconds, decodeSeconds, cacheHits, cacheRevalidated = (
+                after - start for after, start in zip((fetcher.pagesFetched, fetcher.bytesReceived, fetcher.retries,
+                                                       fetcher.requestSeconds, fetcher.decodeSeconds,
+                                                       fetcher.cacheHits, fetcher.cacheRevalidated), before))
+            metrics.count("pages_fetched", pages)
+            metrics.count("bytes_received", received)
+            metrics.count("retries", retries)
+            if fetcher.cache:
+                metrics.count("page_cache_hits", cacheHits)
+                metrics.count("page_cache_revalidated", cacheRevalidated)
+            metrics.add_time("http", requestSeconds)
+            metrics.add_time("decode", decodeSeconds)
+            self.lastRun = metrics.finish()
+        report = metrics.report()
+        log.info("Sync run %d finished in %.1fs: %d pulses received (%s/s), %d inserted, %d updated, %d pages, "
+                 "%d retries", runId, report["duration_seconds"], metrics.counters.get("pulses_received", 0),
+                 report["pulses_per_second"], metrics.counters.get("pulses_inserted", 0),
+                 metrics.counters.get("pulses_updated", 0), pages, retries)
+        log.debug("Sync stage seconds: %s", report["stages"])
+        return metrics
 
     def _update_table(self, table: str) -> None:
         """
-        Updates a table in the DB with the current data from the feed in OTX. Will additionally log metadata to the
-        associated metadata file to keep track of last time the table was updated.
+        Updates a table in the DB with the current data from the feed in OTX. Exactly the pulses modified since the
+        table's stored watermark are fetched, across every page, and upserted. Updating relevantpulses does not touch
+        OTX, it is derived from what allpulses already holds.
         :param table: Table to update
         :return: None
         """
 
         # Check to make sure correct input was passed
         if table != "allpulses" and table != "relevantpulses":
-            print("Invalid Table. Select either allpulses or relevantpulses.")
+            log.error("Invalid Table. Select either allpulses or relevantpulses.")
             return
 
-        # Set the metaFile and meta object variables to use later
-        if table == "allpulses":
-            allPulsesMode = True
-            metadataFile = self.apMetaFile
-            meta = self.apMeta
-        else:
-            allPulsesMode = False
-            metadataFile = self.rpMetaFile
-            meta = self.rpMeta
-
-        # Setup the current metafile to have lastUpdated be set to right now
-        meta.lastUpdated = datetime.today()
-
         # If the table was *just* made, go ahead and populate the table with everything from OTX
         if self.check_for_initialization(table):
-            print("Table Populated. Skipping to Writing Metadata to file.")
-            self._write_metafile(meta, metadataFile)
+            log.info("Table Populated.")
             return
 
-        # Read the metadata file, make sure we can read it
-        if not (lastDBInfo := self._read_metafile(metadataFile)):
-            print("!ERROR READING METADATA FILE!")
+        if table == "relevantpulses":
+            # relevantpulses is materialized from allpulses, keeping it current costs no API calls
+            added = self.dbHandler.derive_relevantpulses()
+            self.dbHandler.metrics.count("relevant_derived", added)
+            log.info("Derived %d new Pulses into %s from allpulses.", added, table)
             return
 
-        # Check for lastUpdated in Metadata file, it *should* be set to a date
-        if allPulsesMode and lastDBInfo.lastUpdated is None:
-            print("Make sure to run init_insert_Xpulses first before proceeding")
-            return
-        elif not allPulsesMode and lastDBInfo.lastUpdated is None:
-            print("Make sure to run init_insert_Xpulses first before proceeding")
+        if self.dbHandler.pending_backfill():
+            log.info("Resuming the unfinished backfill of %s", table)
+            inserted, updated = self.resume_backfill()
+            log.info("Inserted %d new Pulses and updated %d modified Pulses.", inserted, updated)
             return
 
-        # Get the time delta between current time and last time it was updated
-        diff = meta.lastUpdated - lastDBInfo.lastUpdated
-        # For easier reading with the print, to tell the user how long ago it was updated
-        hours, mins, secs = convert_seconds(diff.seconds)
-        years, weeks, days = convert_days(diff.days)
-        # Print last time it was updated
-        print(f"Last {table} Pulse Table Update: {lastDBInfo.lastUpdated}\nTime Since Last Update: {days} Days,"
-              f" {weeks} Weeks, {years} Years: {hours} Hours, {mins} Mins, {secs} Seconds Ago")
-        # For the case that diff.days does not exist (e.g. if its been less than a day), defaults to 1 day if there has
-        # not been a day since the last update
-        daysSince = diff.days if diff.days else 1
-
-        # According to which table to update, get the pulses since the last update
-        if allPulsesMode:
-            self.otxHandler.updatelist_allpulses(last_numdays = daysSince)
+        watermark, lastUpdated = self.dbHandler.get_sync_state(table)
+        if lastUpdated:
+            # For easier reading with the log, to tell the user how long ago it was updated
+            diff = datetime.today() - datetime.fromisoformat(lastUpdated)
+            hours, mins, secs = convert_seconds(diff.seconds)
+            years, weeks, days = convert_days(diff.days)
+            log.info("Last %s Pulse Table Update: %s - Time Since Last Update: %d Days, %d Weeks, %d Years: "
+                     "%d Hours, %d Mins, %d Seconds Ago", table, lastUpdated, days, weeks, years, hours, mins, secs)
+        if watermark is None:
+            log.info("No watermark stored for %s. Fetching the full history, this may take a while.", table)
         else:
-            self.otxHandler.updatelist_relevantpulses(last_numdays = daysSince)
-
-        # Start to do SQL stuff, get the current cursor, get all data currently in the table
-        cursor = self.dbHandler.currentCursor
-        cursor.execute(f"""SELECT * FROM {table} ORDER BY created, modified ASC""")
-        dbPulses = cursor.fetchall()
-
-        print(f"Fetched Pulses from {table} Table")
-
-        # Sort the pulses by it's creation date to make the comparison process more faster
-        self.otxHandler.sort_pulses()
-        print(f"Iterating through Pulses in {table} Table")
-        with alive_bar(total = len(dbPulses), bar = "smooth", force_tty = True) as bar:
-            for dbPulse in dbPulses:
-                pulseId, *_ = dbPulse
-                relivantPulseCopy = self.otxHandler.relevantPulses.copy()
-                for index, pulse in enumerate(relivantPulseCopy):
-                    if pulse.get("id") == pulseId:
-                        del self.otxHandler.relevantPulses[index]
-                        break
-                bar()
-        print("Done Iterating through current Pulses.")
-        if len(self.otxHandler.relevantPulses) != 0:
-            def print_pulsedata(pulses: list):
-                for pulse in pulses:
-                    print(f"\t{pulse.get('name')} ({pulse.get('id')})")
-            print(f"Obtained {len(self.otxHandler.relevantPulses)} Pulses to Insert:")
-            print_pulsedata(self.otxHandler.relevantPulses)
-            self.dbHandler.digest_pulses(self.otxHandler)
-            print("Inserting Pulses and References...", end = " ")
-            self.dbHandler.insert_everything()
-            print("Successful")
+            log.info("Fetching Pulses modified since %s", watermark)
+
+        # Stream the delta since the watermark, each batch is diffed against the primary key index and upserted
+        inserted, updated = self.stream_allpulses(modified_since = watermark)
+        if inserted or updated:
+            log.info("Inserted %d new Pulses and updated %d modified Pulses.", inserted, updated)
         else:
-            print("No Pulses to Insert.")
+            log.info("No Pulses to Insert.")
 
-        self._write_metafile(meta, metadataFile)
-        print("Update Done!")
 
-    @staticmethod
-    def _read_metafile(meta_file: str):
-        print("Reading Metadata file.")
-        try:
-            with open(meta_file, "rb") as f:
-                lastDBInfo = pickle.load(f)
-        except EOFError:
-            print("Error. No Data to Read.")
-            return None
-        except FileNotFoundError:
-            print("Error. Metadata file not found.")
-            return None
-
-        print("Reading Complete.")
-        return lastDBInfo
-
-    @staticmethod
-    def _write_metafile(meta_obj, meta_file: str) -> None:
-        print("Dumping Metadata to File")
-        with open(meta_file, 'wb') as f:
-            pickle.dump(meta_obj, file = f)
-        print("Metadata dumping complete")
+def rebuild_database(workers: int = os.cpu_count() or 4, progress: bool = True, profiles: str = None) -> int:
+    """
+    Rebuilds the pulse DB from the raw pulse archive alone, no OTX key or network access needed.
+    :param workers: number of decompression threads
+    :param progress: show a progress bar
+    :param profiles: optional relevance rule file
+    :return: number of pulses rebuilt
+    """
+    dbHandler = SQLiteDBHandler(relevance = load_relevance(profiles))
+    log.info("Rebuilding the pulse DB from the Pulse Archive")
+    with progress_bar(progress) as bar:
+        rebuilt = dbHandler.rebuild_from_archive(workers, bar = bar)
+    log.info("Rebuild Complete. Pulses rebuilt: %d", rebuilt)
+    return rebuilt
@@ -0,0 +1,144 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from urllib.request import Request, urlopen
+
+from otxmatch import peak_rss_mb
+
+# Fraction of the feed modified and published between the full and the incremental sync
+INCREMENTAL_FRACTION = 0.01
+SCENARIOS = ["full", "incremental", "noop"]
+
+
+def _admin(server_url: str, path: str, method: str = "GET") -> dict:
+    with urlopen(Request(server_url + path, method = method), timeout = 30) as response:
+        return json.load(response)
+
+
+def _run_scenario(scenario: str, server_url: str, workdir: str, workers: int, results) -> None:
+    """
+    Runs one sync against the fake server in a fresh process, so peak RSS belongs to this scenario alone.
+    """
+    import otx
+    # The database paths are built as rootDir + "\\sqlite\\...", without the separator they would land next to workdir
+    # on POSIX, outside of what run_size removes
+    otx.rootDir = os.path.join(workdir, "")
+    app = otx.ApplicationDirector("benchmark", server = server_url, max_workers = workers, progress = False)
+
+    before = _admin(server_url, "/_admin/stats")
+    metrics = app.update_alltables()
+    after = _admin(server_url, "/_admin/stats")
+
+    report = metrics.report()
+    stages = report["stages"]
+    counters = report["counters"]
+    written = counters.get("pulses_inserted", 0) + counters.get("pulses_updated", 0)
+    insertSeconds = stages.get("prepare", 0.0) + stages.get("sql", 0.0)
+    # Closing checkpoints the WAL into the database file, which is only then at its full size
+    app.dbHandler.close()
+    results.put({
+        "scenario": scenario,
+        "feed_pulses": after["pulses"],
+        "pulses_received": counters.get("pulses_received", 0),
+        "pulses_inserted": counters.get("pulses_inserted", 0),
+        "pulses_updated": counters.get("pulses_updated", 0),
+        "seconds": round(report["duration_seconds"], 3),
+        "pulses_per_second": report["pulses_per_second"],
+        "diff_seconds": round(stages.get("diff", 0.0), 3),
+        "insert_seconds": round(insertSeconds, 3),
+        "insert_rate": round(written / insertSeconds, 1) if insertSeconds > 0 else None,
+        "batches": counters.get("batches", 0),
+        "api_calls": after["calls"] - before["calls"] - 1,
+        "throttled": after["throttled"] - before["throttled"],
+        "client_retries": counters.get("retries", 0),
+        "mb_received": round(counters.get("bytes_received", 0) / 2 ** 20, 1),
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+        "db_size_mb": round(os.path.getsize(otx.database_path()) / 2 ** 20, 1),
+    })
+
+
+def run_size(pulses: int, args) -> list:
+    """
+    Starts a fake OTX server with the given feed size and runs every scenario against it, in order, on one DB.
+    :return: list of scenario result dicts
+    """
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "otxfakeserver.py"),
+                               "--pulses", str(pulses), "--indicators", str(args.indicators),
+                               "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+                               "--seed", str(args.seed)]
+                              + (["--retry-after", str(args.retry_after)] if args.retry_after is not None else []),
+                              stdout = subprocess.PIPE, text = True)
+    workdir = tempfile.mkdtemp(prefix = f"otxbench-{pulses}-")
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        serverUrl = server.stdout.readline().strip()
+        for scenario in args.scenarios:
+            if scenario == "incremental":
+                changed = max(1, int(pulses * INCREMENTAL_FRACTION))
+                _admin(serverUrl, f"/_admin/touch?count={changed}", "POST")
+                _admin(serverUrl, f"/_admin/add?count={changed}", "POST")
+            queue = context.Queue()
+            process = context.Process(target = _run_scenario, args = (scenario, serverUrl, workdir, args.workers,
+                                                                      queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            result["pulses"] = pulses
+            results.append(result)
+            print(f"{pulses:>9} {scenario:<12} {result['seconds']:>9.2f}s {result['pulses_per_second'] or 0:>10.0f} "
+                  f"pulses/s  diff {result['diff_seconds']:>7.2f}s  "
+                  f"insert {result['insert_rate'] or 0:>9.0f} pulses/s  rss {result['peak_rss_mb']} MiB  "
+                  f"calls {result['api_calls']}", flush = True)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors = True)
+    return results
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark syncing against a local fake OTX server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Feed sizes, in pulses, to benchmark")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS,
+                        help="Syncs to run per size, in order, on the same DB")
+    parser.add_argument("--indicators", type=int, default=25, help="Average number of indicators per pulse")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server adds to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=None, help="Retry-After sent with injected 429s")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum number of pages fetched concurrently")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic feed")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": [],
+    }
+    for pulses in args.sizes:
+        report["results"].extend(run_size(pulses, args))
+
+    output = args.output or f"otxbench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent = 2)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import sys
+
+from otx import CHANGE_TABLES, SQLiteDBHandler
+
+# Changes read from the changelog per query
+CHANGES_PAGE_SIZE = 1000
+
+
+def read_cursor(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_cursor(path: str, cursor: int) -> None:
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        f.write(f"{cursor}\n")
+    os.replace(temporary, path)
+
+
+def iter_changes(db_handler: SQLiteDBHandler, cursor: int = 0, table: str = "relevantpulses", limit: int = None,
+                 page_size: int = CHANGES_PAGE_SIZE):
+    """
+    Pages through the changelog after a cursor.
+    :param db_handler: SQLiteDBHandler to read from
+    :param cursor: change_id of the last change already seen
+    :param table: only changes of this table, None for both
+    :param limit: stop after this many changes, defaults to every change there is
+    :param page_size: changes read per query
+    :return: Generator of change dicts, each one's change_id the cursor to continue after it
+    """
+    returned = 0
+    while limit is None or returned < limit:
+        changes = db_handler.changes_since(cursor, table, page_size if limit is None
+                                           else min(page_size, limit - returned))
+        if not changes:
+            return
+        for changeId, runId, changeTable, pulseId, kind, oldModified, newModified in changes:
+            yield {"change_id": changeId, "run_id": runId, "table": changeTable, "pulse_id": pulseId,
+                   "change": kind, "old_modified": oldModified, "new_modified": newModified}
+        cursor = changes[-1][0]
+        returned += len(changes)
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Print the pulse changes recorded by syncs after a cursor, as JSONL")
+    parser.add_argument("--cursor", type=int, default=None,
+                        help="change_id of the last change already seen, defaults to 0 or the cursor file")
+    parser.add_argument("--cursor-file", default=None,
+                        help="Read the cursor from this file and store the new cursor in it once the changes are out")
+    parser.add_argument("--table", default="relevantpulses", choices=[*CHANGE_TABLES, "all"],
+                        help="Only print changes of this table")
+    parser.add_argument("--limit", type=int, default=None, help="Print at most this many changes")
+    parser.add_argument("--runs", action="store_true", help="List the latest sync runs instead of changes")
+    args = parser.parse_args(argv)
+
+    dbHandler = SQLiteDBHandler()
+    try:
+        if args.runs:
+            for runId, started, finished, status, inserted, updated in dbHandler.sync_runs(args.limit or 20):
+                print(json.dumps({"run_id": runId, "started": started, "finished": finished, "status": status,
+                                  "inserted": inserted, "updated": updated}))
+            return
+        cursor = args.cursor
+        if cursor is None:
+            cursor = read_cursor(args.cursor_file) if args.cursor_file else 0
+        start = cursor
+        for change in iter_changes(dbHandler, cursor, None if args.table == "all" else args.table, args.limit):
+            sys.stdout.write(json.dumps(change) + "\n")
+            cursor = change["change_id"]
+        sys.stdout.flush()
+        if args.cursor_file and cursor != start:
+            write_cursor(args.cursor_file, cursor)
+    finally:
+        dbHandler.close()
+
+
+if __name__ == '__main__':
+    main()
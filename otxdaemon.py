@@ -0,0 +1,102 @@
+import logging
+import signal
+import threading
+
+from otx import ApplicationDirector
+
+log = logging.getLogger(__name__)
+
+
+class SyncScheduler:
+    """
+    Runs incremental syncs of every pulse table on an interval, keeping the ApplicationDirector (and with it the HTTP
+    session and the DB connection) warm between runs. The interval adapts to the feed: it shrinks while runs keep
+    finding new or modified pulses and grows back while they find nothing, between min_interval and max_interval.
+    """
+
+    def __init__(self, app_director: ApplicationDirector, interval: float = 900, min_interval: float = 60,
+                 max_interval: float = 3600, metrics_json: str = None, metrics_prom: str = None):
+        self.appDirector = app_director
+        self.interval = max(min_interval, min(interval, max_interval))
+        self.minInterval = min_interval
+        self.maxInterval = max_interval
+        self.metricsJson = metrics_json
+        self.metricsProm = metrics_prom
+        # Called with the RunMetrics of every successful run, e.g. to notify consumers of the new pulses. IOCMatchers
+        # reading the same database need no callback, they refresh themselves once a sync has committed.
+        self.callbacks = []
+        self.runs = 0
+        self.failures = 0
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def stop(self) -> None:
+        """
+        Asks the scheduler to exit once the current run, if any, has committed.
+        """
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self) -> None:
+        """
+        Starts the next run now instead of at the end of the interval.
+        """
+        self._wake.set()
+
+    def install_signal_handlers(self) -> None:
+        """
+        SIGINT and SIGTERM stop the scheduler gracefully, SIGHUP (where available) triggers an immediate run.
+        """
+        def on_stop(signum, frame):
+            log.info("Received %s, stopping after the current run", signal.Signals(signum).name)
+            self.stop()
+
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGTERM, on_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.wake())
+
+    def run_once(self):
+        """
+        Runs a single sync and adapts the interval to its outcome.
+        :return: RunMetrics of the run, None if it failed
+        """
+        self.runs += 1
+        try:
+            metrics = self.appDirector.update_alltables()
+        except Exception:
+            self.failures += 1
+            # OTX or the network is having trouble, back off all the way
+            self.interval = self.maxInterval
+            log.exception("Sync run %d failed, retrying in %.0fs", self.runs, self.interval)
+            return None
+
+        changed = metrics.counters.get("pulses_inserted", 0) + metrics.counters.get("pulses_updated", 0)
+        if changed:
+            self.interval = max(self.minInterval, self.interval / 2)
+        else:
+            self.interval = min(self.maxInterval, self.interval * 1.5)
+        log.info("Sync run %d found %d new or modified pulses, next run in %.0fs", self.runs, changed, self.interval)
+
+        if self.metricsJson:
+            metrics.write_json(self.metricsJson)
+        if self.metricsProm:
+            metrics.write_prometheus(self.metricsProm)
+        for callback in self.callbacks:
+            try:
+                callback(metrics)
+            except Exception:
+                log.exception("Sync callback %r failed", callback)
+        return metrics
+
+    def run_forever(self) -> None:
+        """
+        Syncs until stop() is called or a stop signal arrives.
+        """
+        log.info("Sync daemon started, interval %.0fs (%.0fs - %.0fs)", self.interval, self.minInterval,
+                 self.maxInterval)
+        while not self._stop.is_set():
+            self._wake.clear()
+            self.run_once()
+            self._wake.wait(self.interval)
+        log.info("Sync daemon stopped after %d runs (%d failed)", self.runs, self.failures)
@@ -0,0 +1,209 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# What urllib.request.pathname2url resolves to, without importing urllib.request and the http.client and email
+# packages that come with it
+if os.name == "nt":
+    from nturl2path import pathname2url
+else:
+    from urllib.parse import quote as pathname2url
+
+log = logging.getLogger(__name__)
+
+# Page size of newly created databases, larger pages suit the long TEXT rows of pulses and the FTS index
+PAGE_SIZE = 8192
+# Pragmas of every connection. WAL lets readers carry on while the writer commits, synchronous=NORMAL is durable
+# across application crashes in WAL mode and only fsyncs at checkpoints.
+CONNECTION_PRAGMAS = {
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+# Page cache per connection and database, in KiB. SQLite defaults to 2 MB, the indexes of a synced DB need more
+CACHE_SIZE_KIB = 32000
+# Readers map the database instead of copying pages into their own caches, the mapping is shared between them
+READER_PRAGMAS = {
+    "mmap_size": 268435456,
+    "query_only": "ON",
+}
+WRITER_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+}
+# Number of queued write jobs committed together in one transaction
+WRITER_MAX_BATCH = 8
+# Number of write jobs allowed to wait for the writer thread before submit() blocks, each holds a batch of pulses
+WRITER_QUEUE_SIZE = 2
+
+
+def configure_connection(connection: sqlite3.Connection, schema: str = "main", writer: bool = True,
+                         cache_size_kib: int = CACHE_SIZE_KIB) -> None:
+    """
+    Applies the tuned pragmas to a connection. On a database that does not exist yet the page size and incremental
+    auto vacuum are set first, neither can change once the first table is written without rewriting the file.
+    :param connection: connection to configure
+    :param schema: schema name of the database, e.g. an ATTACHed one
+    :param writer: switch the database to WAL with synchronous=NORMAL, otherwise set up a memory mapped reader
+    :param cache_size_kib: page cache of the database on this connection
+    :return: None
+    """
+    if writer and connection.execute(f"""PRAGMA {schema}.page_count""").fetchone()[0] == 0:
+        connection.execute(f"""PRAGMA {schema}.page_size = {PAGE_SIZE}""")
+        connection.execute(f"""PRAGMA {schema}.auto_vacuum = INCREMENTAL""")
+    for pragma, value in CONNECTION_PRAGMAS.items():
+        connection.execute(f"""PRAGMA {pragma} = {value}""")
+    connection.execute(f"""PRAGMA {schema}.cache_size = {-cache_size_kib}""")
+    for pragma, value in (WRITER_PRAGMAS if writer else READER_PRAGMAS).items():
+        connection.execute(f"""PRAGMA {schema}.{pragma} = {value}""")
+
+
+def connect_reader(path: str) -> sqlite3.Connection:
+    """
+    :param path: path of the database
+    :return: read-only connection to the database, configured as a reader
+    """
+    connection = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri = True, check_same_thread = False)
+    configure_connection(connection, writer = False)
+    return connection
+
+
+class SQLiteWriter:
+    """
+    Dedicated writer thread of a connection. Jobs are callables taking the connection, run one after another in
+    submission order. Whatever jobs are queued when the writer becomes free are committed together in a single
+    transaction, and if one of them fails the whole transaction is rolled back and all of them fail.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, max_batch: int = WRITER_MAX_BATCH,
+                 queue_size: int = WRITER_QUEUE_SIZE, metrics = None):
+        # The connection must have been opened with check_same_thread = False, and callers must not use it themselves
+        # while jobs are pending
+        self.connection = connection
+        self.maxBatch = max_batch
+        self.metrics = metrics
+        self.transactions = 0
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._thread = threading.Thread(target = self._run, name = "otx-sqlite-writer", daemon = True)
+        self._thread.start()
+
+    def submit(self, job) -> Future:
+        """
+        Queues a write job, blocking while the queue is full.
+        :param job: callable taking the connection, its return value becomes the result of the future
+        :return: Future of the job's result, set once its transaction committed
+        """
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def execute(self, sql: str, parameters = ()) -> Future:
+        return self.submit(lambda connection: connection.execute(sql, parameters).rowcount)
+
+    def executemany(self, sql: str, rows) -> Future:
+        return self.submit(lambda connection: connection.executemany(sql, rows).rowcount)
+
+    def flush(self) -> None:
+        """
+        Waits until every job submitted so far has committed.
+        """
+        self.submit(lambda connection: None).result()
+
+    def close(self) -> None:
+        """
+        Commits whatever is queued and stops the writer thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            group = [item]
+            while len(group) < self.maxBatch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._commit(group)
+                    return
+                group.append(item)
+            self._commit(group)
+
+    def _commit(self, group: list) -> None:
+        results = []
+        try:
+            for job, _ in group:
+                results.append(job(self.connection))
+            if self.metrics:
+                with self.metrics.stage("commit"):
+                    self.connection.commit()
+            else:
+                self.connection.commit()
+        except BaseException as e:
+            self.connection.rollback()
+            log.debug("Write transaction of %d jobs rolled back: %s", len(group), e)
+            for _, future in group:
+                future.set_exception(e)
+            return
+        self.transactions += 1
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
+
+
+class ReadPool:
+    """
+    Pool of read-only connections to a database. In WAL mode they read the last committed state without waiting for
+    the writer, so queries scale across threads while an ingest is running.
+    """
+
+    def __init__(self, path: str, size: int = None, prepare = None):
+        self.path = path
+        self.size = size or min(32, (os.cpu_count() or 4))
+        # Optional callable run on a connection whenever it is borrowed, outside any transaction
+        self.prepare = prepare
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection, creating one while fewer than size exist and blocking for a free one otherwise.
+        """
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            try:
+                connection = connect_reader(self.path) if create else self._idle.get()
+            except BaseException:
+                if create:
+                    with self._lock:
+                        self._created -= 1
+                raise
+        try:
+            if self.prepare is not None:
+                self.prepare(connection)
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            self._idle.put(connection)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,372 @@
+import abc
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import types
+import uuid
+
+from datetime import datetime, timezone
+
+from otx import CHANGE_TABLES, epoch_seconds, PARTITIONED, SQLiteDBHandler, SQLITE_MAX_VARIABLES
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    # Parquet and Arrow exports need pyarrow, the other formats do not
+    pyarrow = None
+
+log = logging.getLogger(__name__)
+
+# Rows fetched from SQLite and handed to the writer at once
+EXPORT_CHUNK_SIZE = 10000
+PULSE_COLUMNS = ("pulse_id", "name", "created", "modified", "description", "author", "created_ts", "modified_ts")
+# Exportable table -> columns. Tables without a modified column are exported by the modified time of their pulse.
+EXPORT_TABLES = {
+    "allpulses": PULSE_COLUMNS,
+    "relevantpulses": PULSE_COLUMNS,
+    "reference": ("pulse_id", "reference"),
+}
+FORMATS = ["jsonl", "csv", "parquet", "arrow", "stix"]
+# Namespace of the deterministic STIX IDs, the same pulse always maps to the same report
+STIX_NAMESPACE = uuid.UUID("7b2f5c1e-3d0a-4c55-9a7e-2f1a4f0d6c11")
+# created/modified of the author identities, which have no timestamps of their own in OTX
+IDENTITY_CREATED = "2012-01-01T00:00:00.000Z"
+# OTX indicator type -> STIX pattern template
+STIX_PATTERNS = {
+    "IPv4": "[ipv4-addr:value = '{}']",
+    "IPv6": "[ipv6-addr:value = '{}']",
+    "domain": "[domain-name:value = '{}']",
+    "hostname": "[domain-name:value = '{}']",
+    "URL": "[url:value = '{}']",
+    "URI": "[url:value = '{}']",
+    "email": "[email-addr:value = '{}']",
+    "FileHash-MD5": "[file:hashes.MD5 = '{}']",
+    "FileHash-SHA1": "[file:hashes.'SHA-1' = '{}']",
+    "FileHash-SHA256": "[file:hashes.'SHA-256' = '{}']",
+    "Mutex": "[mutex:name = '{}']",
+}
+
+
+class RowWriter(abc.ABC):
+    """
+    Writes chunks of rows to an export file. select() decides what SQLite returns per row: the plain columns by
+    default, text writers have SQLite encode every row so Python only joins lines. Every format implements write().
+    """
+
+    def __init__(self, f, columns: tuple):
+        self.f = f
+        self.columns = columns
+
+    @staticmethod
+    def select(columns: list) -> list:
+        """
+        :param columns: qualified column names, e.g. p.pulse_id
+        :return: list of SQL expressions to select per row
+        """
+        return columns
+
+    @abc.abstractmethod
+    def write(self, rows: list) -> None:
+        """
+        :param rows: chunk of rows, shaped by select()
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class JSONLWriter(RowWriter):
+    @staticmethod
+    def select(columns: list) -> list:
+        # json_object runs in C, several times faster than json.dumps per row
+        return ["json_object(" + ", ".join(f"'{column.split('.')[-1]}', {column}" for column in columns) + ")"]
+
+    def write(self, rows: list) -> None:
+        self.f.write("".join(row[0] + "\n" for row in rows))
+
+
+class CSVWriter(RowWriter):
+    def __init__(self, f, columns: tuple):
+        super().__init__(f, columns)
+        csv.writer(f).writerow(columns)
+
+    @staticmethod
+    def select(columns: list) -> list:
+        # Encoded by SQLite, text is always quoted, numbers and NULLs never are
+        fields = [f"""COALESCE({column}, '')""" if column.endswith("_ts") else
+                  f"""CASE WHEN {column} IS NULL THEN '' ELSE '"' || replace({column}, '"', '""') || '"' END"""
+                  for column in columns]
+        return [" || ',' || ".join(fields)]
+
+    def write(self, rows: list) -> None:
+        # The csv module's line terminator
+        self.f.write("".join(row[0] + "\r\n" for row in rows))
+
+
+class ArrowWriter(RowWriter):
+    """
+    Writes every chunk as one record batch, into a Parquet file (one row group per chunk) or an Arrow IPC file.
+    """
+
+    def __init__(self, f, columns: tuple, parquet: bool = True):
+        super().__init__(f, columns)
+        if pyarrow is None:
+            raise RuntimeError("Parquet and Arrow exports need pyarrow, pip install pyarrow")
+        self.schema = pyarrow.schema([(column, pyarrow.int64() if column.endswith("_ts") else pyarrow.string())
+                                      for column in columns])
+        if parquet:
+            self.writer = pyarrow.parquet.ParquetWriter(f, self.schema, compression = "zstd")
+        else:
+            self.writer = pyarrow.ipc.new_file(f, self.schema)
+
+    def write(self, rows: list) -> None:
+        columns = list(zip(*rows))
+        self.writer.write_batch(pyarrow.record_batch([pyarrow.array(values, type = field.type)
+                                                      for values, field in zip(columns, self.schema)],
+                                                     schema = self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def _stix_id(kind: str, *key) -> str:
+    return f"{kind}--{uuid.uuid5(STIX_NAMESPACE, ':'.join(map(str, key)))}"
+
+
+def _stix_timestamp(timestamp: str) -> str:
+    """
+    :return: OTX timestamp in the STIX form, UTC with millisecond precision and a Z suffix
+    """
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        parsed = datetime(1970, 1, 1)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class STIXWriter(RowWriter):
+    """
+    Streams a STIX 2.1 bundle. Every pulse becomes a report referencing an indicator per patternable OTX indicator and
+    the identity of its author, OTX itself standing in for pulses without one. Indicators are emitted per pulse, with
+    the pulse's timestamps, as OTX itself scopes them, so no export-wide deduplication (and memory) is needed.
+    """
+
+    def __init__(self, f, columns: tuple, connection):
+        super().__init__(f, columns)
+        self.connection = connection
+        self.authors = set()
+        self.first = True
+        f.write('{"type": "bundle", "id": "bundle--' + str(uuid.uuid4()) + '", "objects": [\n')
+
+    def _emit(self, stixObject: dict) -> None:
+        self.f.write(("" if self.first else ",\n") + json.dumps(stixObject, ensure_ascii = False))
+        self.first = False
+
+    def write(self, rows: list) -> None:
+        indicators = {}
+        for start in range(0, len(rows), SQLITE_MAX_VARIABLES):
+            chunk = [row[0] for row in rows[start:start + SQLITE_MAX_VARIABLES]]
+            placeholders = ", ".join("?" * len(chunk))
+            for pulseId, indicatorType, indicator in self.connection.execute(f"""SELECT l.pulse_id, t.name,
+                    i.indicator FROM pulse_indicator_all l JOIN indicator i ON i.indicator_id = l.indicator_id
+                    JOIN indicator_type t ON t.type_id = i.type_id WHERE l.pulse_id IN ({placeholders})""", chunk):
+                if indicatorType in STIX_PATTERNS:
+                    indicators.setdefault(pulseId, []).append((indicatorType, indicator))
+
+        for pulseId, name, created, modified, description, author, *_ in rows:
+            created = _stix_timestamp(created)
+            modified = max(created, _stix_timestamp(modified or created))
+            authorRef = _stix_id("identity", "author", author or "")
+            if authorRef not in self.authors:
+                self.authors.add(authorRef)
+                self._emit({"type": "identity", "spec_version": "2.1", "id": authorRef, "created": IDENTITY_CREATED,
+                            "modified": IDENTITY_CREATED, "name": author or "AlienVault OTX",
+                            "identity_class": "individual" if author else "organization"})
+            # object_refs may not be empty, the author is always there
+            refs = [authorRef]
+            for indicatorType, indicator in indicators.get(pulseId, ()):
+                indicatorRef = _stix_id("indicator", pulseId, indicatorType, indicator)
+                value = indicator.replace("\\", "\\\\").replace("'", "\\'")
+                self._emit({"type": "indicator", "spec_version": "2.1", "id": indicatorRef, "created": created,
+                            "modified": modified, "valid_from": created, "pattern_type": "stix",
+                            "pattern": STIX_PATTERNS[indicatorType].format(value), "created_by_ref": authorRef})
+                refs.append(indicatorRef)
+            report = {"type": "report", "spec_version": "2.1", "id": _stix_id("report", pulseId), "created": created,
+                      "modified": modified, "published": created, "name": name or pulseId,
+                      "report_types": ["threat-report"],
+                      "external_references": [{"source_name": "AlienVault OTX", "external_id": pulseId,
+                                               "url": f"https://otx.alienvault.com/pulse/{pulseId}"}],
+                      "created_by_ref": authorRef, "object_refs": refs}
+            if description:
+                report["description"] = description
+            self._emit(report)
+
+    def close(self) -> None:
+        self.f.write("\n]}\n")
+
+
+class PulseExporter:
+    """
+    Streams pulse tables out of the pulse DB into files for SIEMs and data lakes. Every export reads one consistent
+    snapshot through a read-only connection with a chunked cursor, so memory stays flat regardless of table size and a
+    running sync is neither blocked nor half exported. Named exports can be incremental: only rows of pulses the
+    changelog records as added or modified since their last run are written.
+    """
+
+    def __init__(self, db_handler: SQLiteDBHandler = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+        self.dbHandler = db_handler or SQLiteDBHandler()
+        self.chunkSize = chunk_size
+
+    @staticmethod
+    def _query(table: str, since: str, writer = RowWriter, after: int = None) -> tuple:
+        # Partitioned tables are read through their views, rolled pulses are exported like the others
+        alias = "r" if table == "reference" else "p"
+        select = ", ".join(writer.select([f"{alias}.{column}" for column in EXPORT_TABLES[table]]))
+        query = f"""SELECT {select} FROM {PARTITIONED.get(table, table)} {alias}"""
+        params = []
+        if after is not None:
+            # Every pulse the changelog has inserted or updated since, whatever its modified time. A range on the
+            # changelog's primary key, deleted pulses find no row to export.
+            query += f""" WHERE {alias}.pulse_id IN (SELECT pulse_id FROM changelog WHERE change_id > ? 
+                    AND table_code = ?)"""
+            params = [after, CHANGE_TABLES.index("allpulses" if table == "reference" else table)]
+        elif since:
+            if table == "reference":
+                query += f""" JOIN {PARTITIONED["allpulses"]} p ON p.pulse_id = r.pulse_id"""
+            # The range is an index lookup on modified_ts, the text comparison keeps sub-second precision
+            query += """ WHERE p.modified_ts >= ? AND p.modified >= ?"""
+            params = [epoch_seconds(since), since]
+        return query, params
+
+    def iter_rows(self, connection, table: str, since: str = None, writer = RowWriter,
+                  after: int = None) -> types.GeneratorType:
+        """
+        Yields the rows of a table in chunks, optionally only rows of pulses modified at or after since.
+        :param writer: RowWriter class whose select() the rows are shaped by
+        :param after: only rows of pulses inserted or updated after this change_id of the changelog, overrides since
+        :return: Generator of lists of row tuples, columns as in EXPORT_TABLES unless writer encodes them
+        """
+        query, params = self._query(table, since, writer, after)
+        cursor = connection.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(self.chunkSize)
+            if not rows:
+                return
+            yield rows
+
+    def export(self, table: str, export_format: str, path: str, since: str = None, name: str = None,
+               incremental: bool = False) -> dict:
+        """
+        Exports a table to a file. The file is written next to its destination and moved into place once complete, and
+        only then is the export's state advanced.
+        :param table: table to export, see EXPORT_TABLES
+        :param export_format: one of FORMATS
+        :param path: output file
+        :param since: iso formatted timestamp, only export rows of pulses modified at or after it
+        :param name: name the export's state is kept under, defaults to table.format
+        :param incremental: only export rows of pulses the changelog records as inserted or updated since the last run
+                            of this export, overrides since. Unlike a modified watermark this also catches pulses that
+                            join relevantpulses with an older modified time, e.g. after a profile edit. The first run,
+                            and a run after the changelog was reset, exports the whole table.
+        :return: dict describing the export
+        """
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Cannot export {table}, choose from {', '.join(EXPORT_TABLES)}")
+        if export_format not in FORMATS:
+            raise ValueError(f"Unknown export format {export_format}, choose from {', '.join(FORMATS)}")
+        if export_format == "stix" and table == "reference":
+            raise ValueError("STIX exports are made of pulses, export allpulses or relevantpulses")
+        name = name or f"{table}.{export_format}"
+        after = None
+        if incremental:
+            since = None
+            _, _, after = self.dbHandler.get_export_state(name)
+        if since and epoch_seconds(since) is None:
+            raise ValueError(f"{since} is not an iso formatted timestamp")
+
+        start = time.perf_counter()
+        rows = 0
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with self.dbHandler.read_pool().connection() as connection:
+            # One read transaction, the export state and the rows come from the same snapshot
+            connection.execute("""BEGIN""")
+            pulseTable = "allpulses" if table == "reference" else table
+            # Off the end of the modified_ts index. Partitions hold the older pulses, their view has no index to read
+            # the end of and is only scanned when the pulse database holds none.
+            for source in dict.fromkeys((pulseTable, PARTITIONED.get(pulseTable, pulseTable))):
+                watermark = connection.execute(f"""SELECT modified FROM {source}
+                        WHERE modified_ts = (SELECT MAX(modified_ts) FROM {source})
+                        ORDER BY modified DESC LIMIT 1""").fetchone()
+                if watermark:
+                    break
+            watermark = watermark[0] if watermark else since
+            changeCursor = connection.execute("""SELECT COALESCE(MAX(change_id), 0) FROM changelog""").fetchone()[0]
+            if after is not None and after > changeCursor:
+                log.warning("The changelog of export %s was reset, exporting the whole table", name)
+                after = None
+            binary = export_format in ("parquet", "arrow")
+            try:
+                with open(temporary, "wb" if binary else "w", encoding = None if binary else "utf-8",
+                          newline = None if binary else "") as f:
+                    columns = EXPORT_TABLES[table]
+                    if export_format == "stix":
+                        writer = STIXWriter(f, columns, connection)
+                    elif binary:
+                        writer = ArrowWriter(f, columns, parquet = export_format == "parquet")
+                    elif export_format == "csv":
+                        writer = CSVWriter(f, columns)
+                    else:
+                        writer = JSONLWriter(f, columns)
+                    for chunk in self.iter_rows(connection, table, since, type(writer), after):
+                        writer.write(chunk)
+                        rows += len(chunk)
+                    writer.close()
+                os.replace(temporary, path)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+
+        self.dbHandler.set_export_state(name, table, watermark, rows, changeCursor)
+        seconds = time.perf_counter() - start
+        log.info("Exported %d rows of %s to %s in %.1fs", rows, table, path, seconds)
+        return {"name": name, "table": table, "format": export_format, "path": path, "since": since,
+                "after_change": after, "change_cursor": changeCursor, "watermark": watermark, "rows": rows,
+                "seconds": round(seconds, 3)}
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Export tables of the local OTX pulse DB")
+    parser.add_argument("format", choices=FORMATS, help="Output format, parquet and arrow need pyarrow")
+    parser.add_argument("output", help="File to write")
+    parser.add_argument("--table", default="relevantpulses", choices=list(EXPORT_TABLES), help="Table to export")
+    parser.add_argument("--since", default=None, help="Only export pulses modified at or after this iso formatted date")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only export pulses the changelog records as added or modified since the last run")
+    parser.add_argument("--name", default=None, help="Name the export's state is kept under")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="Rows read and written at once")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    exporter = PulseExporter(chunk_size = args.chunk_size)
+    try:
+        report = exporter.export(args.table, args.format, args.output, since = args.since, name = args.name,
+                                 incremental = args.incremental)
+    except (ValueError, RuntimeError) as e:
+        parser.exit(2, f"{parser.prog}: error: {e}\n")
+    finally:
+        exporter.dbHandler.close()
+    json.dump(report, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    main()
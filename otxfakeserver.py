@@ -0,0 +1,296 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from otxfetch import SUBSCRIBED
+
+# Modified time of synthetic pulse 0, pulse i is modified i seconds later
+EPOCH = datetime(2015, 1, 1)
+INDUSTRIES = ["Aerospace", "Government", "Finance", "Healthcare", "Energy", "Telecommunications", "Technology",
+              "Transportation", "Manufacturing", "Education"]
+COUNTRIES = ["United States", "United Kingdom", "Germany", "France", "Israel", "Japan", "India", "Ukraine", "Canada"]
+ADVERSARIES = ["", "", "", "APT28", "APT33", "Lazarus Group", "Kimsuky", "Turla", "OilRig", "FIN7"]
+MALWARE = ["Emotet", "TrickBot", "Cobalt Strike", "AgentTesla", "Formbook", "QakBot", "RedLine", "PlugX"]
+ATTACKS = ["T1566", "T1059", "T1071", "T1105", "T1204", "T1027", "T1547", "T1082", "T1190", "T1486"]
+TAGS = ["phishing", "ransomware", "apt", "malware", "c2", "botnet", "aviation", "airport", "ads-b", "supply chain",
+        "credential theft", "espionage"]
+WORDS = ["campaign", "actor", "infrastructure", "observed", "targeting", "payload", "loader", "domain", "server",
+         "spearphishing", "attachment", "credential", "airline", "operator", "network", "exfiltration", "backdoor"]
+
+
+class FakeOTX:
+    """
+    Synthetic contents of the OTX subscribed pulse feed. Pulses are generated on demand from their index, so a feed of
+    a million pulses costs no memory. Pulse i has modified time EPOCH + i seconds, unless it was touched since, in which
+    case it carries a later modified time and shows up again for any modified_since past its original one.
+    """
+
+    def __init__(self, pulses: int, indicators: int = 25, seed: int = 0):
+        self.count = pulses
+        self.indicators = indicators
+        self.seed = seed
+        # Pulse index -> (modified offset in seconds, revision)
+        self.touched = {}
+        self._lock = threading.Lock()
+
+    def add(self, pulses: int) -> None:
+        """
+        Publishes new pulses, newer than every existing one.
+        """
+        with self._lock:
+            self.count += pulses
+
+    def touch(self, pulses: int) -> None:
+        """
+        Modifies existing pulses, spread evenly over the feed, giving them a modified time newer than every pulse.
+        """
+        with self._lock:
+            step = max(1, self.count // max(1, pulses))
+            clock = max([self.count] + [offset + 1 for offset, _ in self.touched.values()])
+            for n, index in enumerate(range(0, self.count, step)):
+                if n >= pulses:
+                    break
+                revision = self.touched.get(index, (0, 0))[1] + 1
+                self.touched[index] = (clock + n, revision)
+
+    def page(self, page: int, limit: int, modified_since: datetime = None) -> tuple:
+        """
+        :return: tuple of the list of pulses of the page and the total number of pulses matching the query
+        """
+        with self._lock:
+            count = self.count
+            touched = dict(self.touched)
+        start = 0
+        if modified_since is not None:
+            start = max(0, min(count, int((modified_since - EPOCH).total_seconds() + 0.999999)))
+        # Pulses modified past the start after having been touched, followed by every pulse from the start onwards
+        early = sorted(index for index, (offset, _) in touched.items()
+                       if index < start and EPOCH + timedelta(seconds = offset) >= (modified_since or EPOCH))
+        total = len(early) + count - start
+        first = (page - 1) * limit
+        indexes = early[first:first + limit]
+        if len(indexes) < limit:
+            rangeStart = start + max(0, first - len(early))
+            indexes += range(rangeStart, min(count, rangeStart + limit - len(indexes)))
+        return [self.pulse(index, touched.get(index)) for index in indexes], total
+
+    def pulse(self, index: int, touched: tuple = None) -> dict:
+        """
+        :return: the synthetic pulse at the index, shaped and sized like a real OTX pulse
+        """
+        rng = random.Random(self.seed * 1000003 + index)
+        created = EPOCH + timedelta(seconds = index)
+        offset, revision = touched or (index, 0)
+        modified = EPOCH + timedelta(seconds = offset)
+        pulseId = "%024x" % (0x5f0000000000000000000000 + index)
+        industries = rng.sample(INDUSTRIES, rng.randint(0, 3))
+        indicators = []
+        for n in range(rng.randint(self.indicators // 2, self.indicators * 3 // 2)):
+            kind = rng.random()
+            if kind < 0.3:
+                indicatorType, indicator = "IPv4", "%d.%d.%d.%d" % tuple(rng.randint(1, 254) for _ in range(4))
+            elif kind < 0.5:
+                indicatorType, indicator = "domain", f"{rng.choice(WORDS)}-{rng.randint(0, 99999)}.com"
+            elif kind < 0.6:
+                indicatorType, indicator = "hostname", f"mail.{rng.choice(WORDS)}{rng.randint(0, 99999)}.net"
+            elif kind < 0.7:
+                indicatorType, indicator = "URL", f"http://{rng.choice(WORDS)}{rng.randint(0, 9999)}.org/" \
+                                                  f"{rng.choice(WORDS)}.php?id={rng.randint(0, 10 ** 6)}"
+            elif kind < 0.8:
+                indicatorType, indicator = "FileHash-SHA256", "%064x" % rng.getrandbits(256)
+            elif kind < 0.9:
+                indicatorType, indicator = "FileHash-MD5", "%032x" % rng.getrandbits(128)
+            else:
+                indicatorType, indicator = "FileHash-SHA1", "%040x" % rng.getrandbits(160)
+            indicators.append({"id": index * 1000 + n, "indicator": indicator, "type": indicatorType,
+                               "created": created.isoformat(), "content": "", "title": "", "description": "",
+                               "expiration": None, "is_active": 1, "role": None})
+        return {
+            "id": pulseId,
+            "name": f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} campaign #{index}"
+                    + (f" (rev {revision})" if revision else ""),
+            "description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 120))),
+            "author_name": f"author{rng.randint(0, 500)}",
+            "modified": modified.isoformat(timespec = "microseconds"),
+            "created": created.isoformat(timespec = "microseconds"),
+            "revision": revision + 1,
+            "tlp": rng.choice(["white", "white", "green", "amber"]),
+            "public": 1,
+            "adversary": rng.choice(ADVERSARIES),
+            "indicators": indicators,
+            "tags": rng.sample(TAGS, rng.randint(0, 5)),
+            "targeted_countries": rng.sample(COUNTRIES, rng.randint(0, 3)),
+            "malware_families": [{"id": family, "display_name": family}
+                                 for family in rng.sample(MALWARE, rng.randint(0, 2))],
+            "attack_ids": [{"id": attack, "name": attack, "display_name": attack}
+                           for attack in rng.sample(ATTACKS, rng.randint(0, 4))],
+            "references": [f"https://blog.example.com/{pulseId}/{n}" for n in range(rng.randint(0, 4))],
+            "industries": industries,
+            "extract_source": [],
+            "more_indicators": False,
+        }
+
+
+class FakeOTXHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        # Thousands of requests per run, keep the console quiet
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        server.count_call()
+        if url.path == "/_admin/stats":
+            return self._send_json(200, server.stats())
+        if url.path.rstrip("/") != SUBSCRIBED:
+            return self._send_json(404, {"detail": "Not found."})
+        if not self.headers.get("X-OTX-API-KEY"):
+            return self._send_json(403, {"detail": "Authentication credentials were not provided."})
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.count_throttle()
+            headers = {"Retry-After": str(server.retry_after)} if server.retry_after is not None else {}
+            return self._send_json(429, {"detail": "Request was throttled."}, headers)
+
+        try:
+            page = max(1, int(query.get("page", 1)))
+            limit = max(1, min(int(query.get("limit", 50)), 500))
+            modifiedSince = query.get("modified_since")
+            modifiedSince = datetime.fromisoformat(modifiedSince).replace(tzinfo = None) if modifiedSince else None
+        except ValueError as e:
+            return self._send_json(400, {"detail": str(e)})
+
+        results, total = server.feed.page(page, limit, modifiedSince)
+        base = f"http://{self.headers.get('Host')}{SUBSCRIBED}?limit={limit}" \
+               + (f"&modified_since={query['modified_since']}" if modifiedSince else "")
+        self._send_json(200, {
+            "results": results,
+            "count": total,
+            "next": f"{base}&page={page + 1}" if page * limit < total else None,
+            "previous": f"{base}&page={page - 1}" if page > 1 else None,
+        }, conditional = True)
+
+    def do_POST(self) -> None:
+        server = self.server
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/_admin/add":
+            server.feed.add(int(query.get("count", 0)))
+        elif url.path == "/_admin/touch":
+            server.feed.touch(int(query.get("count", 0)))
+        else:
+            return self._send_json(404, {"detail": "Not found."})
+        self._send_json(200, server.stats())
+
+    def _send_json(self, status: int, body: dict, headers: dict = None, conditional: bool = False) -> None:
+        data = json.dumps(body, separators = (",", ":")).encode("utf-8")
+        if conditional:
+            # Pages carry an ETag of their body and are answered with 304 when the client already has it
+            etag = f'"{hashlib.sha1(data).hexdigest()}"'
+            headers = dict(headers or {}, ETag = etag)
+            if self.headers.get("If-None-Match") == etag:
+                self.server.count_not_modified()
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOTXServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OTX /pulses/subscribed endpoint, with configurable latency and injected 429 responses. Pages
+    are sent with an ETag and honour If-None-Match.
+    Besides the feed it serves GET /_admin/stats and POST /_admin/add?count=N, /_admin/touch?count=N to publish and
+    modify pulses between syncs.
+    """
+    daemon_threads = True
+
+    def __init__(self, feed: FakeOTX, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 error_rate: float = 0.0, retry_after: float = None, seed: int = 0):
+        super().__init__((host, port), FakeOTXHandler)
+        self.feed = feed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.throttled = 0
+        self.notModified = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def count_throttle(self) -> None:
+        with self._lock:
+            self.throttled += 1
+
+    def count_not_modified(self) -> None:
+        with self._lock:
+            self.notModified += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "throttled": self.throttled, "not_modified": self.notModified,
+                    "pulses": self.feed.count, "touched": len(self.feed.touched)}
+
+    def start(self) -> "FakeOTXServer":
+        """
+        Serves on a background thread, for use from the same process.
+        """
+        threading.Thread(target = self.serve_forever, name = "otx-fake-server", daemon = True).start()
+        return self
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Serve a synthetic OTX subscribed pulse feed locally")
+    parser.add_argument("--pulses", type=int, default=10000, help="Number of pulses in the feed")
+    parser.add_argument("--indicators", type=int, default=25, help="Average number of indicators per pulse")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on, defaults to a free port")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every feed request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of feed requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=None, help="Retry-After sent with injected 429s")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic pulses and injected errors")
+    args = parser.parse_args(argv)
+
+    server = FakeOTXServer(FakeOTX(args.pulses, indicators = args.indicators, seed = args.seed), host = args.host,
+                           port = args.port, latency = args.latency, error_rate = args.error_rate,
+                           retry_after = args.retry_after, seed = args.seed)
+    # The benchmark reads the URL from the first line
+    print(server.url, flush = True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+import hashlib
+import json
+import logging
+import math
+import random
+import sqlite3
+import threading
+import time
+import types
+import zlib
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+from otxdb import configure_connection
+
+OTX_SERVER = "https://otx.alienvault.com"
+SUBSCRIBED = "/api/v1/pulses/subscribed"
+# HTTP status codes that mean "slow down / try again later" rather than "this request is wrong"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Seconds a cached page is served without asking OTX, after that it is revalidated with a conditional request
+PAGE_CACHE_TTL = 3600
+# Compressed bytes the page cache may hold before the least recently used pages are evicted
+PAGE_CACHE_MAX_BYTES = 1024 * 2 ** 20
+# zlib level of cached pages, the same trade-off as the raw pulse archive
+PAGE_CACHE_COMPRESSION_LEVEL = 6
+
+log = logging.getLogger(__name__)
+
+
+class FetchError(Exception):
+    """
+    Raised when a page could not be fetched from OTX, either because the server rejected the request or because every
+    retry was exhausted.
+    """
+
+
+CachedPage = namedtuple("CachedPage", "content etag last_modified fresh")
+
+
+class PageCache:
+    """
+    On-disk cache of OTX page responses, zlib compressed in an SQLite file and keyed by API key, endpoint, query
+    parameters and page. Pages younger than the TTL are served without a request, older ones are revalidated with
+    If-None-Match/If-Modified-Since when OTX sent validators for them. The total size is bounded, least recently used
+    pages are evicted first. Safe to share between the fetch threads.
+    """
+
+    def __init__(self, path: str, ttl: float = PAGE_CACHE_TTL, max_bytes: int = PAGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.maxBytes = max_bytes
+        # Autocommit, every statement is its own short transaction
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        configure_connection(self.connection, cache_size_kib = 2000)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS page (key TEXT PRIMARY KEY NOT NULL, etag TEXT, 
+                last_modified TEXT, stored REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL, 
+                data BLOB NOT NULL)""")
+        self.connection.execute("""CREATE INDEX IF NOT EXISTS idx_page_accessed ON page (accessed)""")
+        self.size = self.connection.execute("""SELECT COALESCE(SUM(size), 0) FROM page""").fetchone()[0]
+        self._lock = threading.Lock()
+        # The bound may have been lowered since the cache was last used
+        if self.size > self.maxBytes:
+            self._evict()
+
+    def get(self, key: str) -> CachedPage:
+        """
+        :param key: cache key from PageFetcher.cache_key
+        :return: CachedPage of the decompressed response body and its validators, None if the page is not cached
+        """
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute("""SELECT data, etag, last_modified, stored FROM page WHERE key = ?""",
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("""UPDATE page SET accessed = ? WHERE key = ?""", (now, key))
+        data, etag, lastModified, stored = row
+        return CachedPage(zlib.decompress(data), etag, lastModified, now - stored < self.ttl)
+
+    def put(self, key: str, content: bytes, etag: str = None, last_modified: str = None) -> None:
+        """
+        Stores a page response, replacing any older copy, and evicts pages past the size bound.
+        """
+        data = zlib.compress(content, PAGE_CACHE_COMPRESSION_LEVEL)
+        now = time.time()
+        with self._lock:
+            old = self.connection.execute("""SELECT size FROM page WHERE key = ?""", (key,)).fetchone()
+            self.connection.execute("""INSERT OR REPLACE INTO page (key, etag, last_modified, stored, accessed, size, 
+                    data) VALUES (?, ?, ?, ?, ?, ?, ?)""", (key, etag, last_modified, now, now, len(data), data))
+            self.size += len(data) - (old[0] if old else 0)
+            if self.size > self.maxBytes:
+                self._evict()
+
+    def revalidated(self, key: str) -> None:
+        """
+        Marks a cached page as confirmed current by OTX, restarting its TTL.
+        """
+        now = time.time()
+        with self._lock:
+            self.connection.execute("""UPDATE page SET stored = ?, accessed = ? WHERE key = ?""", (now, now, key))
+
+    def _evict(self) -> None:
+        # Down to 90% of the bound, so not every put past it has to evict
+        target = self.maxBytes * 0.9
+        evicted = []
+        for key, size in self.connection.execute("""SELECT key, size FROM page ORDER BY accessed"""):
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.connection.executemany("""DELETE FROM page WHERE key = ?""", evicted)
+        log.debug("Evicted %d pages from the page cache, %d bytes left", len(evicted), self.size)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.connection.execute("""DELETE FROM page""")
+            self.size = 0
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class PageFetcher:
+    """
+    Fetches pages of the OTX subscribed pulse feed concurrently over a pooled keep-alive session. Several pages are kept
+    in flight at once, the number of pages in flight adapts to how the server responds (additive increase,
+    multiplicative decrease on 429/5xx), and pulses are delivered in page order.
+    """
+
+    def __init__(self, api_key: str, server: str = OTX_SERVER, max_workers: int = 8, min_workers: int = 1,
+                 max_retries: int = 6, backoff_base: float = 0.5, backoff_cap: float = 30.0, timeout: float = 60.0,
+                 cache: PageCache = None):
+        self.server = server.rstrip("/")
+        self.maxWorkers = max_workers
+        self.minWorkers = min_workers
+        self.maxRetries = max_retries
+        self.backoffBase = backoff_base
+        self.backoffCap = backoff_cap
+        self.timeout = timeout
+        self.cache = cache
+        # Cached pages of one API key are never served for another, subscriptions differ between accounts
+        self._cacheNamespace = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+        # Start conservatively and let additive increase find the rate the server is comfortable with
+        self.concurrency = max(min_workers, min(2, max_workers))
+        self._successes = 0
+        self._pauseUntil = 0.0
+        self._lock = threading.Lock()
+
+        self.pagesFetched = 0
+        self.bytesReceived = 0
+        self.retries = 0
+        # Summed over the worker threads, so these grow faster than wall time when pages are fetched concurrently
+        self.requestSeconds = 0.0
+        self.decodeSeconds = 0.0
+        # Pages served from the cache without a request, and pages OTX confirmed with a 304
+        self.cacheHits = 0
+        self.cacheRevalidated = 0
+
+        # requests is imported here rather than at module load, the offline commands only need the constants above
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        self.session.headers.update({"X-OTX-API-KEY": api_key, "User-Agent": "OTX Aviation Threat Intel",
+                                     "Accept-Encoding": "gzip, deflate"})
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def getall_iter(self, modified_since = None, limit: int = 50, max_page: int = None,
+                    first_page: int = 1) -> types.GeneratorType:
+        """
+        Drop-in replacement for OTXv2.getall_iter. Yields every subscribed pulse, in the order OTX pages them.
+        :param modified_since: date, datetime or iso formatted string of the earliest modification to return
+        :param limit: The page size to retrieve in a single request
+        :param max_page: if set, limits number of pages returned to 'max_page'
+        :param first_page: 1-based page to start from, e.g. to resume an interrupted walk
+        :return: Generator of OTX pulses
+        """
+        params = {"limit": limit}
+        if modified_since is not None:
+            if isinstance(modified_since, (datetime, date)):
+                modified_since = modified_since.isoformat()
+            params["modified_since"] = modified_since
+
+        # The first page tells us how many pages there are, after that every page can be requested independently
+        firstPage = self.fetch_page(first_page, params)
+        yield from firstPage.get("results", [])
+        if not firstPage.get("next") or max_page == 1:
+            return
+
+        count = firstPage.get("count")
+        if count is None:
+            # Server did not report a total, fall back to walking the next links one at a time
+            yield from self._walk_next(firstPage.get("next"), max_page)
+            return
+
+        lastPage = max(1, math.ceil(count / limit))
+        if max_page:
+            lastPage = min(lastPage, first_page + max_page - 1)
+        yield from self._fetch_range(first_page + 1, lastPage, params)
+
+    def _fetch_range(self, first_page: int, last_page: int, params: dict) -> types.GeneratorType:
+        """
+        Keeps up to self.concurrency pages in flight and yields their pulses strictly in page order. Only pages that
+        are in flight or waiting for an earlier page to finish are held in memory.
+        """
+        executor = ThreadPoolExecutor(max_workers = self.maxWorkers, thread_name_prefix = "otx-fetch")
+        inFlight = {}
+        nextSubmit = first_page
+        try:
+            for page in range(first_page, last_page + 1):
+                while nextSubmit <= last_page and len(inFlight) < self.concurrency:
+                    inFlight[nextSubmit] = executor.submit(self.fetch_page, nextSubmit, params)
+                    nextSubmit += 1
+                data = inFlight.pop(page).result()
+                results = data.get("results", [])
+                yield from results
+                if not results or not data.get("next"):
+                    # Feed shrank while we were walking it, nothing left past this page
+                    break
+        finally:
+            for future in inFlight.values():
+                future.cancel()
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    def _walk_next(self, next_url: str, max_page: int = None) -> types.GeneratorType:
+        page = 1
+        while next_url and not (max_page and page >= max_page):
+            data = self._request(next_url, None)
+            page += 1
+            yield from data.get("results", [])
+            next_url = data.get("next")
+
+    def fetch_page(self, page: int, params: dict) -> dict:
+        """
+        Fetches a single page of the subscribed pulse feed.
+        :param page: 1-based page number
+        :param params: query parameters shared by every page of this walk
+        :return: decoded JSON page
+        """
+        return self._request(self.server + SUBSCRIBED, dict(params, page = page))
+
+    def cache_key(self, url: str, params) -> str:
+        """
+        :return: page cache key of a request, independent of the order the query parameters were given in
+        """
+        import requests
+        prepared = requests.Request("GET", url, params = sorted(params.items()) if params else None).prepare()
+        return f"{self._cacheNamespace}:{prepared.url}"
+
+    def _request(self, url: str, params) -> dict:
+        import requests
+        cacheKey = cached = None
+        headers = {}
+        if self.cache:
+            cacheKey = self.cache_key(url, params)
+            cached = self.cache.get(cacheKey)
+            if cached and cached.fresh:
+                start = time.perf_counter()
+                data = json.loads(cached.content)
+                with self._lock:
+                    self.cacheHits += 1
+                    self.decodeSeconds += time.perf_counter() - start
+                return data
+            if cached and cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached and cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        attempt = 0
+        while True:
+            self._wait_for_pause()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params = params, headers = headers, timeout = self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                status, retryAfter, error = None, None, e
+            else:
+                if response.status_code == 200:
+                    received = time.perf_counter()
+                    data = response.json()
+                    self._on_success(len(response.content), received - start, time.perf_counter() - received)
+                    if self.cache:
+                        self.cache.put(cacheKey, response.content, response.headers.get("ETag"),
+                                       response.headers.get("Last-Modified"))
+                    return data
+                if response.status_code == 304 and cached:
+                    received = time.perf_counter()
+                    data = json.loads(cached.content)
+                    self.cache.revalidated(cacheKey)
+                    self._on_success(0, received - start, time.perf_counter() - received)
+                    with self._lock:
+                        self.cacheRevalidated += 1
+                    return data
+                status, retryAfter, error = response.status_code, response.headers.get("Retry-After"), None
+                if status not in RETRY_STATUSES:
+                    raise FetchError(f"OTX returned HTTP {status} for {response.url}")
+
+            with self._lock:
+                self.requestSeconds += time.perf_counter() - start
+            attempt += 1
+            log.debug("Retrying %s (attempt %d, status: %s)", url, attempt, status or error)
+            if attempt > self.maxRetries:
+                raise FetchError(f"Giving up on {url} after {self.maxRetries} retries "
+                                 f"(last status: {status or error})")
+            self._on_throttle(attempt, retryAfter)
+
+    def _wait_for_pause(self) -> None:
+        delay = self._pauseUntil - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _on_success(self, size: int, request_seconds: float = 0.0, decode_seconds: float = 0.0) -> None:
+        with self._lock:
+            self.pagesFetched += 1
+            self.bytesReceived += size
+            self.requestSeconds += request_seconds
+            self.decodeSeconds += decode_seconds
+            # Additive increase: one more page in flight per full window of clean responses
+            self._successes += 1
+            if self._successes >= self.concurrency and self.concurrency < self.maxWorkers:
+                self.concurrency += 1
+                self._successes = 0
+
+    def _on_throttle(self, attempt: int, retry_after = None) -> None:
+        # Full jitter exponential backoff, unless the server told us exactly how long to wait
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(self.backoffCap, self.backoffBase * 2 ** attempt))
+        with self._lock:
+            self.retries += 1
+            # Multiplicative decrease, and hold every worker back so the whole pool backs off, not just this thread
+            self.concurrency = max(self.minWorkers, self.concurrency // 2)
+            log.debug("Throttled, backing off %.2fs with %d pages in flight", delay, self.concurrency)
+            self._successes = 0
+            self._pauseUntil = max(self._pauseUntil, time.monotonic() + delay)
+        self._wait_for_pause()
@@ -1,11 +1,300 @@
 import argparse
+import importlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+from datetime import datetime
+
 import otx
+import otxfetch
+import otxsimilar
+
+# Commands implemented here, the network ones import the OTX client and progress bars on first use
+COMMANDS = ("sync", "backfill", "rebuild", "status", "query", "duplicates", "stats")
+# Commands run by the main() of their own module, their arguments are passed through: command -> (module, help)
+DELEGATED_COMMANDS = {
+    "export": ("otxexport", "Export a table to JSONL, CSV, STIX 2.1, Parquet or Arrow"),
+    "changes": ("otxchanges", "Print the pulse changes recorded by syncs after a cursor"),
+    "partition": ("otxpartition", "Roll older pulses into partitions, apply retention, vacuum"),
+    "serve": ("otxserve", "Serve read-only pulse queries over HTTP"),
+    "match": ("otxmatch", "Match logs or indicator lists against the stored indicators"),
+}
+# Tables counted by the stats command
+STATS_TABLES = ("allpulses", "relevantpulses", "reference", "indicator", "pulse_indicator", "pulse_minhash",
+                "changelog", "sync_run")
+
+
+def _logging_arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log warnings and errors")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Also log debug messages")
+    return parser
+
+
+def _sync_arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("key", help="OTX API Key supplied from a valid OTX account")
+    parser.add_argument("--server", default=otxfetch.OTX_SERVER, help="OTX server to fetch pulses from")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum number of OTX pages fetched concurrently")
+    parser.add_argument("--page-cache", default=None,
+                        help="Cache OTX page responses in this SQLite file, e.g. for development runs or re-runs")
+    parser.add_argument("--page-cache-ttl", type=float, default=otxfetch.PAGE_CACHE_TTL,
+                        help="Seconds a cached page is used before it is revalidated with OTX")
+    parser.add_argument("--page-cache-mb", type=int, default=otxfetch.PAGE_CACHE_MAX_BYTES // 2 ** 20,
+                        help="Size bound of the page cache in MB, least recently used pages are evicted beyond it")
+    parser.add_argument("--profiles", default=None,
+                        help="JSON file of relevance profiles, defaults to relevance.json in the working directory")
+    parser.add_argument("--no-progress", action="store_true", help="Disable progress bars, e.g. for cron or log files")
+    parser.add_argument("--metrics-json", default=None, help="Write a JSON report of the sync run to this file")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="Write the sync run metrics to this file in Prometheus textfile collector format")
+    return parser
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Create and Maintain a local SQLite Database of OTX Pulses")
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="command")
+    common = _logging_arguments()
+    network = _sync_arguments()
+
+    sync = subparsers.add_parser("sync", parents=[common, network], help="Sync the pulse tables with OTX")
+    sync.add_argument("--backfill", action="store_true",
+                      help="Backfill the pulse history before syncing, resumes an interrupted backfill if there is one")
+    sync.add_argument("--backfill-since", default=None, help="Backfill pulses modified since this iso formatted date")
+    sync.add_argument("--window-days", type=int, default=None,
+                      help="Split the backfill into windows of this many days, each checkpointed on its own")
+    sync.add_argument("--daemon", action="store_true", help="Keep running and sync on an interval until signalled")
+    sync.add_argument("--interval", type=float, default=900, help="Initial seconds between syncs in daemon mode")
+    sync.add_argument("--min-interval", type=float, default=60, help="Shortest interval the daemon adapts down to")
+    sync.add_argument("--max-interval", type=float, default=3600, help="Longest interval the daemon adapts up to")
+    sync.add_argument("--serve", type=int, default=None, metavar="PORT",
+                      help="In daemon mode, also serve read-only pulse queries over HTTP on this port")
+    sync.add_argument("--serve-host", default="127.0.0.1", help="Address the query service listens on")
+
+    backfill = subparsers.add_parser("backfill", parents=[common, network],
+                                     help="Backfill the pulse history and sync, resumes an interrupted backfill")
+    backfill.add_argument("--since", default=None, help="Backfill pulses modified since this iso formatted date")
+    backfill.add_argument("--window-days", type=int, default=None,
+                          help="Split the backfill into windows of this many days, each checkpointed on its own")
+
+    rebuild = subparsers.add_parser("rebuild", parents=[common],
+                                    help="Rebuild the pulse DB offline from the raw pulse archive")
+    rebuild.add_argument("--profiles", default=None,
+                         help="JSON file of relevance profiles, defaults to relevance.json in the working directory")
+    rebuild.add_argument("--no-progress", action="store_true", help="Disable progress bars")
+
+    status = subparsers.add_parser("status", parents=[common],
+                                   help="Print the sync state as JSON, for scripts and health checks")
+    status.add_argument("--max-age", type=float, default=None, metavar="SECONDS",
+                        help="Exit with status 1 unless the last sync run completed within this many seconds")
+
+    query = subparsers.add_parser("query", parents=[common], help="Query the stored pulses, prints JSONL")
+    query.add_argument("--table", default="allpulses", choices=["allpulses", "relevantpulses"], help="Table to query")
+    lookup = query.add_mutually_exclusive_group()
+    lookup.add_argument("--search", default=None, metavar="TEXT", help="Full-text search pulse names, descriptions "
+                                                                       "and references, best match first")
+    lookup.add_argument("--indicator", default=None, metavar="VALUE", help="List the pulses an indicator appears in")
+    lookup.add_argument("--pulse", default=None, metavar="ID",
+                        help="Print one pulse with its attributes, references and indicators")
+    lookup.add_argument("--related", default=None, metavar="ID",
+                        help="List the pulses whose indicators are most like those of a pulse, most similar first")
+    query.add_argument("--min-similarity", type=float, default=0.0,
+                       help="Only list --related pulses sharing at least this estimated share (Jaccard) of indicators")
+    query.add_argument("--raw", action="store_true", help="Pass --search through as FTS5 query syntax")
+    query.add_argument("--type", default=None, help="Only match --indicator as this OTX indicator type, e.g. IPv4")
+    query.add_argument("--since", default=None, help="Only pulses modified at or after this iso formatted date")
+    query.add_argument("--until", default=None, help="Only pulses modified before this iso formatted date")
+    query.add_argument("--limit", type=int, default=100, help="Maximum number of results")
+    for attribute in otx.PULSE_ATTRIBUTES:
+        query.add_argument(f"--{attribute}", default=None, help=f"Only pulses with this {attribute}")
+
+    duplicates = subparsers.add_parser("duplicates", parents=[common],
+                                       help="Cluster pulses with near-identical indicator sets, prints JSONL")
+    duplicates.add_argument("--table", default="allpulses", choices=["allpulses", "relevantpulses"],
+                            help="Only cluster pulses of this table")
+    duplicates.add_argument("--threshold", type=float, default=otxsimilar.NEAR_DUPLICATE_SIMILARITY,
+                            help="Estimated Jaccard similarity of indicators at or above which pulses are clustered")
+    duplicates.add_argument("--since", default=None,
+                            help="Only the clusters of pulses modified since this iso formatted date, e.g. last sync")
+
+    subparsers.add_parser("stats", parents=[common], help="Print table row counts and database file sizes as JSON")
+
+    for command, (_, description) in DELEGATED_COMMANDS.items():
+        subparsers.add_parser(command, help=f"{description}, see {command} --help", add_help=False)
+    return parser
+
+
+def run_sync(args) -> None:
+    page_cache = None
+    if args.page_cache:
+        page_cache = otxfetch.PageCache(args.page_cache, ttl=args.page_cache_ttl,
+                                        max_bytes=args.page_cache_mb * 2 ** 20)
+    app_dir = otx.ApplicationDirector(args.key, server=args.server, max_workers=args.workers,
+                                      progress=not args.no_progress, profiles=args.profiles, page_cache=page_cache)
+    if args.command == "backfill":
+        app_dir.plan_backfill(since=args.since, window_days=args.window_days)
+    elif args.backfill or args.backfill_since or args.window_days:
+        app_dir.plan_backfill(since=args.backfill_since, window_days=args.window_days)
+    if args.command == "sync" and args.daemon:
+        import otxdaemon
+        scheduler = otxdaemon.SyncScheduler(app_dir, interval=args.interval, min_interval=args.min_interval,
+                                            max_interval=args.max_interval, metrics_json=args.metrics_json,
+                                            metrics_prom=args.metrics_prom)
+        scheduler.install_signal_handlers()
+        if args.serve is not None:
+            import otxserve
+            otxserve.QueryService(app_dir.dbHandler).serve_in_thread(args.serve_host, args.serve)
+        scheduler.run_forever()
+    else:
+        metrics = app_dir.update_alltables()
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+
+
+def status(db_handler: otx.SQLiteDBHandler, max_age: float = None) -> dict:
+    """
+    Reads the sync state without touching the pulse tables, so it costs the same on any size of database.
+    :param db_handler: SQLiteDBHandler to read from
+    :param max_age: seconds within which the last sync run has to have completed for the database to count as healthy
+    :return: dict of the sync watermarks, the latest sync runs, pending backfill windows and partitions
+    """
+    cursor = db_handler.currentCursor
+    cursor.execute("""PRAGMA user_version""")
+    schemaVersion = cursor.fetchone()[0]
+    cursor.execute("""SELECT table_name, watermark, last_updated FROM sync_state""")
+    sync = {table: {"watermark": watermark, "last_updated": lastUpdated}
+            for table, watermark, lastUpdated in cursor.fetchall()}
+    cursor.execute("""SELECT run_id, started, finished, status, inserted, updated FROM sync_run
+            WHERE run_id = (SELECT MAX(run_id) FROM sync_run)
+            OR run_id = (SELECT MAX(run_id) FROM sync_run WHERE status = 'completed') ORDER BY run_id DESC""")
+    runs = [dict(zip(("run_id", "started", "finished", "status", "inserted", "updated"), row))
+            for row in cursor.fetchall()]
+    completed = next((run for run in runs if run["status"] == "completed"), None)
+    cursor.execute("""SELECT MAX(change_id) FROM changelog""")
+    latestChange = cursor.fetchone()[0] or 0
+    cursor.execute("""SELECT COUNT(*), SUM(pulses) FROM partition_catalog""")
+    partitions, partitionedPulses = cursor.fetchone()
+
+    age = None
+    if completed:
+        age = round((datetime.today() - datetime.fromisoformat(completed["finished"])).total_seconds(), 1)
+    return {"database": otx.database_path(), "schema_version": schemaVersion, "sync": sync,
+            "last_run": runs[0] if runs else None, "last_completed_run": completed, "seconds_since_completed": age,
+            "healthy": completed is not None and (max_age is None or age <= max_age),
+            "backfill_windows_pending": len(db_handler.pending_backfill()), "latest_change": latestChange,
+            "partitions": partitions, "partitioned_pulses": partitionedPulses or 0}
+
+
+def stats(db_handler: otx.SQLiteDBHandler) -> dict:
+    """
+    :param db_handler: SQLiteDBHandler to read from
+    :return: dict of the row counts of the main tables, the members of every relevance profile and the file sizes
+    """
+    cursor = db_handler.currentCursor
+    rows = {}
+    for table in STATS_TABLES:
+        cursor.execute(f"""SELECT COUNT(*) FROM {table}""")
+        rows[table] = cursor.fetchone()[0]
+    # A read-only handler only attaches the archive if there is one
+    cursor.execute("""SELECT name FROM pragma_database_list WHERE name = 'archive'""")
+    if cursor.fetchone():
+        cursor.execute("""SELECT COUNT(*) FROM archive.pulse_archive""")
+        rows["pulse_archive"] = cursor.fetchone()[0]
+    cursor.execute("""SELECT profile, COUNT(*) FROM pulse_profile GROUP BY profile ORDER BY profile""")
+    profiles = dict(cursor.fetchall())
+    cursor.execute("""SELECT name FROM partition_catalog ORDER BY start_ts""")
+    paths = [otx.database_path(), otx.archive_path(), *(otx.partition_path(name) for (name,) in cursor.fetchall())]
+    files = {path: sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+             for path in paths}
+    return {"rows": rows, "profiles": profiles, "files": files, "total_bytes": sum(files.values())}
+
+
+def run_query(db_handler: otx.SQLiteDBHandler, args) -> list:
+    """
+    :return: list of result dicts of the query the arguments describe
+    """
+    if args.pulse:
+        pulse = db_handler.get_pulse(args.pulse, args.table)
+        if pulse is None:
+            return []
+        result = dict(zip(("pulse_id", "name", "created", "modified", "description", "author"), pulse))
+        result["attributes"] = db_handler.get_pulse_attributes(args.pulse)
+        result["references"] = [reference for _, reference in db_handler.find_references(args.pulse, limit = -1)]
+        result["indicators"] = [{"type": indicatorType, "indicator": indicator}
+                                for indicatorType, indicator in db_handler.get_pulse_indicators(args.pulse)]
+        return [result]
+    if args.related:
+        return [dict(zip(("pulse_id", "name", "similarity"), row))
+                for row in db_handler.related_pulses(args.related, args.table, args.limit, args.min_similarity)]
+    if args.search:
+        return [dict(zip(("pulse_id", "name", "snippet", "rank"), row))
+                for row in db_handler.search(args.search, args.table, args.limit, raw = args.raw)]
+    if args.indicator:
+        return [{"type": indicatorType, "pulse_id": pulseId}
+                for indicatorType, pulseId in db_handler.find_indicator(args.indicator, args.type)[:args.limit]]
+    filters = {attribute: getattr(args, attribute) for attribute in otx.PULSE_ATTRIBUTES
+               if getattr(args, attribute) is not None}
+    return [dict(zip(("pulse_id", "name", "created", "modified", "author"), row))
+            for row in db_handler.find_pulses(args.table, args.since, args.until, args.limit, **filters)]
+
+
+def main(argv: list = None) -> int:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = build_parser()
+    # Before the subcommands, otxmain.py <key> synced and otxmain.py --rebuild rebuilt
+    if argv and argv[0] not in COMMANDS and argv[0] not in DELEGATED_COMMANDS and argv[0] not in ("-h", "--help"):
+        argv = ["rebuild", *(arg for arg in argv if arg != "--rebuild")] if "--rebuild" in argv else ["sync", *argv]
+    if argv and argv[0] in DELEGATED_COMMANDS:
+        module, _ = DELEGATED_COMMANDS[argv[0]]
+        sys.argv[0] = f"{parser.prog} {argv[0]}"
+        return importlib.import_module(module).main(argv[1:]) or 0
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.command in ("sync", "backfill"):
+        run_sync(args)
+        return 0
+    if args.command == "rebuild":
+        otx.rebuild_database(progress=not args.no_progress, profiles=args.profiles)
+        return 0
 
-parser = argparse.ArgumentParser(description="Create and Maintain a local SQLite Database of OTX Pulses")
-parser.add_argument("key", help="OTX API Key supplied from a valid OTX account")
-args = parser.parse_args()
+    # The offline commands only read the local DB, the OTX client and progress bars are never imported for them. The
+    # database is opened read-only: they neither migrate nor refresh anything, nor wait for a running sync.
+    try:
+        dbHandler = otx.SQLiteDBHandler(read_only=True)
+    except otx.SchemaVersionError as e:
+        parser.exit(2, f"{parser.prog} {args.command}: error: {e}\n")
+    try:
+        if args.command == "status":
+            result = status(dbHandler, args.max_age)
+            json.dump(result, sys.stdout)
+            print()
+            return 0 if result["healthy"] else 1
+        if args.command == "stats":
+            json.dump(stats(dbHandler), sys.stdout)
+            print()
+            return 0
+        try:
+            if args.command == "duplicates":
+                results = [{"size": len(cluster), "pulses": [{"pulse_id": pulseId, "name": name}
+                                                             for pulseId, name in cluster]}
+                           for cluster in dbHandler.near_duplicates(args.threshold, args.table, args.since)]
+            else:
+                results = run_query(dbHandler, args)
+        except (ValueError, sqlite3.OperationalError) as e:
+            parser.exit(2, f"{parser.prog} {args.command}: error: {e}\n")
+        sys.stdout.writelines(json.dumps(result) + "\n" for result in results)
+        sys.stdout.flush()
+        return 0
+    finally:
+        dbHandler.close()
 
 
 if __name__ == '__main__':
-    app_dir = otx.ApplicationDirector(args.key)
-    app_dir.update_alltables()
+    sys.exit(main())
@@ -0,0 +1,329 @@
+import argparse
+import ipaddress
+import json
+import re
+import socket
+import sqlite3
+import sys
+import time
+import types
+
+from otx import attach_partitions, database_path, PARTITIONED, SQLITE_MAX_VARIABLES
+from otxdb import pathname2url
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the benchmark then reports no RSS
+    resource = None
+
+# Number of log lines whose hits are resolved to pulses with one query
+MATCH_BATCH_SIZE = 5000
+# Number of indicator -> pulse resolutions kept between batches, hits in logs repeat a lot
+PULSE_CACHE_SIZE = 100000
+
+# One pass over each line pulls out every token that could be an indicator. URLs come first so their host is not
+# consumed as a bare domain before the URL itself has been checked.
+TOKEN_PATTERN = re.compile(r"""
+    (?P<url>\b(?:https?|ftp)://(?:[^\s/@"'<>]*@)?(?P<urlhost>\[[0-9a-f:.]+\]|[^\s/:?#"'<>\[]+)[^\s"'<>]*)
+  | (?P<email>\b[\w.+-]+@(?:[a-z0-9-]+\.)+[a-z]{2,63}\b)
+  | (?P<cve>\bCVE-\d{4}-\d{4,}\b)
+  | (?P<ipv4>\b(?:\d{1,3}\.){3}\d{1,3}\b)
+  | (?P<ipv6>(?<![\w:])(?:[0-9a-f]{1,4}:){2,7}(?::|[0-9a-f]{1,4})(?![\w:]))
+  | (?P<hash>\b(?:[0-9a-f]{64}|[0-9a-f]{40}|[0-9a-f]{32})\b)
+  | (?P<domain>\b(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,62}\b)
+""", re.IGNORECASE | re.VERBOSE)
+
+
+def _add(index: dict, key, indicator_id: int) -> None:
+    """
+    Adds an indicator to one of the lookup dicts. A key almost always maps to a single indicator, so it is stored as a
+    bare int, only the rare key shared by several indicators is stored as a tuple.
+    """
+    existing = index.get(key)
+    if existing is None:
+        index[key] = indicator_id
+    elif isinstance(existing, tuple):
+        index[key] = existing + (indicator_id,)
+    elif existing != indicator_id:
+        index[key] = (existing, indicator_id)
+
+
+def _collect(hits: set, found) -> None:
+    if found is None:
+        return
+    if isinstance(found, tuple):
+        hits.update(found)
+    else:
+        hits.add(found)
+
+
+class IOCMatcher:
+    """
+    Matches log lines against every indicator in the pulse database. Exact indicators live in hash lookups keyed by
+    compact forms (IPv4 addresses as ints, file hashes as raw bytes), CIDR networks are looked up by masking the address
+    once per prefix length present, and domain indicators also match their subdomains by walking the labels of each
+    hostname. Hits are resolved to pulse IDs of the selected table in one query per batch of lines.
+    """
+
+    def __init__(self, db_path: str = None, table: str = "relevantpulses"):
+        if table not in ("allpulses", "relevantpulses"):
+            raise ValueError("Invalid Table. Select either allpulses or relevantpulses.")
+        self.table = table
+        uri = f"file:{pathname2url(db_path or database_path())}?mode=ro"
+        self.connection = sqlite3.connect(uri, uri = True, check_same_thread = False)
+
+        self.linesRead = 0
+        self._pulseCache = {}
+        # PRAGMA data_version of the last refresh, it changes whenever another connection, i.e. a sync, commits
+        self._dataVersion = None
+        # PRAGMA schema_version of the last refresh, it changes when the indicator table is dropped and rebuilt
+        self._schemaVersion = None
+        self._clear()
+        self.refresh()
+
+    def _clear(self) -> None:
+        self.ipv4 = {}
+        self.ipv6 = {}
+        self.hashes = {}
+        self.hosts = {}
+        self.domains = {}
+        self.urls = {}
+        self.other = {}
+        # (version, prefix length) -> {network int >> host bits: indicator id}
+        self.networks = {}
+
+        self.highWater = 0
+        self.indicatorCount = 0
+
+    def refresh(self) -> int:
+        """
+        Catches up with the syncs committed since the last refresh, costing a single pragma when there were none.
+        Indicator IDs only ever grow, so this reads just the new indicator rows instead of rebuilding the matcher, and
+        the cached pulse resolutions are dropped, as a sync may also link already loaded indicators to new pulses. If
+        indicators were removed or the table was rebuilt, loaded IDs may point elsewhere and everything is reloaded.
+        :return: number of indicators loaded
+        """
+        dataVersion = self.connection.execute("""PRAGMA data_version""").fetchone()[0]
+        if dataVersion == self._dataVersion:
+            return 0
+        self._dataVersion = dataVersion
+        self._pulseCache.clear()
+        # A roll or drop commits too, pulses are resolved through the partitions of the moment
+        attach_partitions(self.connection)
+
+        schemaVersion = self.connection.execute("""PRAGMA schema_version""").fetchone()[0]
+        kept = self.connection.execute("""SELECT COUNT(*) FROM indicator WHERE indicator_id <= ?""",
+                                       (self.highWater,)).fetchone()[0]
+        if schemaVersion != self._schemaVersion or kept != self.indicatorCount:
+            self._clear()
+        self._schemaVersion = schemaVersion
+
+        cursor = self.connection.execute("""SELECT i.indicator_id, t.name, i.indicator FROM indicator i
+                JOIN indicator_type t ON t.type_id = i.type_id WHERE i.indicator_id > ? ORDER BY i.indicator_id""",
+                                         (self.highWater,))
+        loaded = 0
+        for indicatorId, indicatorType, indicator in cursor:
+            self._load(indicatorId, indicatorType, indicator)
+            self.highWater = indicatorId
+            loaded += 1
+        self.indicatorCount += loaded
+        return loaded
+
+    def _load(self, indicator_id: int, indicator_type: str, indicator: str) -> None:
+        try:
+            if indicator_type == "IPv4":
+                _add(self.ipv4, int(ipaddress.IPv4Address(indicator)), indicator_id)
+            elif indicator_type == "IPv6":
+                _add(self.ipv6, int(ipaddress.IPv6Address(indicator)), indicator_id)
+            elif indicator_type == "CIDR":
+                network = ipaddress.ip_network(indicator, strict = False)
+                key = (network.version, network.prefixlen)
+                hostBits = network.max_prefixlen - network.prefixlen
+                _add(self.networks.setdefault(key, {}), int(network.network_address) >> hostBits, indicator_id)
+            elif indicator_type.startswith("FileHash"):
+                _add(self.hashes, bytes.fromhex(indicator), indicator_id)
+            elif indicator_type == "domain":
+                _add(self.domains, indicator.lower().rstrip("."), indicator_id)
+            elif indicator_type == "hostname":
+                _add(self.hosts, indicator.lower().rstrip("."), indicator_id)
+            elif indicator_type in ("URL", "URI"):
+                _add(self.urls, indicator, indicator_id)
+            else:
+                _add(self.other, indicator.lower(), indicator_id)
+        except ValueError:
+            # Malformed indicator (e.g. a "CIDR" that is not one), keep it matchable as plain text
+            _add(self.other, indicator.lower(), indicator_id)
+
+    def _match_ip(self, hits: set, address: int, version: int) -> None:
+        _collect(hits, (self.ipv4 if version == 4 else self.ipv6).get(address))
+        bits = 32 if version == 4 else 128
+        for (networkVersion, prefixLength), networks in self.networks.items():
+            if networkVersion == version:
+                _collect(hits, networks.get(address >> (bits - prefixLength)))
+
+    def _match_host(self, hits: set, host: str) -> None:
+        host = host.lower().rstrip(".")
+        _collect(hits, self.hosts.get(host))
+        # A domain indicator covers itself and every subdomain below it
+        while True:
+            _collect(hits, self.domains.get(host))
+            dot = host.find(".")
+            if dot < 0:
+                return
+            host = host[dot + 1:]
+
+    def _match_url_host(self, hits: set, host: str) -> None:
+        if host.startswith("["):
+            try:
+                self._match_ip(hits, int(ipaddress.IPv6Address(host.strip("[]"))), 6)
+            except ValueError:
+                pass
+            return
+        if host[-1:].isdigit():
+            try:
+                self._match_ip(hits, int.from_bytes(socket.inet_aton(host), "big"), 4)
+                return
+            except OSError:
+                pass
+        self._match_host(hits, host)
+
+    def match_line(self, line: str) -> set:
+        """
+        :param line: a single log line
+        :return: set of the indicator IDs found in the line
+        """
+        hits = set()
+        for token in TOKEN_PATTERN.finditer(line):
+            kind = token.lastgroup
+            value = token.group()
+            if kind == "ipv4":
+                try:
+                    self._match_ip(hits, int.from_bytes(socket.inet_aton(value), "big"), 4)
+                except OSError:
+                    continue
+            elif kind == "domain":
+                self._match_host(hits, value)
+            elif kind == "hash":
+                _collect(hits, self.hashes.get(bytes.fromhex(value)))
+            elif kind == "url":
+                _collect(hits, self.urls.get(value))
+                self._match_url_host(hits, token.group("urlhost"))
+            elif kind == "ipv6":
+                try:
+                    self._match_ip(hits, int(ipaddress.IPv6Address(value)), 6)
+                except ValueError:
+                    continue
+            else:
+                _collect(hits, self.other.get(value.lower()))
+        return hits
+
+    def resolve_pulses(self, indicator_ids) -> dict:
+        """
+        :param indicator_ids: iterable of indicator IDs
+        :return: dict of indicator ID to the list of pulse IDs of the selected table it appears in, partitions included
+        """
+        resolved = {}
+        missing = []
+        for indicatorId in indicator_ids:
+            if indicatorId in self._pulseCache:
+                resolved[indicatorId] = self._pulseCache[indicatorId]
+            else:
+                missing.append(indicatorId)
+
+        for start in range(0, len(missing), SQLITE_MAX_VARIABLES):
+            chunk = missing[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            found = {indicatorId: [] for indicatorId in chunk}
+            for indicatorId, pulseId in self.connection.execute(f"""SELECT l.indicator_id, l.pulse_id
+                    FROM pulse_indicator_all l JOIN {PARTITIONED.get(self.table, self.table)} p 
+                    ON p.pulse_id = l.pulse_id WHERE l.indicator_id IN ({placeholders})""", chunk):
+                found[indicatorId].append(pulseId)
+            if len(self._pulseCache) + len(found) > PULSE_CACHE_SIZE:
+                self._pulseCache.clear()
+            self._pulseCache.update(found)
+            resolved.update(found)
+        return resolved
+
+    def match_lines(self, lines, batch_size: int = MATCH_BATCH_SIZE) -> types.GeneratorType:
+        """
+        Matches a stream of log lines, e.g. an open file or sys.stdin, in batches. The matcher is refreshed before every
+        batch of lines is matched, so a long-running stream (tail -F access.log | otxmatch.py) picks up every sync
+        committed meanwhile, whether by a daemon or a scheduled sync in another process.
+        :param lines: iterable of log lines
+        :param batch_size: number of lines whose hits are resolved to pulses together
+        :return: Generator of (line number, line, sorted list of pulse IDs) for every line that matched a pulse
+        """
+        batch = []
+        lineNumber = 0
+        for lineNumber, line in enumerate(lines, start = 1):
+            if (lineNumber - 1) % batch_size == 0:
+                self.refresh()
+            hits = self.match_line(line)
+            if hits:
+                batch.append((lineNumber, line, hits))
+            if lineNumber % batch_size == 0 and batch:
+                yield from self._resolve_batch(batch)
+                batch = []
+        if batch:
+            yield from self._resolve_batch(batch)
+        self.linesRead = lineNumber
+
+    def _resolve_batch(self, batch: list) -> types.GeneratorType:
+        resolved = self.resolve_pulses({indicatorId for _, _, hits in batch for indicatorId in hits})
+        for lineNumber, line, hits in batch:
+            pulseIds = sorted({pulseId for indicatorId in hits for pulseId in resolved.get(indicatorId, ())})
+            if pulseIds:
+                yield lineNumber, line, pulseIds
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: peak resident set size of this process in MiB, or None where it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Match log lines against the indicators of the local OTX pulse DB")
+    parser.add_argument("logfile", nargs="?", default="-", help="Log file to match, defaults to stdin")
+    parser.add_argument("--db", default=None, help="Path of the pulse database")
+    parser.add_argument("--table", default="relevantpulses", choices=["allpulses", "relevantpulses"],
+                        help="Only report pulses of this table")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Only count matches and report throughput and memory as JSON on stderr")
+    args = parser.parse_args(argv)
+
+    loadStart = time.perf_counter()
+    matcher = IOCMatcher(args.db, table = args.table)
+    loadTime = time.perf_counter() - loadStart
+
+    logFile = sys.stdin if args.logfile == "-" else open(args.logfile, encoding = "utf-8", errors = "replace")
+    matchStart = time.perf_counter()
+    matchedLines = 0
+    with logFile:
+        for lineNumber, line, pulseIds in matcher.match_lines(logFile):
+            matchedLines += 1
+            if not args.benchmark:
+                print(json.dumps({"line": lineNumber, "pulses": pulseIds, "text": line.rstrip("\n")}))
+    matchTime = time.perf_counter() - matchStart
+
+    if args.benchmark:
+        lines = matcher.linesRead
+        print(json.dumps({
+            "indicators": matcher.indicatorCount,
+            "load_seconds": round(loadTime, 3),
+            "lines": lines,
+            "matched_lines": matchedLines,
+            "match_seconds": round(matchTime, 3),
+            "lines_per_second": round(lines / matchTime) if matchTime else None,
+            "peak_rss_mb": peak_rss_mb(),
+        }), file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
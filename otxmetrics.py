@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+# Prefix of every exported Prometheus metric
+METRIC_PREFIX = "otx_sync"
+
+
+class RunMetrics:
+    """
+    Wall time per stage and counters of a single sync run. Stages nest freely and may run on several threads at once
+    (page decoding does), their seconds are summed, so stage times can add up to more than the run's duration.
+    """
+
+    def __init__(self, run: str = "sync"):
+        self.run = run
+        self.started = datetime.now()
+        self.finished = None
+        self.stages = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+        self._duration = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the enclosed block into the named stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self) -> "RunMetrics":
+        """
+        Marks the end of the run, the duration is frozen from here on.
+        """
+        if self._duration is None:
+            self._duration = time.perf_counter() - self._start
+            self.finished = datetime.now()
+        return self
+
+    @property
+    def duration(self) -> float:
+        return self._duration if self._duration is not None else time.perf_counter() - self._start
+
+    def report(self) -> dict:
+        """
+        :return: JSON serializable run report
+        """
+        duration = self.duration
+        with self._lock:
+            stages = {name: round(seconds, 6) for name, seconds in sorted(self.stages.items())}
+            counters = dict(sorted(self.counters.items()))
+        received = counters.get("pulses_received", 0)
+        return {
+            "run": self.run,
+            "started": self.started.isoformat(),
+            "finished": self.finished.isoformat() if self.finished else None,
+            "duration_seconds": round(duration, 6),
+            "pulses_per_second": round(received / duration, 1) if duration else None,
+            "stages": stages,
+            "counters": counters,
+        }
+
+    def write_json(self, path: str) -> None:
+        """
+        Writes the run report as JSON, replacing the file atomically.
+        """
+        _write_atomic(path, json.dumps(self.report(), indent = 2) + "\n")
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Writes the run report in the Prometheus text format, for the node_exporter textfile collector. The file is
+        replaced atomically so the collector never reads a half written run.
+        """
+        report = self.report()
+        run = report["run"]
+        lines = [
+            f"# HELP {METRIC_PREFIX}_last_run_timestamp_seconds Unix time the last sync run finished.",
+            f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge",
+            f'{METRIC_PREFIX}_last_run_timestamp_seconds{{run="{run}"}} '
+            f'{(self.finished or datetime.now()).timestamp():.3f}',
+            f"# HELP {METRIC_PREFIX}_duration_seconds Wall time of the last sync run.",
+            f"# TYPE {METRIC_PREFIX}_duration_seconds gauge",
+            f'{METRIC_PREFIX}_duration_seconds{{run="{run}"}} {report["duration_seconds"]}',
+            f"# HELP {METRIC_PREFIX}_stage_seconds Time spent per stage of the last sync run.",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds gauge",
+        ]
+        lines += [f'{METRIC_PREFIX}_stage_seconds{{run="{run}",stage="{name}"}} {seconds}'
+                  for name, seconds in report["stages"].items()]
+        for name, value in report["counters"].items():
+            lines += [f"# TYPE {METRIC_PREFIX}_{name} gauge", f'{METRIC_PREFIX}_{name}{{run="{run}"}} {value}']
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _write_atomic(path: str, text: str) -> None:
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding = "utf-8") as f:
+        f.write(text)
+    os.replace(temporary, path)
@@ -0,0 +1,310 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from otx import (attach_partitions, database_path, delete_signatures, detach_partitions, epoch_seconds,
+                 partition_path, PARTITION_TABLES, PULSE_ATTRIBUTES, SQLiteDBHandler)
+from otxdb import configure_connection, connect_reader
+
+log = logging.getLogger(__name__)
+
+PERIODS = ["year", "quarter"]
+# Pulses modified longer ago than this are rolled into partitions unless told otherwise
+ROLL_AFTER_DAYS = 365
+PARTITION_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS {schema}.allpulses (pulse_id TEXT PRIMARY KEY NOT NULL, name TEXT, created TEXT,
+            modified TEXT, description TEXT, author TEXT, created_ts INTEGER, modified_ts INTEGER)""",
+    """CREATE INDEX IF NOT EXISTS {schema}.idx_allpulses_modified_ts ON allpulses (modified_ts)""",
+    """CREATE TABLE IF NOT EXISTS {schema}.reference (pulse_id TEXT NOT NULL, reference TEXT)""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS {schema}.idx_reference_pulse_reference ON reference (pulse_id, reference)""",
+    """CREATE TABLE IF NOT EXISTS {schema}.pulse_indicator (indicator_id INTEGER NOT NULL, pulse_id TEXT NOT NULL,
+            PRIMARY KEY (indicator_id, pulse_id)) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS {schema}.idx_pulse_indicator_pulse ON pulse_indicator (pulse_id)""",
+]
+
+
+def period_start(seconds: int, period: str) -> datetime:
+    moment = datetime.fromtimestamp(seconds, timezone.utc)
+    month = 1 if period == "year" else (moment.month - 1) // 3 * 3 + 1
+    return datetime(moment.year, month, 1, tzinfo = timezone.utc)
+
+
+def next_period(start: datetime, period: str) -> datetime:
+    if period == "year" or start.month == 10:
+        return datetime(start.year + 1, 1, 1, tzinfo = timezone.utc)
+    return datetime(start.year, start.month + 3, 1, tzinfo = timezone.utc)
+
+
+def partition_name(start: datetime, period: str) -> str:
+    """
+    :param start: start of the period
+    :param period: one of PERIODS
+    :return: name of the partition of the period, e.g. "2019" or "2019q3"
+    """
+    return str(start.year) if period == "year" else f"{start.year}q{(start.month - 1) // 3 + 1}"
+
+
+class PartitionManager:
+    """
+    Keeps the pulse database small by rolling the allpulses, reference and pulse_indicator rows of pulses last modified
+    long ago into one database file per year or quarter. The pulse database keeps the recent, hot rows. The readers of
+    the handler, the matcher and the exports attach the partitions behind TEMP views that read like the unpartitioned
+    tables (see otx.attach_partitions), and retention drops whole partition files instead of deleting rows.
+
+    A pulse lives in exactly one place: when a partitioned pulse is modified the sync writes its new version to the
+    pulse database, and rows of a pulse present there shadow its rows in any partition until the next roll deletes them.
+    Maintenance runs on the handler's own connection and must not overlap a sync of the same handler.
+    """
+
+    def __init__(self, db_handler: SQLiteDBHandler = None):
+        self.dbHandler = db_handler or SQLiteDBHandler()
+
+    def partitions(self, since: int = None, until: int = None) -> list:
+        """
+        :param since: only partitions covering modified times at or after this epoch second
+        :param until: only partitions covering modified times before this epoch second
+        :return: list of (name, period, start_ts, end_ts, pulses, updated) tuples, oldest first
+        """
+        return self.dbHandler.currentCursor.execute("""SELECT name, period, start_ts, end_ts, pulses, updated
+                FROM partition_catalog WHERE end_ts > ? AND start_ts < ? ORDER BY start_ts""",
+                                                    (since or 0, until or 2 ** 62)).fetchall()
+
+    def _attach(self, name: str) -> None:
+        """
+        Attaches a partition to the handler's connection as "part", creating it if needed. Must be called outside a
+        transaction.
+        """
+        connection = self.dbHandler.currentConnection
+        connection.execute("""ATTACH DATABASE ? AS part""", (partition_path(name),))
+        # Partitions are written once per roll and read rarely, SQLite's default cache is plenty. A rollback journal
+        # leaves no WAL behind for the read-only connections of history() to trip over.
+        configure_connection(connection, schema = "part", cache_size_kib = 2000)
+        connection.execute("""PRAGMA part.journal_mode = DELETE""")
+        for statement in PARTITION_SCHEMA:
+            connection.execute(statement.format(schema = "part"))
+        connection.commit()
+
+    def _detach(self) -> None:
+        connection = self.dbHandler.currentConnection
+        connection.executescript("""PRAGMA part.incremental_vacuum""")
+        connection.execute("""DETACH DATABASE part""")
+
+    def _flush(self) -> None:
+        if self.dbHandler.writer is not None:
+            self.dbHandler.writer.flush()
+        self.dbHandler.currentConnection.commit()
+        # The partitions are rewritten through "part", readers of the handler's connection attach them again after
+        detach_partitions(self.dbHandler.currentConnection)
+
+    def _prune_shadowed(self) -> int:
+        """
+        Deletes the partitioned rows of pulses that have since been written to the pulse database again.
+        :return: number of pulses pruned
+        """
+        connection = self.dbHandler.currentConnection
+        pruned = 0
+        for name, *_ in self.partitions():
+            self._attach(name)
+            try:
+                with connection:
+                    for table in ("reference", "pulse_indicator"):
+                        connection.execute(f"""DELETE FROM part.{table} WHERE pulse_id IN
+                                (SELECT p.pulse_id FROM part.allpulses p JOIN main.allpulses m USING (pulse_id))""")
+                    removed = connection.execute("""DELETE FROM part.allpulses WHERE pulse_id IN
+                            (SELECT pulse_id FROM main.allpulses)""").rowcount
+                    if removed:
+                        connection.execute("""UPDATE main.partition_catalog SET pulses = pulses - ?, updated = ?
+                                WHERE name = ?""", (removed, datetime.today().isoformat(), name))
+                        pruned += removed
+            finally:
+                self._detach()
+        return pruned
+
+    def roll(self, older_than_days: float = ROLL_AFTER_DAYS, period: str = "year") -> dict:
+        """
+        Moves the rows of pulses last modified more than older_than_days ago out of the pulse database into their
+        partitions, one transaction per partition, and returns the freed pages to the file system.
+        :param older_than_days: age of the newest pulses to roll
+        :param period: one of PERIODS, the time span of each partition created
+        :return: dict of partition name to number of pulses moved into it
+        """
+        if period not in PERIODS:
+            raise ValueError(f"Unknown partition period {period}, choose from {', '.join(PERIODS)}")
+        self._flush()
+        connection = self.dbHandler.currentConnection
+        cutoff = int(time.time() - older_than_days * 86400)
+        pruned = self._prune_shadowed()
+        if pruned:
+            log.info("Pruned %d partitioned pulses superseded by newer versions", pruned)
+
+        oldest = connection.execute("""SELECT MIN(modified_ts) FROM main.allpulses WHERE modified_ts < ?""",
+                                    (cutoff,)).fetchone()[0]
+        connection.execute("""CREATE TEMP TABLE IF NOT EXISTS partition_move (pulse_id TEXT PRIMARY KEY)
+                WITHOUT ROWID""")
+        moved = {}
+        start = period_start(oldest, period) if oldest is not None else None
+        while start is not None and start.timestamp() < cutoff:
+            end = next_period(start, period)
+            name = partition_name(start, period)
+            rangeStart, rangeEnd = int(start.timestamp()), int(end.timestamp())
+            start = end
+            # Partitions of the other period may already cover part of this one, they are left as they are
+            existing = connection.execute("""SELECT period FROM main.partition_catalog WHERE name = ?""",
+                                          (name,)).fetchone()
+            if existing and existing[0] != period:
+                continue
+            with connection:
+                connection.execute("""DELETE FROM temp.partition_move""")
+                count = connection.execute("""INSERT INTO temp.partition_move SELECT pulse_id FROM main.allpulses
+                        WHERE modified_ts >= ? AND modified_ts < ?""", (rangeStart, min(rangeEnd, cutoff))).rowcount
+            if not count:
+                continue
+
+            self._attach(name)
+            try:
+                with connection:
+                    for table, columns in PARTITION_TABLES.items():
+                        columnList = ", ".join(columns)
+                        connection.execute(f"""INSERT OR REPLACE INTO part.{table} ({columnList}) SELECT {columnList}
+                                FROM main.{table} WHERE pulse_id IN (SELECT pulse_id FROM temp.partition_move)""")
+                        connection.execute(f"""DELETE FROM main.{table}
+                                WHERE pulse_id IN (SELECT pulse_id FROM temp.partition_move)""")
+                    connection.execute("""INSERT INTO main.partition_catalog (name, period, start_ts, end_ts, pulses,
+                            updated) VALUES (?, ?, ?, ?, (SELECT COUNT(*) FROM part.allpulses), ?)
+                            ON CONFLICT (name) DO UPDATE SET pulses = excluded.pulses, updated = excluded.updated""",
+                                       (name, period, rangeStart, rangeEnd, datetime.today().isoformat()))
+            finally:
+                self._detach()
+            moved[name] = count
+            log.info("Rolled %d pulses into partition %s", count, name)
+
+        freed = self.dbHandler.vacuum()
+        log.info("Rolled %d pulses into %d partitions, %d pages freed", sum(moved.values()), len(moved), freed)
+        return moved
+
+    def drop(self, before: str) -> list:
+        """
+        Retention: drops every partition that only covers modified times before a cutoff. The partition files are
+        deleted whole, only the attribute, profile, search and MinHash rows of their pulses are deleted row by row, in
+        the transaction that logs the removal of the pulses from allpulses and relevantpulses in the changelog.
+        :param before: iso formatted timestamp
+        :return: list of the names of the dropped partitions
+        """
+        cutoff = epoch_seconds(before)
+        if cutoff is None:
+            raise ValueError(f"{before} is not an iso formatted timestamp")
+        self._flush()
+        connection = self.dbHandler.currentConnection
+        names = [name for name, _, _, end, *_ in self.partitions(until = cutoff) if end <= cutoff]
+        if not names:
+            return []
+
+        connection.execute("""CREATE TEMP TABLE IF NOT EXISTS partition_drop (pulse_id TEXT PRIMARY KEY, modified TEXT)
+                WITHOUT ROWID""")
+        with connection:
+            connection.execute("""DELETE FROM temp.partition_drop""")
+        for name in names:
+            self._attach(name)
+            try:
+                # Pulses written to the pulse database again live on there
+                with connection:
+                    connection.execute("""INSERT OR IGNORE INTO temp.partition_drop SELECT pulse_id, modified
+                            FROM part.allpulses WHERE pulse_id NOT IN (SELECT pulse_id FROM main.allpulses)""")
+            finally:
+                self._detach()
+        self.dbHandler.remove_partitions(names)
+
+        with connection:
+            dropped = """(SELECT pulse_id FROM temp.partition_drop)"""
+            changes = [("allpulses", pulseId, "delete", modified, None) for pulseId, modified
+                       in connection.execute("""SELECT pulse_id, modified FROM temp.partition_drop""")]
+            changes.extend(("relevantpulses", pulseId, "delete", modified, None) for pulseId, modified
+                           in connection.execute(f"""SELECT pulse_id, modified FROM relevantpulses 
+                           WHERE pulse_id IN {dropped}"""))
+            self.dbHandler.log_changes(changes)
+            for junctionTable, _ in PULSE_ATTRIBUTES.values():
+                connection.execute(f"""DELETE FROM {junctionTable} WHERE pulse_id IN {dropped}""")
+            connection.execute(f"""DELETE FROM relevantpulses WHERE pulse_id IN {dropped}""")
+            connection.execute(f"""DELETE FROM pulse_fts WHERE rowid IN
+                    (SELECT docid FROM pulse_search_doc WHERE pulse_id IN {dropped})""")
+            connection.execute(f"""DELETE FROM pulse_search_doc WHERE pulse_id IN {dropped}""")
+            delete_signatures(connection.cursor(), [pulseId for (pulseId,) in connection.execute(
+                """SELECT pulse_id FROM temp.partition_drop""")])
+            connection.execute("""DELETE FROM temp.partition_drop""")
+        freed = self.dbHandler.vacuum()
+        log.info("Dropped partitions %s, %d pages freed", ", ".join(names), freed)
+        return names
+
+    @contextmanager
+    def history(self, since: str = None, until: str = None):
+        """
+        Opens a read-only connection on which allpulses_all, reference_all and pulse_indicator_all are TEMP views over
+        the pulse database and the partitions covering the requested time range, e.g.
+            with manager.history(since="2019-01-01") as connection:
+                connection.execute("SELECT COUNT(*) FROM allpulses_all WHERE modified_ts >= ?", ...)
+        Only the partitions overlapping the range are attached, which bounds a query to the files it needs and keeps
+        the number attached below SQLite's limit.
+        :param since: iso formatted timestamp, start of the modified time range
+        :param until: iso formatted timestamp, end of the modified time range
+        """
+        bounds = []
+        for bound in (since, until):
+            seconds = epoch_seconds(bound) if bound else None
+            if bound and seconds is None:
+                raise ValueError(f"{bound} is not an iso formatted timestamp")
+            bounds.append(seconds)
+        names = [row[0] for row in self.partitions(*bounds)]
+        connection = connect_reader(database_path())
+        try:
+            attach_partitions(connection, names)
+            yield connection
+        finally:
+            connection.close()
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Partition the local OTX pulse DB by time and apply retention")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List the partitions")
+    roll = subparsers.add_parser("roll", help="Move older pulses out of the pulse DB into partitions")
+    roll.add_argument("--older-than-days", type=float, default=ROLL_AFTER_DAYS,
+                      help="Roll pulses last modified longer ago than this")
+    roll.add_argument("--period", default="year", choices=PERIODS, help="Time span of each partition")
+    drop = subparsers.add_parser("drop", help="Drop partitions older than a retention cutoff")
+    cutoff = drop.add_mutually_exclusive_group(required=True)
+    cutoff.add_argument("--before", default=None, help="Drop partitions ending before this iso formatted date")
+    cutoff.add_argument("--keep-days", type=float, default=None,
+                        help="Drop partitions ending more than this many days ago")
+    vacuum = subparsers.add_parser("vacuum", help="Return free pages of the pulse DB and archive to the file system")
+    vacuum.add_argument("--full", action="store_true",
+                        help="Switch databases created without incremental auto vacuum over, rewrites them once")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    manager = PartitionManager()
+    try:
+        if args.command == "list":
+            result = [dict(zip(("name", "period", "start_ts", "end_ts", "pulses", "updated"), row))
+                      for row in manager.partitions()]
+        elif args.command == "roll":
+            result = manager.roll(args.older_than_days, args.period)
+        elif args.command == "drop":
+            before = args.before or datetime.fromtimestamp(time.time() - args.keep_days * 86400).isoformat()
+            result = manager.drop(before)
+        else:
+            result = {"pages_freed": manager.dbHandler.vacuum(full = args.full)}
+    except ValueError as e:
+        parser.exit(2, f"{parser.prog}: error: {e}\n")
+    finally:
+        manager.dbHandler.close()
+    json.dump(result, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    main()
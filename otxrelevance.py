@@ -0,0 +1,125 @@
+import hashlib
+import json
+import re
+
+# Profile whose members make up relevantpulses
+RELEVANT_PROFILE = "aviation"
+# Rule fields matched against pulse attributes: rule field -> pulse key. Values compare case-insensitively.
+VALUE_FIELDS = {
+    "industries": "industries",
+    "tags": "tags",
+    "countries": "targeted_countries",
+    "adversaries": "adversary",
+}
+# Pulse keys whose text keyword rules are searched in
+KEYWORD_FIELDS = ("name", "tags")
+# Built-in profiles, a rule file adds to them and overrides them by name
+DEFAULT_PROFILES = {
+    "aviation": {
+        "description": "Threats to aerospace manufacturers, airlines, airports and air traffic systems",
+        "rules": [
+            {"industries": ["Aerospace", "Aviation"]},
+            {"keywords": ["aviation", "airline", "airlines", "airport", "airports", "aircraft", "aerospace", "avionics",
+                          "airspace", "air traffic", "ADS-B", "ACARS", "FAA", "EASA", "ICAO", "IATA"]},
+        ],
+    },
+}
+
+
+def _strings(values) -> list:
+    """
+    Flattens a pulse attribute into strings, OTX sends some attributes as a single string and others as lists.
+    """
+    if not values:
+        return []
+    if isinstance(values, str):
+        return [values]
+    return [value for value in values if isinstance(value, str)]
+
+
+def load_profiles(path: str) -> dict:
+    """
+    Reads a rule file and merges it over DEFAULT_PROFILES. The file is a JSON object of profile name to profile, a
+    profile being {"description": ..., "rules": [...]}. A pulse belongs to a profile when any of its rules matches, and
+    a rule matches when every field it has matches at least one of its values, e.g.
+    {"industries": ["Transportation"], "keywords": ["port", "vessel"]}. A profile set to null removes a built-in one.
+    :param path: path of the JSON rule file
+    :return: dict of profile name to profile
+    """
+    with open(path, encoding = "utf-8") as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, dict):
+        raise ValueError(f"{path} must hold a JSON object of profile name to profile")
+    merged = dict(DEFAULT_PROFILES)
+    for name, profile in profiles.items():
+        if profile is None:
+            merged.pop(name, None)
+        else:
+            merged[name] = profile
+    return merged
+
+
+class RelevanceMatcher:
+    """
+    Sorts pulses into relevance profiles. The rules of every profile are compiled once into lookup dicts of value to
+    the rule conditions it satisfies and a single regex union of every keyword, so a pulse is matched against all
+    profiles in one pass over its attributes and one regex scan of its name and tags.
+    """
+
+    def __init__(self, profiles: dict = None):
+        self.profiles = DEFAULT_PROFILES if profiles is None else profiles
+        # Profile name -> hash of its rules, to tell which profiles changed since their members were stored
+        self.fingerprints = {}
+        # Rule field -> {casefolded value: condition ids}
+        self._values = {field: {} for field in VALUE_FIELDS}
+        # Casefolded keyword -> condition ids
+        self._keywords = {}
+        # (profile, condition ids that all have to be satisfied)
+        self._rules = []
+
+        condition = 0
+        for name, profile in self.profiles.items():
+            if not isinstance(profile, dict) or not isinstance(profile.get("rules"), list):
+                raise ValueError(f"Relevance profile {name} needs a list of rules")
+            self.fingerprints[name] = hashlib.sha256(json.dumps(profile["rules"], sort_keys = True)
+                                                     .encode()).hexdigest()
+            for rule in profile["rules"]:
+                unknown = set(rule) - set(VALUE_FIELDS) - {"keywords"}
+                if unknown or not rule:
+                    raise ValueError(f"Relevance profile {name} has a rule with no or unknown fields: {rule}, choose "
+                                     f"from {', '.join(VALUE_FIELDS)}, keywords")
+                required = set()
+                for field, values in rule.items():
+                    index = self._keywords if field == "keywords" else self._values[field]
+                    for value in _strings(values):
+                        index.setdefault(value.casefold(), set()).add(condition)
+                    required.add(condition)
+                    condition += 1
+                self._rules.append((name, frozenset(required)))
+
+        self._pattern = None
+        if self._keywords:
+            # Longest first so a keyword is not cut short by another it starts with
+            keywords = sorted(self._keywords, key = len, reverse = True)
+            self._pattern = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, keywords)) + r")(?!\w)", re.IGNORECASE)
+
+    @classmethod
+    def from_file(cls, path: str) -> "RelevanceMatcher":
+        return cls(load_profiles(path))
+
+    def match(self, pulse: dict) -> set:
+        """
+        :param pulse: OTX pulse dict, or a dict of the same keys rebuilt from the DB
+        :return: set of the names of the profiles the pulse belongs to
+        """
+        satisfied = set()
+        for field, key in VALUE_FIELDS.items():
+            index = self._values[field]
+            if index:
+                for value in _strings(pulse.get(key)):
+                    satisfied.update(index.get(value.casefold(), ()))
+        if self._pattern:
+            text = "\n".join(value for key in KEYWORD_FIELDS for value in _strings(pulse.get(key)))
+            for found in self._pattern.finditer(text):
+                satisfied.update(self._keywords.get(found.group(0).casefold(), ()))
+        return {name for name, required in self._rules if required <= satisfied}
@@ -0,0 +1,467 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from otx import CHANGE_TABLES, PULSE_ATTRIBUTES, SQLiteDBHandler
+from otxdb import connect_reader
+from otxsimilar import NEAR_DUPLICATE_SIMILARITY
+
+log = logging.getLogger(__name__)
+
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8471
+# Size bound of the cached responses, least recently used responses are evicted beyond it
+QUERY_CACHE_BYTES = 64 * 2 ** 20
+# Page size of the listing endpoints when the client does not ask for one, and the largest page it may ask for
+PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+PULSE_TABLES = ("allpulses", "relevantpulses")
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           500: "Internal Server Error"}
+
+
+class RequestError(ValueError):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def encode_cursor(key: tuple) -> str:
+    """
+    :param key: sort key of the last row of a page
+    :return: opaque cursor a client passes back to get the page after it
+    """
+    return base64.urlsafe_b64encode(json.dumps(key, separators = (",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != 2:
+        raise RequestError(400, f"Invalid cursor {cursor}")
+    return tuple(key)
+
+
+class ResultCache:
+    """
+    LRU of encoded response bodies, bounded in bytes. Only the event loop thread touches it.
+    """
+
+    def __init__(self, max_bytes: int = QUERY_CACHE_BYTES):
+        self.maxBytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+
+    def get(self, key) -> bytes:
+        body = self._entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key, body: bytes) -> None:
+        if len(body) > self.maxBytes // 8:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[key] = body
+        self.size += len(body)
+        while self.size > self.maxBytes:
+            _, evicted = self._entries.popitem(last = False)
+            self.size -= len(evicted)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations}
+
+
+class QueryService:
+    """
+    Read-only HTTP/1.1 JSON service over the pulse database, for analysts and enrichment services that would otherwise
+    open the SQLite file themselves. Requests are parsed on an asyncio event loop and answered from the LRU result
+    cache where possible. Misses run the query on a thread borrowing a connection of the handler's ReadPool, so queries
+    neither wait for a running sync nor block the loop. Identical queries arriving while one is running share its
+    result. The cache is emptied whenever the database changes: every committed sync batch moves the database's commit
+    counter (PRAGMA data_version), which is checked once per request on a connection of the service's own.
+
+    Endpoints, all GET:
+      /pulses?table=&since=&until=&limit=&cursor=&<attribute>=   newest modified first, attributes as in find_pulses
+      /pulses/<pulse_id>?table=                                   pulse with its attributes and references
+      /pulses/<pulse_id>/indicators                               indicators of a pulse
+      /pulses/<pulse_id>/related?table=&limit=&min_similarity=    pulses with similar indicator sets, most similar first
+      /references?pulse_id=&limit=&cursor=                        references in pulse_id order
+      /search?q=&table=&raw=&limit=&cursor=                       ranked full-text search
+      /indicators?value=&type=                                    pulses an indicator appears in
+      /duplicates?table=&since=&threshold=                        clusters of near-duplicate pulses, largest first
+      /changes?cursor=&table=&limit=                              changelog after a change_id, see changes_since
+      /status                                                     sync watermarks and cache statistics, never cached
+    Listings are paginated by keyset: a page ends with a "next" cursor whenever more rows follow.
+    """
+
+    def __init__(self, db_handler: SQLiteDBHandler = None, cache_bytes: int = QUERY_CACHE_BYTES, workers: int = None):
+        self.dbHandler = db_handler or SQLiteDBHandler()
+        pool = self.dbHandler.read_pool()
+        self.executor = ThreadPoolExecutor(max_workers = workers or pool.size, thread_name_prefix = "otx-serve")
+        self.cache = ResultCache(cache_bytes)
+        self.requests = 0
+        self.errors = 0
+        # data_version only changes for commits made by other connections, this one never writes
+        self._changes = connect_reader(pool.path)
+        self._dataVersion = None
+        # Cache key -> future of the query currently computing it
+        self._inflight = {}
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self._changes.close()
+
+    def _database_changed(self) -> bool:
+        """
+        Compares the commit counter of the database with the one the cached results were computed at, and empties the
+        cache if they differ.
+        :return: whether the database changed since the last check
+        """
+        version = self._changes.execute("""PRAGMA data_version""").fetchone()[0]
+        if version == self._dataVersion:
+            return False
+        if self._dataVersion is not None:
+            self.cache.clear()
+        self._dataVersion = version
+        return True
+
+    @staticmethod
+    def _table(params: dict) -> str:
+        table = params.pop("table", "allpulses")
+        if table not in PULSE_TABLES:
+            raise RequestError(400, f"Invalid table {table}, choose from {', '.join(PULSE_TABLES)}")
+        return table
+
+    @staticmethod
+    def _limit(params: dict) -> int:
+        limit = params.pop("limit", None)
+        if limit is None:
+            return PAGE_LIMIT
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_LIMIT:
+            raise RequestError(400, f"limit must be between 1 and {MAX_PAGE_LIMIT}")
+        return int(limit)
+
+    @staticmethod
+    def _fraction(params: dict, name: str, default: float) -> float:
+        value = params.pop(name, None)
+        if value is None:
+            return default
+        try:
+            fraction = float(value)
+        except ValueError:
+            fraction = -1.0
+        if not 0.0 <= fraction <= 1.0:
+            raise RequestError(400, f"{name} must be between 0 and 1")
+        return fraction
+
+    @staticmethod
+    def _no_more(params: dict) -> None:
+        if params:
+            raise RequestError(400, f"Unknown parameters: {', '.join(sorted(params))}")
+
+    @staticmethod
+    def _page(items: list, limit: int, key) -> dict:
+        """
+        :param items: up to limit + 1 rows, the one past the limit only tells that another page follows
+        :param key: callable giving the sort key of a row, the cursor continues after it
+        """
+        following = len(items) > limit
+        items = items[:limit]
+        return {"items": items, "next": encode_cursor(key(items[-1])) if following else None}
+
+    def list_pulses(self, params: dict) -> dict:
+        table = self._table(params)
+        limit = self._limit(params)
+        cursor = params.pop("cursor", None)
+        since = params.pop("since", None)
+        until = params.pop("until", None)
+        unknown = set(params) - set(PULSE_ATTRIBUTES)
+        if unknown:
+            raise RequestError(400, f"Unknown parameters: {', '.join(sorted(unknown))}, filter on "
+                                    f"{', '.join(PULSE_ATTRIBUTES)}")
+        rows = self.dbHandler.find_pulses(table, since = since, until = until, limit = limit + 1,
+                                          after = decode_cursor(cursor) if cursor else None, **params)
+        items = [{"pulse_id": pulseId, "name": name, "created": created, "modified": modified, "author": author,
+                  "modified_ts": modifiedTs} for pulseId, name, created, modified, author, modifiedTs in rows]
+        page = self._page(items, limit, lambda item: (item["modified_ts"], item["pulse_id"]))
+        for item in page["items"]:
+            del item["modified_ts"]
+        return page
+
+    def get_pulse(self, params: dict, pulse_id: str) -> dict:
+        table = self._table(params)
+        self._no_more(params)
+        row = self.dbHandler.get_pulse(pulse_id, table)
+        if row is None:
+            raise RequestError(404, f"Pulse {pulse_id} is not in {table}")
+        pulse = dict(zip(("pulse_id", "name", "created", "modified", "description", "author"), row))
+        pulse["attributes"] = self.dbHandler.get_pulse_attributes(pulse_id)
+        pulse["references"] = [reference for _, reference in self.dbHandler.find_references(pulse_id, -1)]
+        return pulse
+
+    def pulse_indicators(self, params: dict, pulse_id: str) -> dict:
+        self._no_more(params)
+        return {"items": [{"type": indicatorType, "indicator": indicator}
+                          for indicatorType, indicator in self.dbHandler.get_pulse_indicators(pulse_id)]}
+
+    def related_pulses(self, params: dict, pulse_id: str) -> dict:
+        table = self._table(params)
+        limit = self._limit(params)
+        minSimilarity = self._fraction(params, "min_similarity", 0.0)
+        self._no_more(params)
+        return {"items": [{"pulse_id": pulseId, "name": name, "similarity": similarity} for pulseId, name, similarity
+                          in self.dbHandler.related_pulses(pulse_id, table, limit, minSimilarity)]}
+
+    def near_duplicates(self, params: dict) -> dict:
+        table = self._table(params)
+        since = params.pop("since", None)
+        threshold = self._fraction(params, "threshold", NEAR_DUPLICATE_SIMILARITY)
+        self._no_more(params)
+        clusters = self.dbHandler.near_duplicates(threshold, table, since)
+        return {"items": [[{"pulse_id": pulseId, "name": name} for pulseId, name in cluster] for cluster in clusters]}
+
+    def list_references(self, params: dict) -> dict:
+        limit = self._limit(params)
+        cursor = params.pop("cursor", None)
+        pulseId = params.pop("pulse_id", None)
+        self._no_more(params)
+        rows = self.dbHandler.find_references(pulseId, limit + 1, after = decode_cursor(cursor) if cursor else None)
+        items = [{"pulse_id": pulseId, "reference": reference} for pulseId, reference in rows]
+        return self._page(items, limit, lambda item: (item["pulse_id"], item["reference"]))
+
+    def search(self, params: dict) -> dict:
+        query = params.pop("q", "")
+        if not query.strip():
+            raise RequestError(400, "q is required")
+        table = self._table(params)
+        limit = self._limit(params)
+        cursor = params.pop("cursor", None)
+        raw = params.pop("raw", "false").lower() in ("1", "true", "yes")
+        self._no_more(params)
+        try:
+            rows = self.dbHandler.search(query, table, limit + 1, raw = raw,
+                                         after = decode_cursor(cursor) if cursor else None)
+        except sqlite3.OperationalError as e:
+            # Raw queries are FTS5 syntax, which the client can get wrong
+            raise RequestError(400, f"Invalid search query: {e}")
+        items = [{"pulse_id": pulseId, "name": name, "snippet": snippet, "rank": rank}
+                 for pulseId, name, snippet, rank in rows]
+        return self._page(items, limit, lambda item: (item["rank"], item["pulse_id"]))
+
+    def find_indicator(self, params: dict) -> dict:
+        value = params.pop("value", "")
+        if not value:
+            raise RequestError(400, "value is required")
+        indicatorType = params.pop("type", None)
+        self._no_more(params)
+        return {"items": [{"type": foundType, "pulse_id": pulseId}
+                          for foundType, pulseId in self.dbHandler.find_indicator(value, indicatorType)]}
+
+    def list_changes(self, params: dict) -> dict:
+        cursor = params.pop("cursor", "0")
+        if not cursor.isdigit():
+            raise RequestError(400, "cursor must be a change_id")
+        table = params.pop("table", "relevantpulses")
+        if table not in (*CHANGE_TABLES, "all"):
+            raise RequestError(400, f"Invalid table {table}, choose from {', '.join(CHANGE_TABLES)}, all")
+        limit = self._limit(params)
+        self._no_more(params)
+        changes = self.dbHandler.changes_since(int(cursor), None if table == "all" else table, limit)
+        # Change IDs are stable, consumers keep the plain cursor between polls
+        return {"items": [{"change_id": changeId, "run_id": runId, "table": changeTable, "pulse_id": pulseId,
+                           "change": kind, "old_modified": oldModified, "new_modified": newModified}
+                          for changeId, runId, changeTable, pulseId, kind, oldModified, newModified in changes],
+                "cursor": changes[-1][0] if changes else int(cursor)}
+
+    def status(self, params: dict) -> dict:
+        self._no_more(params)
+        with self.dbHandler.read_pool().connection() as connection:
+            sync = {table: {"watermark": watermark, "last_updated": lastUpdated} for table, watermark, lastUpdated
+                    in connection.execute("""SELECT table_name, watermark, last_updated FROM sync_state""")}
+        return {"sync": sync, "requests": self.requests, "errors": self.errors, "cache": self.cache.stats()}
+
+    def _route(self, path: str) -> tuple:
+        """
+        :return: tuple of the handler, the arguments taken from the path and whether its responses are cached
+        """
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if parts == ["pulses"]:
+            return self.list_pulses, (), True
+        if len(parts) == 2 and parts[0] == "pulses":
+            return self.get_pulse, (parts[1],), True
+        if len(parts) == 3 and parts[0] == "pulses" and parts[2] == "indicators":
+            return self.pulse_indicators, (parts[1],), True
+        if len(parts) == 3 and parts[0] == "pulses" and parts[2] == "related":
+            return self.related_pulses, (parts[1],), True
+        if parts == ["duplicates"]:
+            return self.near_duplicates, (), True
+        if parts == ["references"]:
+            return self.list_references, (), True
+        if parts == ["search"]:
+            return self.search, (), True
+        if parts == ["indicators"]:
+            return self.find_indicator, (), True
+        if parts == ["changes"]:
+            return self.list_changes, (), True
+        if parts == ["status"]:
+            return self.status, (), False
+        raise RequestError(404, f"No endpoint at {path}")
+
+    @staticmethod
+    def _encode(handler, params: dict, args: tuple) -> bytes:
+        return json.dumps(handler(params, *args), separators = (",", ":")).encode()
+
+    async def respond(self, method: str, target: str) -> tuple:
+        """
+        :param method: HTTP method of the request
+        :param target: request target, path and query string
+        :return: tuple of the HTTP status and the JSON body
+        """
+        self.requests += 1
+        try:
+            if method not in ("GET", "HEAD"):
+                raise RequestError(405, f"{method} is not supported, the service is read-only")
+            url = urlsplit(target)
+            handler, args, cached = self._route(url.path)
+            params = dict(parse_qsl(url.query, keep_blank_values = True))
+            loop = asyncio.get_running_loop()
+            if not cached:
+                return 200, await loop.run_in_executor(self.executor, self._encode, handler, params, args)
+
+            self._database_changed()
+            key = (url.path, tuple(sorted(params.items())))
+            body = self.cache.get(key)
+            if body is not None:
+                return 200, body
+            pending = self._inflight.get(key)
+            if pending is not None:
+                return 200, await asyncio.shield(pending)
+            pending = loop.run_in_executor(self.executor, self._encode, handler, params, args)
+            self._inflight[key] = pending
+            try:
+                body = await asyncio.shield(pending)
+            finally:
+                del self._inflight[key]
+            # A result computed while a sync committed may predate the commit, it is served but not kept
+            if not self._database_changed():
+                self.cache.put(key, body)
+            return 200, body
+        except ValueError as e:
+            self.errors += 1
+            return getattr(e, "status", 400), json.dumps({"error": str(e)}).encode()
+        except Exception as e:
+            self.errors += 1
+            log.exception("Request %s %s failed", method, target)
+            return 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves the requests of one client connection, keeping it open between requests unless asked not to.
+        """
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = headers.get("content-length", "0")
+                if length.isdigit() and int(length):
+                    await reader.readexactly(int(length))
+
+                parts = requestLine.decode("latin-1").split()
+                if len(parts) == 3:
+                    method, target, version = parts
+                    status, body = await self.respond(method, target)
+                else:
+                    method, version = "GET", "HTTP/1.0"
+                    status, body = 400, json.dumps({"error": "Malformed request line"}).encode()
+                connection = headers.get("connection", "").lower()
+                keepAlive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keepAlive else 'close'}"
+                             f"\r\n\r\n".encode() + (body if method != "HEAD" else b""))
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            # Client went away or sent a line longer than the stream limit
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = SERVE_HOST, port: int = SERVE_PORT) -> None:
+        """
+        Serves until cancelled.
+        """
+        server = await asyncio.start_server(self.handle, host, port, backlog = 256)
+        log.info("Serving pulse queries on %s", ", ".join(f"http://{s.getsockname()[0]}:{s.getsockname()[1]}"
+                                                          for s in server.sockets))
+        async with server:
+            await server.serve_forever()
+
+    def serve_in_thread(self, host: str = SERVE_HOST, port: int = SERVE_PORT) -> threading.Thread:
+        """
+        Serves from a daemon thread with its own event loop, e.g. next to a SyncScheduler in the same process.
+        """
+        thread = threading.Thread(target = asyncio.run, args = (self.serve(host, port),), name = "otx-serve",
+                                  daemon = True)
+        thread.start()
+        return thread
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Serve read-only queries over the local OTX pulse DB")
+    parser.add_argument("--host", default=SERVE_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=SERVE_PORT, help="Port to listen on")
+    parser.add_argument("--cache-mb", type=int, default=QUERY_CACHE_BYTES // 2 ** 20,
+                        help="Size bound of the query result cache in MB")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Queries run at once, defaults to the size of the read connection pool")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Also log debug messages")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    service = QueryService(cache_bytes = args.cache_mb * 2 ** 20, workers = args.workers)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        service.dbHandler.close()
+
+
+if __name__ == '__main__':
+    main()
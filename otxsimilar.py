@@ -0,0 +1,123 @@
+import hashlib
+import itertools
+import operator
+import random
+import struct
+
+# NumPy once imported, None when it is not installed, the same signatures are then computed in pure Python, only a lot
+# slower. Imported on first use: it takes longer to import than the offline commands take to run.
+numpy = False
+
+# Hash functions per MinHash signature, a signature holds the minimum of each over a pulse's indicators
+NUM_PERM = 64
+# Signatures are cut into LSH_BANDS bands of LSH_ROWS values and two pulses become candidates when any band matches.
+# With 16 bands of 4 values half of the pairs with a Jaccard similarity of 0.5 match, and all but 1 in 5000 of those
+# above 0.8.
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+# Estimated Jaccard similarity of the indicator sets at or above which two pulses are near-duplicates
+NEAR_DUPLICATE_SIMILARITY = 0.8
+# Indicator hashes expanded at once when computing signatures with NumPy, bounds memory to about 32 MB
+HASH_CHUNK_SIZE = 65536
+# Seed of the hash functions. Changing it, NUM_PERM or LSH_BANDS invalidates every stored signature and bucket.
+SIGNATURE_SEED = 0x07C5
+
+_MASK64 = 2 ** 64 - 1
+_SIGNATURE = struct.Struct(f"<{NUM_PERM}I")
+_seeded = random.Random(SIGNATURE_SEED)
+# Multiply-add-shift hash functions h(x) = ((a * x + b) mod 2^64) >> 32 of 32-bit indicator hashes, strongly universal
+# and exactly the same in uint64 NumPy arithmetic, which wraps, and in Python integers masked to 64 bits
+MULTIPLIERS = [_seeded.getrandbits(64) for _ in range(NUM_PERM)]
+ADDENDS = [_seeded.getrandbits(64) for _ in range(NUM_PERM)]
+# Odd multipliers combining the values of a band into its 64-bit bucket
+BAND_MULTIPLIERS = [_seeded.getrandbits(64) | 1 for _ in range(LSH_ROWS)]
+
+
+def _numpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def indicator_hash(indicator: str) -> int:
+    """
+    :param indicator: indicator value. The type is left out, OTX files the same host as a domain in one pulse and as a
+                      hostname in the next
+    :return: 32-bit hash of the value
+    """
+    return int.from_bytes(hashlib.blake2b(indicator.strip().lower().encode("utf-8"), digest_size = 4).digest(),
+                          "little")
+
+
+def minhash_signatures(indicator_sets: list) -> list:
+    """
+    Computes the MinHash signature of every indicator set. NumPy, when installed, applies all NUM_PERM hash functions
+    to a chunk of indicators in one vectorized step and reduces each pulse's rows to their minima.
+    :param indicator_sets: list of non-empty iterables of indicator values
+    :return: list of signatures, each NUM_PERM little-endian uint32 packed into bytes
+    """
+    hashes = [list({indicator_hash(indicator) for indicator in indicators}) for indicators in indicator_sets]
+    np = _numpy()
+    if np is None:
+        return [_SIGNATURE.pack(*(min([((a * x + b) & _MASK64) >> 32 for x in values])
+                                  for a, b in zip(MULTIPLIERS, ADDENDS)))
+                for values in hashes]
+
+    sizes = np.fromiter(map(len, hashes), dtype = np.int64, count = len(hashes))
+    flat = np.fromiter(itertools.chain.from_iterable(hashes), dtype = np.uint64, count = int(sizes.sum()))
+    owners = np.repeat(np.arange(len(hashes)), sizes)
+    multipliers = np.array(MULTIPLIERS, dtype = np.uint64)
+    addends = np.array(ADDENDS, dtype = np.uint64)
+    minima = np.full((len(hashes), NUM_PERM), 2 ** 32 - 1, dtype = np.uint64)
+    for start in range(0, len(flat), HASH_CHUNK_SIZE):
+        owner = owners[start:start + HASH_CHUNK_SIZE]
+        values = (flat[start:start + HASH_CHUNK_SIZE, None] * multipliers + addends) >> np.uint64(32)
+        # Rows of one pulse are contiguous, reduce each run of them and merge it into the pulse's minima
+        runs = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        minima[owner[runs]] = np.minimum(minima[owner[runs]], np.minimum.reduceat(values, runs, axis = 0))
+    return [row.tobytes() for row in minima.astype("<u4")]
+
+
+def lsh_buckets(signatures: list) -> list:
+    """
+    :param signatures: list of signatures from minhash_signatures
+    :return: list of LSH_BANDS signed 64-bit bucket keys per signature, band order
+    """
+    np = _numpy()
+    if np is None:
+        buckets = []
+        for signature in signatures:
+            values = _SIGNATURE.unpack(signature)
+            keys = []
+            for band in range(LSH_BANDS):
+                key = sum(map(operator.mul, values[band * LSH_ROWS:(band + 1) * LSH_ROWS], BAND_MULTIPLIERS)) & _MASK64
+                keys.append(key - 2 ** 64 if key >= 2 ** 63 else key)
+            buckets.append(keys)
+        return buckets
+    if not signatures:
+        return []
+    bands = np.frombuffer(b"".join(signatures), dtype = "<u4").reshape(-1, LSH_BANDS, LSH_ROWS).astype(np.uint64)
+    keys = (bands * np.array(BAND_MULTIPLIERS, dtype = np.uint64)).sum(axis = 2, dtype = np.uint64)
+    return keys.view(np.int64).tolist()
+
+
+def similarities(signature: bytes, others: list) -> list:
+    """
+    :param signature: signature to compare with
+    :param others: list of signatures
+    :return: list of the estimated Jaccard similarity of the indicator sets behind signature and each of others, the
+             share of signature values they have in common
+    """
+    np = _numpy()
+    if np is None:
+        values = _SIGNATURE.unpack(signature)
+        return [sum(map(operator.eq, values, _SIGNATURE.unpack(other))) / NUM_PERM for other in others]
+    if not others:
+        return []
+    matrix = np.frombuffer(b"".join(others), dtype = "<u4").reshape(-1, NUM_PERM)
+    return (matrix == np.frombuffer(signature, dtype = "<u4")).mean(axis = 1).tolist()
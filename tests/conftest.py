@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import otx
+from otxfakeserver import FakeOTX, FakeOTXServer
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Points every database path at a temporary directory. The paths are rootDir + "\\sqlite\\...", the trailing separator
+    keeps the files inside the directory on POSIX.
+    """
+    monkeypatch.setattr(otx, "rootDir", os.path.join(str(tmp_path), ""))
+    # Set by the handler of the test that created the last database, until a sync consumes them
+    monkeypatch.setattr(otx, "firstInitializationAllPulses", False)
+    monkeypatch.setattr(otx, "firstInitializationRelPulses", False)
+    return tmp_path
+
+
+@pytest.fixture
+def serve(workdir):
+    """
+    Starts an in-process FakeOTXServer over a feed, shut down when the test ends.
+    """
+    servers = []
+
+    def start(feed: FakeOTX) -> FakeOTXServer:
+        servers.append(FakeOTXServer(feed).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def director(serve):
+    """
+    Returns an ApplicationDirector syncing from a fake feed, each feed is served once so a second director stands in for
+    a restarted process. Every director is closed when the test ends.
+    """
+    directors = []
+    servers = {}
+
+    def make(feed: FakeOTX, **kwargs) -> otx.ApplicationDirector:
+        if feed not in servers:
+            servers[feed] = serve(feed)
+        directors.append(otx.ApplicationDirector("test-key", server = servers[feed].url, progress = False, **kwargs))
+        return directors[-1]
+
+    yield make
+    for app in directors:
+        app.dbHandler.close()
@@ -0,0 +1,63 @@
+import zlib
+
+import pytest
+
+import otx
+import otxmatch
+
+
+def pulse(index: int, modified: str = "2020-01-01T00:00:00", name: str = None) -> dict:
+    return {"id": "%024x" % index, "name": name or f"Campaign #{index}", "created": "2020-01-01T00:00:00",
+            "modified": modified, "description": f"Description #{index}", "author_name": "author",
+            "references": [f"https://blog.example.com/{index}"], "industries": ["Aerospace"] if index % 3 == 0 else [],
+            "tags": ["apt"], "indicators": [{"type": "IPv4", "indicator": f"192.0.2.{index}"}]}
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+def snapshot(db: otx.SQLiteDBHandler) -> dict:
+    cursor = db.currentCursor
+    return {
+        "allpulses": sorted(cursor.execute("""SELECT * FROM allpulses""")),
+        "relevantpulses": sorted(cursor.execute("""SELECT pulse_id FROM relevantpulses""")),
+        "reference": sorted(cursor.execute("""SELECT pulse_id, reference FROM reference""")),
+        "tags": sorted(cursor.execute("""SELECT pulse_id, tag FROM pulse_tag""")),
+        "indicators": sorted(cursor.execute("""SELECT l.pulse_id, i.indicator FROM pulse_indicator l 
+                JOIN indicator i ON i.indicator_id = l.indicator_id""")),
+        "watermark": db.get_sync_state("allpulses")[0],
+    }
+
+
+def test_every_version_is_archived_compressed(db):
+    db.stream_pulses("allpulses", [pulse(0), pulse(1)])
+    db.stream_pulses("allpulses", [pulse(0, "2020-01-02T00:00:00", "Renamed"), pulse(1)])
+    rows = db.currentCursor.execute("""SELECT pulse_id, modified, data FROM archive.pulse_archive 
+            ORDER BY archive_id""").fetchall()
+    assert [row[:2] for row in rows] == [(pulse(0)["id"], "2020-01-01T00:00:00"),
+                                         (pulse(1)["id"], "2020-01-01T00:00:00"),
+                                         (pulse(0)["id"], "2020-01-02T00:00:00")]
+    assert b"Renamed" in zlib.decompress(rows[-1][2])
+
+
+def test_rebuild_restores_the_newest_version_of_every_pulse(db, monkeypatch):
+    monkeypatch.setattr(otx, "REBUILD_CHUNK_SIZE", 7)
+    db.stream_pulses("allpulses", [pulse(index) for index in range(50)])
+    db.stream_pulses("allpulses", [pulse(3, "2020-01-02T00:00:00", "Renamed")])
+    expected = snapshot(db)
+    matcher = otxmatch.IOCMatcher()
+    try:
+        assert db.rebuild_from_archive(workers = 2) == 50
+        assert snapshot(db) == expected
+        assert [row[0] for row in db.search("Renamed")] == [pulse(3)["id"]]
+        # Rebuilt indicator IDs start over, the matcher has to notice and reload
+        assert list(matcher.match_lines(["from 192.0.2.3\n"])) == [(1, "from 192.0.2.3\n", [pulse(3)["id"]])]
+        assert matcher.indicatorCount == 50
+    finally:
+        matcher.connection.close()
+    # Rebuilding does not archive the replayed pulses again
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM archive.pulse_archive""").fetchone()[0] == 51
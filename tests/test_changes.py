@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+import otx
+import otxexport
+import otxpartition
+from otxfakeserver import FakeOTX
+from otxrelevance import DEFAULT_PROFILES, RELEVANT_PROFILE, RelevanceMatcher
+from test_partition import PlainRevisions, scalar, stored_pulses
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+def run_changes(db: otx.SQLiteDBHandler, table: str = None) -> dict:
+    """
+    :return: dict of (table, kind) to the pulse IDs the last sync run logged
+    """
+    lastRun = scalar(db, """SELECT MAX(run_id) FROM changelog""")
+    changes = {}
+    for _, runId, changeTable, pulseId, kind, _, _ in db.changes_since(0, table, limit = 10 ** 6):
+        if runId == lastRun:
+            changes.setdefault((changeTable, kind), set()).add(pulseId)
+    return changes
+
+
+def test_changelog_records_inserts_updates_and_deletes(director):
+    feed = PlainRevisions(200, indicators = 2)
+    app = director(feed)
+    app.update_alltables()
+    db = app.dbHandler
+    relevant = {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM relevantpulses""")}
+    assert relevant
+    changes = run_changes(db)
+    assert changes[("allpulses", "insert")] == {feed.pulse(index)["id"] for index in range(200)}
+    assert changes[("relevantpulses", "insert")] == relevant
+
+    feed.touch(200)
+    app.update_alltables()
+    changes = run_changes(db)
+    assert set(changes) == {("allpulses", "update"), ("relevantpulses", "delete")}
+    assert changes[("allpulses", "update")] == {feed.pulse(index)["id"] for index in range(200)}
+    assert changes[("relevantpulses", "delete")] == relevant
+    modified = {feed.pulse(index)["id"]: (feed.pulse(index)["modified"],
+                                          feed.pulse(index, feed.touched[index])["modified"]) for index in range(200)}
+    for _, _, _, pulseId, _, oldModified, newModified in db.changes_since(0, "allpulses", limit = 10 ** 6)[200:]:
+        assert (oldModified, newModified) == modified[pulseId]
+
+    # Reading on from the cursor of the last change returns nothing
+    cursor = db.changes_since(0, None, limit = 10 ** 6)[-1][0]
+    assert db.changes_since(cursor, None) == []
+
+
+def test_incremental_export_follows_the_changelog(director, workdir):
+    feed = FakeOTX(200, indicators = 2)
+    app = director(feed)
+    app.update_alltables()
+    db = app.dbHandler
+    exporter = otxexport.PulseExporter(db)
+    path = str(workdir / "relevant.jsonl")
+    relevant = scalar(db, """SELECT COUNT(*) FROM relevantpulses""")
+    assert exporter.export("relevantpulses", "jsonl", path, incremental = True)["rows"] == relevant
+    assert exporter.export("relevantpulses", "jsonl", path, incremental = True)["rows"] == 0
+
+    # Widening the profile makes old pulses relevant, older than anything exported so far
+    profiles = json.loads(json.dumps(DEFAULT_PROFILES))
+    profiles[RELEVANT_PROFILE]["rules"].append({"industries": ["Finance"]})
+    db.relevance = RelevanceMatcher(profiles)
+    db.refresh_profiles()
+    added = scalar(db, """SELECT COUNT(*) FROM relevantpulses""") - relevant
+    assert added > 0
+    assert exporter.export("relevantpulses", "jsonl", path, incremental = True)["rows"] == added
+    with open(path, encoding = "utf-8") as f:
+        assert len(f.readlines()) == added
+
+
+def test_dropped_partitions_log_their_pulses_as_deleted(db):
+    pulses = stored_pulses(db)
+    relevant = {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM relevantpulses""")}
+    assert pulses[0]["id"] in relevant
+    manager = otxpartition.PartitionManager(db)
+    manager.roll(older_than_days = 30)
+    cursor = db.changes_since(0, None, limit = 10 ** 6)[-1][0]
+
+    assert manager.drop("2020-01-01") == ["2019"]
+    assert [(table, pulseId, kind, oldModified, newModified)
+            for _, _, table, pulseId, kind, oldModified, newModified in db.changes_since(cursor, None)] == [
+        ("allpulses", pulses[0]["id"], "delete", pulses[0]["modified"], None),
+        ("relevantpulses", pulses[0]["id"], "delete", pulses[0]["modified"], None)]
@@ -0,0 +1,64 @@
+import json
+import threading
+import time
+
+from otxdaemon import SyncScheduler
+from otxfakeserver import FakeOTX
+
+
+def test_interval_shrinks_on_changes_and_grows_when_idle(director, tmp_path):
+    feed = FakeOTX(120, indicators = 1)
+    metricsJson = str(tmp_path / "run.json")
+    scheduler = SyncScheduler(director(feed), interval = 400, min_interval = 100, max_interval = 800,
+                              metrics_json = metricsJson)
+    reports = []
+    scheduler.callbacks.append(lambda metrics: reports.append(metrics.report()))
+
+    assert scheduler.run_once().counters["pulses_inserted"] == 120
+    assert scheduler.interval == 200
+    feed.add(1)
+    scheduler.run_once()
+    assert scheduler.interval == 100
+    scheduler.run_once()
+    assert scheduler.interval == 150
+    for _ in range(5):
+        scheduler.run_once()
+    assert scheduler.interval == 800
+    assert (scheduler.runs, scheduler.failures, len(reports)) == (8, 0, 8)
+    assert json.loads((tmp_path / "run.json").read_text())["counters"] == reports[-1]["counters"]
+
+
+def test_failed_runs_back_off_and_callbacks_are_isolated(director):
+    scheduler = SyncScheduler(director(FakeOTX(10)), interval = 100, min_interval = 10, max_interval = 1000)
+
+    def broken(metrics):
+        raise RuntimeError("callback failure")
+    scheduler.callbacks.append(broken)
+    assert scheduler.run_once() is not None
+    assert scheduler.interval == 50
+
+    def fail():
+        raise ConnectionError("OTX is down")
+    scheduler.appDirector.update_alltables = fail
+    assert scheduler.run_once() is None
+    assert (scheduler.interval, scheduler.failures) == (1000, 1)
+
+
+def test_wake_runs_at_once_and_stop_ends_the_loop(director):
+    scheduler = SyncScheduler(director(FakeOTX(10)), interval = 3600, min_interval = 3600, max_interval = 3600)
+
+    def after_run(metrics):
+        # Like a signal handler, wake and stop arrive from outside of the thread that syncs
+        if scheduler.runs == 1:
+            threading.Timer(0.1, scheduler.wake).start()
+        else:
+            threading.Timer(0.1, scheduler.stop).start()
+    scheduler.callbacks.append(after_run)
+    # Fails the test instead of hanging it if the wake-up is lost, the second run would be an hour away
+    guard = threading.Timer(30, scheduler.stop)
+    guard.start()
+    start = time.monotonic()
+    scheduler.run_forever()
+    guard.cancel()
+    assert time.monotonic() - start < 30
+    assert (scheduler.runs, scheduler.failures) == (2, 0)
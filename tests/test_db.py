@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+
+import pytest
+
+import otxdb
+
+
+@pytest.fixture
+def connection(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "test.sqlite3"), check_same_thread = False)
+    otxdb.configure_connection(connection)
+    connection.execute("""CREATE TABLE item (value INTEGER PRIMARY KEY)""")
+    connection.commit()
+    yield connection
+    connection.close()
+
+
+def test_writer_commits_queued_jobs_together_and_fails_them_together(connection):
+    writer = otxdb.SQLiteWriter(connection, queue_size = 10)
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def block(_):
+        blocked.set()
+        release.wait(10)
+    writer.submit(block)
+    blocked.wait(10)
+    # Queued while the writer is busy, so they share the next transaction and the duplicate rolls all of them back
+    futures = [writer.execute("""INSERT INTO item VALUES (?)""", (value,)) for value in (1, 2, 2)]
+    release.set()
+    for future in futures:
+        with pytest.raises(sqlite3.IntegrityError):
+            future.result(10)
+    assert writer.executemany("""INSERT INTO item VALUES (?)""", [(3,), (4,)]).result(10) == 2
+    writer.close()
+    assert connection.execute("""SELECT value FROM item""").fetchall() == [(3,), (4,)]
+    assert writer.transactions == 2
+
+
+def test_readers_see_the_last_commit_while_a_write_is_open(connection, tmp_path):
+    assert connection.execute("""PRAGMA journal_mode""").fetchone() == ("wal",)
+    assert connection.execute("""PRAGMA page_size""").fetchone() == (otxdb.PAGE_SIZE,)
+    connection.execute("""INSERT INTO item VALUES (1)""")
+    connection.commit()
+    pool = otxdb.ReadPool(str(tmp_path / "test.sqlite3"), size = 2)
+    try:
+        connection.execute("""INSERT INTO item VALUES (2)""")
+        with pool.connection() as reader:
+            assert reader.execute("""SELECT COUNT(*) FROM item""").fetchone() == (1,)
+            with pytest.raises(sqlite3.OperationalError):
+                reader.execute("""DELETE FROM item""")
+        connection.commit()
+        with pool.connection() as reader:
+            assert reader.execute("""SELECT COUNT(*) FROM item""").fetchone() == (2,)
+        # Connections are reused, never more than size are opened
+        with pool.connection(), pool.connection():
+            pass
+        assert pool._created == 2
+    finally:
+        pool.close()
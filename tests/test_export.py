@@ -0,0 +1,89 @@
+import csv
+import json
+import os
+
+import pytest
+
+import otx
+import otxexport
+from test_sync import pulse
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+def read_jsonl(path: str) -> list:
+    with open(path, encoding = "utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_formats_export_every_row(db, workdir):
+    pulses = [pulse(index, f"2020-01-01T00:00:{index:02d}") for index in range(3)]
+    pulses[0]["description"] = 'Says "hi", twice'
+    pulses[0]["indicators"] = [{"type": "IPv4", "indicator": "192.0.2.1"}, {"type": "CVE", "indicator": "CVE-1"}]
+    db.stream_pulses("allpulses", pulses)
+    exporter = otxexport.PulseExporter(db, chunk_size = 2)
+
+    path = str(workdir / "pulses.jsonl")
+    assert exporter.export("allpulses", "jsonl", path)["rows"] == 3
+    rows = read_jsonl(path)
+    assert sorted(row["pulse_id"] for row in rows) == [pulse(index)["id"] for index in range(3)]
+    assert {row["modified_ts"] for row in rows} == {otx.epoch_seconds(p["modified"]) for p in pulses}
+
+    path = str(workdir / "pulses.csv")
+    exporter.export("allpulses", "csv", path)
+    with open(path, newline = "", encoding = "utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert tuple(rows[0]) == otxexport.PULSE_COLUMNS
+    assert {row["description"] for row in rows} == {'Says "hi", twice', ""}
+
+    path = str(workdir / "pulses.stix")
+    exporter.export("allpulses", "stix", path)
+    with open(path, encoding = "utf-8") as f:
+        bundle = json.load(f)
+    kinds = [stixObject["type"] for stixObject in bundle["objects"]]
+    assert kinds.count("report") == 3 and kinds.count("identity") == 1
+    # Indicator types without a STIX pattern are left out
+    assert [stixObject["pattern"] for stixObject in bundle["objects"] if stixObject["type"] == "indicator"] == \
+        ["[ipv4-addr:value = '192.0.2.1']"]
+    assert not [name for name in os.listdir(workdir) if name.endswith(".tmp")]
+
+
+def test_incremental_export_only_writes_pulses_changed_since_the_last_run(db, workdir):
+    db.stream_pulses("allpulses", [pulse(index, f"2020-01-01T00:00:{index:02d}") for index in range(3)])
+    exporter = otxexport.PulseExporter(db)
+    path = str(workdir / "pulses.jsonl")
+    assert exporter.export("allpulses", "jsonl", path, incremental = True)["rows"] == 3
+
+    # Pulse 3 shares the second of the last exported pulse, pulse 1 is modified, neither is missed
+    db.stream_pulses("allpulses", [pulse(3, "2020-01-01T00:00:02.500000"), pulse(1, "2020-01-01T00:00:05")])
+    assert exporter.export("allpulses", "jsonl", path, incremental = True)["rows"] == 2
+    assert sorted(row["pulse_id"] for row in read_jsonl(path)) == [pulse(index)["id"] for index in (1, 3)]
+    assert exporter.export("allpulses", "jsonl", path, incremental = True)["rows"] == 0
+
+
+def test_failed_export_leaves_the_previous_file(db, workdir, monkeypatch):
+    db.stream_pulses("allpulses", [pulse(0)])
+    exporter = otxexport.PulseExporter(db)
+    path = str(workdir / "pulses.jsonl")
+    exporter.export("allpulses", "jsonl", path, name = "nightly")
+
+    def fail(self, rows):
+        raise OSError("disk full")
+    monkeypatch.setattr(otxexport.JSONLWriter, "write", fail)
+    with pytest.raises(OSError):
+        exporter.export("allpulses", "jsonl", path, name = "nightly")
+    assert len(read_jsonl(path)) == 1
+    assert not [name for name in os.listdir(workdir) if name.endswith(".tmp")]
+
+
+def test_writers_implement_write():
+    class Untitled(otxexport.RowWriter):
+        pass
+
+    with pytest.raises(TypeError):
+        Untitled(None, ())
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import otx
+import otxbench
+from otxfakeserver import FakeOTX
+from otxrelevance import RELEVANT_PROFILE, RelevanceMatcher
+
+
+def scalar(db, query: str, params = ()):
+    return db.currentCursor.execute(query, params).fetchone()[0]
+
+
+def test_incremental_sync_upserts_touched_and_added_pulses(director):
+    feed = FakeOTX(300, indicators = 4)
+    app = director(feed)
+    app.update_alltables()
+    db = app.dbHandler
+    assert scalar(db, """SELECT COUNT(*) FROM allpulses""") == 300
+    assert db.get_sync_state("allpulses")[0] == feed.pulse(299)["modified"]
+
+    feed.touch(5)
+    feed.add(7)
+    app.update_alltables()
+    assert scalar(db, """SELECT COUNT(*) FROM allpulses""") == 307
+    for index, touched in feed.touched.items():
+        pulse = feed.pulse(index, touched)
+        assert db.currentCursor.execute("""SELECT name, modified FROM allpulses WHERE pulse_id = ?""",
+                                        (pulse["id"],)).fetchone() == (pulse["name"], pulse["modified"])
+    assert db.get_sync_state("allpulses")[0] == max([feed.pulse(306)["modified"]] + [
+        feed.pulse(index, touched)["modified"] for index, touched in feed.touched.items()])
+    matcher = RelevanceMatcher()
+    relevant = {feed.pulse(index, feed.touched.get(index))["id"] for index in range(307)
+                if RELEVANT_PROFILE in matcher.match(feed.pulse(index, feed.touched.get(index)))}
+    assert {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM relevantpulses""")} == relevant
+
+
+def test_benchmark_reports_every_scenario_and_cleans_up(tmp_path, monkeypatch):
+    # The scenario processes get the workdir passed, only the parent has to create it under tmp_path
+    monkeypatch.setattr(otxbench.tempfile, "tempdir", str(tmp_path))
+    output = tmp_path / "report.json"
+    otxbench.main(["--sizes", "200", "--indicators", "2", "--workers", "2", "--output", str(output)])
+    results = json.loads(output.read_text())["results"]
+    assert [result["scenario"] for result in results] == otxbench.SCENARIOS
+    full, incremental, noop = results
+    assert full["pulses_inserted"] == 200
+    assert (incremental["pulses_inserted"], incremental["pulses_updated"]) == (2, 2)
+    assert noop["pulses_inserted"] == noop["pulses_updated"] == 0
+    assert [path.name for path in tmp_path.iterdir()] == ["report.json"]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_interrupted_backfill_resumes_from_its_checkpoint(director, monkeypatch):
+    # Three batches of the stream, each committed with its checkpoint
+    feed = FakeOTX(2 * otx.STREAM_BATCH_SIZE + 200, indicators = 1)
+    app = director(feed)
+    checkpoint = app.dbHandler.checkpoint_backfill
+    calls = []
+
+    def interrupt(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise Interrupted()
+        checkpoint(*args, **kwargs)
+
+    monkeypatch.setattr(app.dbHandler, "checkpoint_backfill", interrupt)
+    with pytest.raises(Interrupted):
+        app.update_alltables()
+    app.dbHandler.close()
+
+    resumed = director(feed)
+    db = resumed.dbHandler
+    (_, _, _, consumed), = db.pending_backfill()
+    assert consumed == otx.STREAM_BATCH_SIZE
+    assert scalar(db, """SELECT COUNT(*) FROM allpulses""") == consumed
+    metrics = resumed.update_alltables()
+    assert db.pending_backfill() == []
+    assert scalar(db, """SELECT COUNT(*) FROM allpulses""") == feed.count
+    assert db.get_sync_state("allpulses")[0] == feed.pulse(feed.count - 1)["modified"]
+    # Only the pages from the checkpoint on are fetched again
+    assert metrics.counters["pages_fetched"] == (feed.count - consumed) // otx.OTX_PAGE_SIZE
@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import otxfetch
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        query = {key: values[-1] for key, values in parse_qs(urlsplit(self.path).query).items()}
+        page, limit = int(query.get("page", 1)), int(query["limit"])
+        with server.lock:
+            server.requests.append((page, time.monotonic(), self.headers.get("X-OTX-API-KEY")))
+            failure = server.failures.get(page)
+            if failure and failure[1] > 0:
+                server.failures[page] = (failure[0], failure[1] - 1)
+        if failure and failure[1] > 0:
+            status, _ = failure
+            self.send_response(status)
+            if server.retryAfter is not None:
+                self.send_header("Retry-After", str(server.retryAfter))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        # A page changes whenever the feed's version does
+        etag = '"%d-%d"' % (page, server.version)
+        if self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.notModified += 1
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        first = (page - 1) * limit
+        results = [{"id": index, "version": server.version}
+                   for index in range(first, min(server.pulses, first + limit))]
+        body = json.dumps({"results": results, "count": server.pulses,
+                           "next": "next" if first + limit < server.pulses else None}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def feed():
+    """
+    Serves a feed of numbered pulses. failures maps a page to (HTTP status, number of times it is answered with it).
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    server.daemon_threads = True
+    server.pulses = 95
+    server.failures = {}
+    server.retryAfter = None
+    server.requests = []
+    server.version = 0
+    server.notModified = 0
+    server.lock = threading.Lock()
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetcher(url: str, **kwargs) -> otxfetch.PageFetcher:
+    return otxfetch.PageFetcher("test-key", server = url, **dict({"backoff_base": 0.01}, **kwargs))
+
+
+def test_pages_are_fetched_concurrently_and_delivered_in_order(feed):
+    pages = fetcher(feed.url, max_workers = 4)
+    assert [pulse["id"] for pulse in pages.getall_iter(limit = 10)] == list(range(95))
+    assert pages.pagesFetched == 10
+    assert sorted(page for page, _, _ in feed.requests) == list(range(1, 11))
+    assert {key for _, _, key in feed.requests} == {"test-key"}
+    # Ten clean responses grow the pages in flight from two
+    assert pages.concurrency > 2
+
+
+def test_throttled_pages_are_retried_after_the_servers_delay(feed):
+    feed.failures = {3: (429, 2)}
+    feed.retryAfter = 0.3
+    pages = fetcher(feed.url, max_workers = 4)
+    assert [pulse["id"] for pulse in pages.getall_iter(limit = 10)] == list(range(95))
+    assert pages.retries == 2
+    attempts = [at for page, at, _ in feed.requests if page == 3]
+    assert len(attempts) == 3
+    assert all(later - earlier >= 0.29 for earlier, later in zip(attempts, attempts[1:]))
+
+
+def test_throttling_halves_the_pages_in_flight(feed):
+    pages = fetcher(feed.url, max_workers = 8)
+    list(pages.getall_iter(limit = 10))
+    before = pages.concurrency
+    feed.failures = {1: (503, 1)}
+    list(pages.getall_iter(limit = 95))
+    assert pages.retries == 1
+    assert pages.concurrency == max(1, before // 2)
+
+
+def test_retries_are_bounded(feed):
+    feed.failures = {1: (503, 10)}
+    with pytest.raises(otxfetch.FetchError, match = "after 2 retries"):
+        list(fetcher(feed.url, max_retries = 2).getall_iter(limit = 10))
+    assert len(feed.requests) == 3
+
+
+def test_client_errors_are_not_retried(feed):
+    feed.failures = {1: (403, 1)}
+    with pytest.raises(otxfetch.FetchError, match = "HTTP 403"):
+        list(fetcher(feed.url).getall_iter(limit = 10))
+    assert len(feed.requests) == 1
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = otxfetch.PageCache(str(tmp_path / "pages.sqlite3"))
+    yield cache
+    cache.close()
+
+
+def ids(pages: otxfetch.PageFetcher) -> list:
+    return [(pulse["id"], pulse["version"]) for pulse in pages.getall_iter(limit = 10)]
+
+
+def test_fresh_pages_are_served_from_the_cache(feed, cache):
+    expected = ids(fetcher(feed.url, cache = cache))
+    assert len(feed.requests) == 10
+    cached = fetcher(feed.url, cache = cache)
+    assert ids(cached) == expected
+    assert (cached.cacheHits, cached.bytesReceived, len(feed.requests)) == (10, 0, 10)
+    # Subscriptions differ between accounts, another key never sees these pages
+    other = otxfetch.PageFetcher("other-key", server = feed.url, cache = cache)
+    assert ids(other) == expected
+    assert (other.cacheHits, len(feed.requests)) == (0, 20)
+
+
+def test_stale_pages_are_revalidated(feed, cache):
+    expected = ids(fetcher(feed.url, cache = cache))
+    cache.ttl = 0
+    revalidating = fetcher(feed.url, cache = cache)
+    assert ids(revalidating) == expected
+    assert (revalidating.cacheRevalidated, revalidating.bytesReceived, feed.notModified) == (10, 0, 10)
+
+    feed.version = 1
+    changed = fetcher(feed.url, cache = cache)
+    assert ids(changed) == [(pulseId, 1) for pulseId, _ in expected]
+    assert (changed.cacheRevalidated, feed.notModified) == (0, 10)
+    # The new pages replaced the old ones and are fresh again
+    cache.ttl = 3600
+    assert ids(fetcher(feed.url, cache = cache)) == [(pulseId, 1) for pulseId, _ in expected]
+    assert len(feed.requests) == 30
+
+
+def test_cache_evicts_the_least_recently_used_pages(feed, tmp_path):
+    cache = otxfetch.PageCache(str(tmp_path / "pages.sqlite3"), max_bytes = 10 ** 6)
+    try:
+        for page in range(1, 6):
+            cache.put(f"page{page}", bytes(range(256)) * 1000)
+        pageSize = cache.size // 5
+        cache.get("page1")
+        cache.maxBytes = pageSize * 4
+        cache.put("page6", bytes(range(256)) * 1000)
+        # Evicted down to 90% of the bound, three pages, of which page1 was used most recently
+        assert [cache.get(f"page{page}") is not None for page in range(1, 7)] == [True, False, False, False, True, True]
+        assert cache.size <= cache.maxBytes * 0.9
+    finally:
+        cache.close()
+    # The size is read back from the file, and a lowered bound is applied on open
+    reopened = otxfetch.PageCache(str(tmp_path / "pages.sqlite3"), max_bytes = pageSize)
+    try:
+        assert reopened.size <= pageSize * 0.9
+    finally:
+        reopened.close()
@@ -0,0 +1,50 @@
+import json
+import sqlite3
+
+import pytest
+
+import otx
+import otxmain
+from otxfakeserver import FakeOTX
+
+
+def run(capsys, *argv) -> tuple:
+    code = otxmain.main(list(argv))
+    return code, [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_offline_commands_read_a_synced_database(director, capsys):
+    feed = FakeOTX(50, indicators = 2)
+    app = director(feed)
+    app.update_alltables()
+
+    code, [status] = run(capsys, "status", "--max-age", "3600")
+    assert code == 0 and status["healthy"] and status["schema_version"] == otx.SCHEMA_VERSION
+    code, [stats] = run(capsys, "stats")
+    assert stats["rows"]["allpulses"] == stats["rows"]["pulse_archive"] == 50
+    code, results = run(capsys, "query", "--limit", "5")
+    assert [result["pulse_id"] for result in results] == [row[0] for row in app.dbHandler.find_pulses(limit = 5)]
+    pulseId = feed.pulse(0)["id"]
+    code, [result] = run(capsys, "query", "--pulse", pulseId)
+    assert result["pulse_id"] == pulseId
+    assert len(result["indicators"]) == len(app.dbHandler.get_pulse_indicators(pulseId)) > 0
+
+
+def test_offline_commands_neither_create_nor_migrate(workdir, capsys):
+    with pytest.raises(SystemExit) as exited:
+        otxmain.main(["status"])
+    assert exited.value.code == 2
+    assert "run a sync first" in capsys.readouterr().err
+
+    otx.SQLiteDBHandler().close()
+    connection = sqlite3.connect(otx.database_path())
+    connection.execute("""PRAGMA user_version = 2""")
+    connection.close()
+    for command in ("status", "stats", "query", "duplicates"):
+        with pytest.raises(SystemExit) as exited:
+            otxmain.main([command])
+        assert exited.value.code == 2
+        assert f"schema version 2, this version of otx reads {otx.SCHEMA_VERSION}" in capsys.readouterr().err
+    connection = sqlite3.connect(otx.database_path())
+    assert connection.execute("""PRAGMA user_version""").fetchone()[0] == 2
+    connection.close()
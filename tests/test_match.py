@@ -0,0 +1,69 @@
+import pytest
+
+import otx
+import otxmatch
+
+
+def pulse(index: int, indicators: list, modified: str = "2020-01-01T00:00:00", relevant: bool = True) -> dict:
+    return {"id": "%024x" % index, "name": f"Campaign #{index}", "created": "2020-01-01T00:00:00",
+            "modified": modified, "description": "", "author_name": "author", "references": [],
+            "industries": ["Aerospace"] if relevant else [],
+            "indicators": [{"type": indicatorType, "indicator": indicator} for indicatorType, indicator in indicators]}
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+@pytest.fixture
+def matcher(db):
+    matcher = otxmatch.IOCMatcher()
+    yield matcher
+    matcher.connection.close()
+
+
+def matches(matcher: otxmatch.IOCMatcher, *lines: str) -> list:
+    return [pulseIds for _, _, pulseIds in matcher.match_lines([line + "\n" for line in lines])]
+
+
+def test_indicator_kinds_match_log_lines(db):
+    db.stream_pulses("allpulses", [pulse(0, [("IPv4", "192.0.2.1"), ("CIDR", "198.51.100.0/24"),
+                                             ("domain", "example.com"), ("FileHash-MD5", "d41d8cd98f00b204e9800998ecf8427e"),
+                                             ("URL", "http://203.0.113.5/payload")]),
+                                   pulse(1, [("IPv4", "192.0.2.1")], relevant = False)])
+    matcher = otxmatch.IOCMatcher()
+    try:
+        assert matcher.indicatorCount == 5
+        assert matches(matcher, "connect 192.0.2.1:443", "from 198.51.100.77", "GET cdn.example.com/",
+                       "hash D41D8CD98F00B204E9800998ECF8427E", "fetch http://203.0.113.5/payload",
+                       "nothing at 192.0.2.2 or example.org") == [[pulse(0, [])["id"]]] * 5
+        matcher = otxmatch.IOCMatcher(table = "allpulses")
+        assert matches(matcher, "connect 192.0.2.1:443") == [[pulse(0, [])["id"], pulse(1, [])["id"]]]
+    finally:
+        matcher.connection.close()
+
+
+def test_matcher_picks_up_pulses_linked_by_a_sync(db, matcher):
+    db.stream_pulses("allpulses", [pulse(0, [("IPv4", "198.51.100.7")], relevant = False)])
+    assert matches(matcher, "GET / from 198.51.100.7") == []
+
+    # The indicator is already loaded, only its link to a relevant pulse is new
+    db.stream_pulses("allpulses", [pulse(1, [("IPv4", "198.51.100.7")], "2020-01-02T00:00:00")])
+    assert matches(matcher, "GET / from 198.51.100.7") == [[pulse(1, [])["id"]]]
+    assert matcher.refresh() == 0
+
+
+def test_matcher_reloads_when_indicators_are_rebuilt(db, matcher):
+    db.stream_pulses("allpulses", [pulse(0, [("IPv4", "192.0.2.1"), ("domain", "example.com")])])
+    assert matches(matcher, "from 192.0.2.1") == [[pulse(0, [])["id"]]]
+
+    # The rebuilt table hands out the same IDs to different indicators
+    db.currentCursor.execute("""DELETE FROM pulse_indicator""")
+    db.currentCursor.execute("""DELETE FROM indicator""")
+    db.currentConnection.commit()
+    db.stream_pulses("allpulses", [pulse(0, [("domain", "example.net"), ("IPv4", "192.0.2.9")], "2020-01-02T00:00:00")])
+    assert matches(matcher, "from 192.0.2.1", "GET example.com", "from 192.0.2.9") == [[pulse(0, [])["id"]]]
+    assert matcher.indicatorCount == 2
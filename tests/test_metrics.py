@@ -0,0 +1,51 @@
+import json
+import re
+
+from otxfakeserver import FakeOTX
+from otxmetrics import METRIC_PREFIX, RunMetrics
+
+
+def test_sync_run_counts_every_stage(director):
+    feed = FakeOTX(250, indicators = 2)
+    app = director(feed)
+    report = app.update_alltables().report()
+    counters = report["counters"]
+    assert counters["pulses_received"] == counters["pulses_inserted"] == 250
+    assert counters["pages_fetched"] == 3
+    assert counters["batches"] == 1
+    assert {"fetch_wait", "http", "decode", "digest", "diff", "prepare", "sql"} <= set(report["stages"])
+    assert report["finished"] is not None
+
+    feed.touch(3)
+    counters = app.update_alltables().report()["counters"]
+    # modified_since is inclusive, the pulse at the watermark comes back unchanged
+    assert (counters["pulses_received"], counters["pulses_updated"], counters["pulses_unchanged"]) == (4, 3, 1)
+    assert counters.get("pulses_inserted", 0) == 0
+    assert counters["pages_fetched"] == 1
+
+
+def test_reports_are_written_as_json_and_prometheus(tmp_path):
+    metrics = RunMetrics()
+    with metrics.stage("sql"):
+        metrics.count("pulses_received", 10)
+    metrics.add_time("sql", 1.5)
+    metrics.finish()
+    duration = metrics.duration
+    assert metrics.duration == duration
+
+    metrics.write_json(str(tmp_path / "run.json"))
+    report = json.loads((tmp_path / "run.json").read_text())
+    assert report["counters"] == {"pulses_received": 10}
+    assert report["stages"]["sql"] >= 1.5
+
+    metrics.write_prometheus(str(tmp_path / "run.prom"))
+    samples = {}
+    for line in (tmp_path / "run.prom").read_text().splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    assert samples[f'{METRIC_PREFIX}_pulses_received{{run="sync"}}'] == 10
+    assert samples[f'{METRIC_PREFIX}_stage_seconds{{run="sync",stage="sql"}}'] >= 1.5
+    assert all(re.fullmatch(r'[a-z_]+\{[a-z]+="[a-z_]+"(,[a-z]+="[a-z_]+")*\}', name) for name in samples)
+    # Written atomically, no temporary file is left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["run.json", "run.prom"]
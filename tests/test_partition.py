@@ -0,0 +1,124 @@
+import json
+
+import pytest
+
+import otx
+import otxexport
+import otxmatch
+import otxpartition
+from otxfakeserver import FakeOTX
+from otxrelevance import DEFAULT_PROFILES, RELEVANT_PROFILE, RelevanceMatcher
+from test_sync import pulse
+
+
+class PlainRevisions(FakeOTX):
+    """
+    Feed whose modified pulses lose every attribute that made them relevant.
+    """
+
+    def pulse(self, index: int, touched: tuple = None) -> dict:
+        pulse = super().pulse(index, touched)
+        if touched:
+            pulse["name"] = f"Plain campaign #{index} (rev {touched[1]})"
+            pulse["tags"] = ["plain"]
+            pulse["industries"] = []
+        return pulse
+
+
+def scalar(db: otx.SQLiteDBHandler, query: str, params = ()):
+    return db.currentCursor.execute(query, params).fetchone()[0]
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+def stored_pulses(db: otx.SQLiteDBHandler) -> list:
+    # 2019 and 2020, both long past, and one recent pulse that stays in the pulse database
+    pulses = [pulse(0, "2019-06-01T00:00:00", ["Aerospace"]), pulse(1, "2020-03-01T00:00:00"),
+              pulse(2, "2020-09-01T00:00:00", ["Finance"]), pulse(3, otx.datetime.today().isoformat())]
+    pulses[0]["indicators"] = [{"type": "IPv4", "indicator": "192.0.2.1"}]
+    pulses[1]["indicators"] = [{"type": "domain", "indicator": "evil.example.com"}]
+    pulses[3]["indicators"] = [{"type": "IPv4", "indicator": "192.0.2.1"}]
+    db.stream_pulses("allpulses", pulses)
+    return pulses
+
+
+def test_readers_see_rolled_pulses(db, workdir):
+    pulses = stored_pulses(db)
+    exporter = otxexport.PulseExporter(db)
+    before = {table: exporter.export(table, "jsonl", str(workdir / f"{table}.jsonl"))["rows"]
+              for table in ("allpulses", "reference")}
+    matcher = otxmatch.IOCMatcher(table = "allpulses")
+    try:
+        assert otxpartition.PartitionManager(db).roll(older_than_days = 30) == {"2019": 1, "2020": 2}
+        assert scalar(db, """SELECT COUNT(*) FROM main.allpulses""") == 1
+
+        lines = ["GET / from 192.0.2.1\n", "lookup evil.example.com\n"]
+        assert [sorted(pulseIds) for _, _, pulseIds in matcher.match_lines(lines)] == \
+            [sorted([pulses[0]["id"], pulses[3]["id"]]), [pulses[1]["id"]]]
+        assert sorted(pulseId for _, pulseId in db.find_indicator("192.0.2.1")) == \
+            sorted([pulses[0]["id"], pulses[3]["id"]])
+        assert db.get_pulse_indicators(pulses[1]["id"]) == [("domain", "evil.example.com")]
+        assert db.get_pulse(pulses[2]["id"])[1] == pulses[2]["name"]
+        assert db.find_references(pulses[0]["id"]) == [(pulses[0]["id"], pulses[0]["references"][0])]
+        assert [row[0] for row in db.find_pulses()] == [pulses[index]["id"] for index in (3, 2, 1, 0)]
+
+        for table, rows in before.items():
+            assert exporter.export(table, "jsonl", str(workdir / f"{table}.jsonl"))["rows"] == rows
+        path = str(workdir / "pulses.stix")
+        exporter.export("allpulses", "stix", path)
+        with open(path, encoding = "utf-8") as f:
+            patterns = sorted(stixObject["pattern"] for stixObject in json.load(f)["objects"]
+                              if stixObject["type"] == "indicator")
+        assert patterns == ["[domain-name:value = 'evil.example.com']"] + ["[ipv4-addr:value = '192.0.2.1']"] * 2
+    finally:
+        matcher.connection.close()
+
+
+def test_widened_profiles_reach_rolled_pulses(db):
+    pulses = stored_pulses(db)
+    otxpartition.PartitionManager(db).roll(older_than_days = 30)
+    profiles = json.loads(json.dumps(DEFAULT_PROFILES))
+    profiles[RELEVANT_PROFILE]["rules"].append({"industries": ["Finance"]})
+    db.relevance = RelevanceMatcher(profiles)
+    db.refresh_profiles()
+    relevant = {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM relevantpulses""")}
+    assert pulses[2]["id"] in relevant
+    assert db.find_pulses("relevantpulses", industry = "Finance")[0][0] == pulses[2]["id"]
+
+
+def test_history_attaches_the_partitions_of_a_range(db):
+    stored_pulses(db)
+    manager = otxpartition.PartitionManager(db)
+    manager.roll(older_than_days = 30)
+    with manager.history(since = "2020-01-01") as connection:
+        assert [schema for _, schema, _ in connection.execute("""PRAGMA database_list""")
+                if schema.startswith("partition_")] == ["partition_2020"]
+        assert connection.execute("""SELECT COUNT(*) FROM allpulses_all""").fetchone()[0] == 3
+    assert manager.drop("2020-01-01") == ["2019"]
+    assert [row[0] for row in manager.partitions()] == ["2020"]
+    assert len(db.find_pulses()) == 3
+
+
+def test_partitioned_pulses_modified_upstream_are_updated(director):
+    feed = PlainRevisions(300, indicators = 4)
+    app = director(feed)
+    app.update_alltables()
+    db = app.dbHandler
+    assert scalar(db, """SELECT COUNT(*) FROM relevantpulses""")
+    otxpartition.PartitionManager(db).roll(older_than_days = 0)
+    assert scalar(db, """SELECT COUNT(*) FROM main.allpulses""") == 0
+
+    feed.touch(300)
+    metrics = app.update_alltables()
+    assert metrics.counters.get("pulses_inserted", 0) == 0
+    assert metrics.counters["pulses_updated"] == 300
+    assert scalar(db, """SELECT COUNT(*) FROM pulse_tag WHERE tag != 'plain'""") == 0
+    assert scalar(db, """SELECT COUNT(*) FROM pulse_profile WHERE profile = ?""", (RELEVANT_PROFILE,)) == 0
+    assert scalar(db, """SELECT COUNT(*) FROM relevantpulses""") == 0
+    # The new versions shadow the partitioned ones
+    assert len(db.find_pulses(limit = 1000)) == 300
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import otx
+from otxfakeserver import FakeOTX
+from otxrelevance import RELEVANT_PROFILE, RelevanceMatcher, load_profiles
+
+
+def profile_state(db: otx.SQLiteDBHandler) -> tuple:
+    cursor = db.currentCursor
+    return (sorted(cursor.execute("""SELECT profile, pulse_id FROM pulse_profile""")),
+            sorted(cursor.execute("""SELECT pulse_id FROM relevantpulses""")),
+            sorted(cursor.execute("""SELECT profile, fingerprint FROM relevance_profile""")))
+
+
+@pytest.fixture
+def rules(workdir) -> str:
+    path = str(workdir / "rules.json")
+    with open(path, "w") as f:
+        json.dump({"aviation": {"rules": [{"industries": ["Aerospace"]}]},
+                   "finance": {"rules": [{"industries": ["Finance", "Banking"]}]}}, f)
+    return path
+
+
+def members(feed: FakeOTX, industries: set) -> set:
+    return {feed.pulse(index)["id"] for index in range(feed.count)
+            if industries & set(feed.pulse(index)["industries"])}
+
+
+def test_sync_matches_stored_pulses_against_its_rules(director, rules):
+    feed = FakeOTX(300, indicators = 1)
+    director(feed).update_alltables()
+    synced = director(feed, profiles = rules)
+    assert synced.update_alltables().counters.get("pulses_inserted", 0) == 0
+    state = profile_state(synced.dbHandler)
+    assert {pulseId for profile, pulseId in state[0] if profile == "finance"} == members(feed, {"Finance", "Banking"})
+    assert {pulseId for (pulseId,) in state[1]} == members(feed, {"Aerospace"})
+
+
+def test_opening_a_handler_never_matches_profiles(director, rules):
+    feed = FakeOTX(300, indicators = 1)
+    app = director(feed, profiles = rules)
+    app.update_alltables()
+    synced = profile_state(app.dbHandler)
+
+    # Neither the built-in rules nor other rule files touch what the sync stored
+    for relevance in (None, RelevanceMatcher({"other": {"rules": [{"tags": ["phishing"]}]}})):
+        reader = otx.SQLiteDBHandler(relevance = relevance)
+        try:
+            assert profile_state(reader) == synced
+        finally:
+            reader.close()
+    assert profile_state(app.dbHandler) == synced
+
+
+def test_rebuild_matches_against_its_rules(director, rules):
+    feed = FakeOTX(100, indicators = 1)
+    director(feed).update_alltables()
+    db = otx.SQLiteDBHandler(relevance = RelevanceMatcher(load_profiles(rules)))
+    try:
+        db.rebuild_from_archive(workers = 2)
+        assert {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM pulse_profile 
+                WHERE profile = 'finance'""")} == members(feed, {"Finance", "Banking"})
+        assert {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM pulse_profile 
+                WHERE profile = ?""", (RELEVANT_PROFILE,))} == members(feed, {"Aerospace"})
+    finally:
+        db.close()
@@ -0,0 +1,46 @@
+import pytest
+
+import otx
+
+
+def pulse(index: int, name: str, description: str = "", references: list = (), relevant: bool = False,
+          modified: str = "2020-01-01T00:00:00") -> dict:
+    return {"id": "%024x" % index, "name": name, "created": "2020-01-01T00:00:00", "modified": modified,
+            "description": description, "author_name": "author", "references": list(references),
+            "industries": ["Aerospace"] if relevant else []}
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    handler.stream_pulses("allpulses", [
+        pulse(0, "ADS-B spoofing against airlines", "Fake ACARS messages", relevant = True),
+        pulse(1, "Phishing wave", "Lures mention ADS-B receivers and ACARS", ["https://blog.example.com/ads-b"]),
+        pulse(2, "Ransomware", "Encrypts file servers, ransom note in \"quotes\"", ["https://intel.example.com/r"]),
+    ])
+    yield handler
+    handler.close()
+
+
+def ids(results: list) -> list:
+    return [row[0] for row in results]
+
+
+def test_every_keyword_matches_and_names_rank_first(db):
+    assert ids(db.search("ADS-B ACARS")) == ["%024x" % 0, "%024x" % 1]
+    assert ids(db.search("ads-b", table = "relevantpulses")) == ["%024x" % 0]
+    assert ids(db.search("intel.example.com")) == ["%024x" % 2]
+    assert ids(db.search('"quotes"')) == ["%024x" % 2]
+    assert db.search("ransomware")[0][2].startswith("[Ransomware]")
+
+
+def test_raw_queries_use_fts5_syntax(db):
+    assert sorted(ids(db.search("phish* OR ransom*", raw = True))) == ["%024x" % 1, "%024x" % 2]
+    assert ids(db.search("name:acars", raw = True)) == []
+
+
+def test_modified_pulses_are_reindexed(db):
+    db.stream_pulses("allpulses", [pulse(2, "Wiper", "Destroys disks", modified = "2020-01-02T00:00:00")])
+    assert ids(db.search("ransomware")) == []
+    assert ids(db.search("wiper")) == ["%024x" % 2]
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM pulse_fts""").fetchone()[0] == 3
@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+
+import otx
+import otxserve
+from test_sync import pulse
+
+
+@pytest.fixture
+def service(workdir):
+    handler = otx.SQLiteDBHandler()
+    service = otxserve.QueryService(handler, workers = 2)
+    yield service
+    service.close()
+    handler.close()
+
+
+def get(service: otxserve.QueryService, target: str) -> tuple:
+    status, body = asyncio.run(service.respond("GET", target))
+    return status, json.loads(body)
+
+
+def list_all(service: otxserve.QueryService, target: str) -> list:
+    pages = []
+    status, page = get(service, target)
+    while True:
+        assert status == 200
+        pages.append([item["pulse_id"] for item in page["items"]])
+        if not page["next"]:
+            return pages
+        status, page = get(service, f"{target}&cursor={page['next']}")
+
+
+def test_pulses_are_paginated_by_keyset(service):
+    # Pulses 0-3 share a second, the pulse_id breaks the tie
+    pulses = [pulse(index, "2020-01-01T00:00:00" if index < 4 else f"2020-01-0{index - 2}T00:00:00")
+              for index in range(7)]
+    service.dbHandler.stream_pulses("allpulses", pulses)
+    expected = [pulse(index)["id"] for index in (6, 5, 4, 3, 2, 1, 0)]
+    pages = list_all(service, "/pulses?limit=3")
+    assert pages == [expected[:3], expected[3:6], expected[6:]]
+    assert list_all(service, "/pulses?limit=7") == [expected]
+    assert get(service, "/pulses?cursor=nonsense")[0] == 400
+
+
+def test_pulses_without_a_modified_timestamp_page_last(service):
+    # An unparseable modified leaves modified_ts NULL, such pulses must neither vanish nor repeat across pages
+    pulses = [pulse(index, "2020-01-01T00:00:00" if index % 2 else "unknown") for index in range(5)]
+    service.dbHandler.stream_pulses("allpulses", pulses)
+    pages = list_all(service, "/pulses?limit=2")
+    assert sum(pages, []) == [pulse(index)["id"] for index in (3, 1, 4, 2, 0)]
+    assert [row[0] for row in service.dbHandler.find_pulses(after = (None, pulse(4)["id"]))] == \
+        [pulse(index)["id"] for index in (2, 0)]
+
+
+def test_results_are_cached_until_the_database_changes(service):
+    service.dbHandler.stream_pulses("allpulses", [pulse(0)])
+    first = get(service, "/pulses?limit=5")
+    assert get(service, "/pulses?limit=5") == first
+    assert service.cache.stats()["hits"] == 1
+
+    service.dbHandler.stream_pulses("allpulses", [pulse(1, "2020-01-02T00:00:00")])
+    status, page = get(service, "/pulses?limit=5")
+    assert [item["pulse_id"] for item in page["items"]] == [pulse(1)["id"], pulse(0)["id"]]
+    assert service.cache.stats()["invalidations"] >= 1
+    # Status is never cached
+    assert get(service, "/status")[1]["requests"] == 4
+
+
+def test_result_cache_evicts_the_least_recently_used():
+    cache = otxserve.ResultCache(max_bytes = 80)
+    for key in "abcdefgh":
+        cache.put(key, b"x" * 10)
+    cache.get("a")
+    cache.put("i", b"x" * 10)
+    assert [cache.get(key) is not None for key in "abci"] == [True, False, True, True]
+    assert cache.size == 80
+    # Bodies larger than an eighth of the cache are not kept
+    cache.put("j", b"x" * 11)
+    assert cache.get("j") is None
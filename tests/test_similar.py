@@ -0,0 +1,85 @@
+import pytest
+
+import otx
+import otxpartition
+import otxsimilar
+from test_sync import pulse
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+def indicators(start: int, count: int) -> list:
+    return [{"type": "domain", "indicator": f"host-{value}.example.com"} for value in range(start, start + count)]
+
+
+def stored_pulses(db: otx.SQLiteDBHandler) -> list:
+    # 0 and 1 share 95 of 105 indicators, 2 only a fifth of 0's, 3 none and 4 has no indicators at all
+    pulses = [pulse(index, f"202{index}-01-01T00:00:00") for index in range(5)]
+    for index, (start, count) in enumerate([(0, 100), (5, 100), (80, 100), (1000, 100), (0, 0)]):
+        pulses[index]["indicators"] = indicators(start, count)
+    db.stream_pulses("allpulses", pulses)
+    return pulses
+
+
+def test_signatures_do_not_depend_on_numpy(monkeypatch):
+    pytest.importorskip("numpy")
+    sets = [[f"198.51.100.{value}" for value in range(size)] for size in (1, 7, 300)]
+    signatures = otxsimilar.minhash_signatures(sets)
+    buckets = otxsimilar.lsh_buckets(signatures)
+    scores = otxsimilar.similarities(signatures[1], signatures)
+    monkeypatch.setattr(otxsimilar, "numpy", None)
+    assert otxsimilar.minhash_signatures(sets) == signatures
+    assert otxsimilar.lsh_buckets(signatures) == buckets
+    assert otxsimilar.similarities(signatures[1], signatures) == scores
+
+
+def test_similarity_estimates_the_jaccard_index():
+    # Values are compared without case and surrounding whitespace
+    assert otxsimilar.minhash_signatures([["Evil.example.com "]]) == \
+        otxsimilar.minhash_signatures([["evil.example.com"]])
+    base = [f"host-{value}" for value in range(1000)]
+    signatures = otxsimilar.minhash_signatures([base, base[200:] + [f"other-{value}" for value in range(200)]])
+    # 800 of 1200 values shared, the estimate of 64 hash functions stays within a few standard deviations
+    assert abs(otxsimilar.similarities(signatures[0], signatures[1:])[0] - 800 / 1200) < 0.2
+
+
+def test_related_pulses_and_near_duplicates(db):
+    pulses = stored_pulses(db)
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM pulse_minhash""").fetchone()[0] == 4
+    related = db.related_pulses(pulses[0]["id"])
+    assert related[0][:2] == (pulses[1]["id"], pulses[1]["name"]) and related[0][2] > 0.7
+    assert pulses[3]["id"] not in [pulseId for pulseId, _, _ in related]
+    assert db.related_pulses(pulses[4]["id"]) == []
+
+    assert db.near_duplicates() == [[(pulses[0]["id"], pulses[0]["name"]), (pulses[1]["id"], pulses[1]["name"])]]
+    assert db.near_duplicates(since = "2021-01-01") == db.near_duplicates()
+    assert db.near_duplicates(since = "2022-01-01") == []
+    assert db.near_duplicates(table = "relevantpulses") == []
+
+    # A pulse modified upstream is filed under the buckets of its new indicators
+    pulses[1].update(modified = "2025-01-01T00:00:00", indicators = indicators(2000, 50))
+    db.stream_pulses("allpulses", [pulses[1]])
+    assert db.near_duplicates() == []
+
+
+def test_partitioned_pulses_stay_indexed(db):
+    pulses = stored_pulses(db)
+    manager = otxpartition.PartitionManager(db)
+    manager.roll(older_than_days = 30)
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM main.allpulses""").fetchone()[0] == 0
+
+    # Rebuilding the index reads the indicators of the partitioned pulses too
+    db.reset_table("pulse_minhash")
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM pulse_minhash""").fetchone()[0] == 4
+    assert db.related_pulses(pulses[0]["id"])[0][0] == pulses[1]["id"]
+    assert len(db.near_duplicates(since = "2020-01-01")) == 1
+
+    assert manager.drop("2022-01-01") == ["2020", "2021"]
+    assert {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM pulse_minhash""")} == \
+        {pulses[2]["id"], pulses[3]["id"]}
+    assert db.related_pulses(pulses[2]["id"]) == []
@@ -0,0 +1,171 @@
+import sqlite3
+
+import pytest
+
+import otx
+from otxrelevance import RELEVANT_PROFILE
+
+
+def pulse(index: int, modified: str = "2020-01-01T00:00:00", industries: list = None, name: str = None) -> dict:
+    return {"id": "%024x" % index, "name": name or f"Campaign #{index}", "created": "2020-01-01T00:00:00",
+            "modified": modified, "description": "", "author_name": "author", "industries": industries or [],
+            "references": [f"https://blog.example.com/{index}"]}
+
+
+@pytest.fixture
+def db(workdir):
+    handler = otx.SQLiteDBHandler()
+    yield handler
+    handler.close()
+
+
+def test_stream_inserts_new_and_updates_modified_pulses(db):
+    pulses = [pulse(index, f"2020-01-01T00:00:{index:02d}", ["Aerospace"] if index % 2 else []) for index in range(10)]
+    assert db.stream_pulses("allpulses", pulses) == (10, 0)
+    assert db.get_sync_state("allpulses")[0] == "2020-01-01T00:00:09"
+    relevant = {pulseId for (pulseId,) in db.currentCursor.execute("""SELECT pulse_id FROM relevantpulses""")}
+    assert relevant == {pulse(index)["id"] for index in range(1, 10, 2)}
+
+    # Pulse 1 is modified and no longer relevant, pulse 2 shows up again unchanged and pulse 3 in an older version
+    changed = [pulse(1, "2020-01-02T00:00:00", name = "Renamed"), pulse(2, "2020-01-01T00:00:02"),
+               pulse(3, "2019-12-31T00:00:00", name = "Outdated"), pulse(10, "2020-01-02T00:00:01")]
+    assert db.stream_pulses("allpulses", changed) == (1, 1)
+    rows = dict(db.currentCursor.execute("""SELECT pulse_id, name FROM allpulses"""))
+    assert len(rows) == 11
+    assert rows[pulse(1)["id"]] == "Renamed"
+    assert rows[pulse(3)["id"]] == "Campaign #3"
+    assert db.get_sync_state("allpulses")[0] == "2020-01-02T00:00:01"
+    assert pulse(1)["id"] not in {pulseId for (pulseId,) in db.currentCursor.execute(
+        """SELECT pulse_id FROM relevantpulses""")}
+    # The references of the modified pulse are rebuilt, not added to
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM reference WHERE pulse_id = ?""",
+                                    (pulse(1)["id"],)).fetchone()[0] == 1
+
+
+def test_watermark_only_moves_forward(db):
+    db.stream_pulses("allpulses", [pulse(0, "2020-01-02T00:00:00")])
+    db.stream_pulses("allpulses", [pulse(1, "2020-01-01T00:00:00")])
+    assert db.get_sync_state("allpulses")[0] == "2020-01-02T00:00:00"
+
+
+def test_batches_commit_on_their_own(db):
+    pulses = [pulse(index, f"2020-01-01T00:00:{index:02d}") for index in range(7)]
+    assert db.stream_pulses("allpulses", pulses, batch_size = 3) == (7, 0)
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM allpulses""").fetchone()[0] == 7
+    assert db.stream_pulses("allpulses", pulses, batch_size = 3) == (0, 0)
+
+
+def test_find_pulses_intersects_attributes(db):
+    pulses = [pulse(0, "2020-01-01T00:00:00", ["Aerospace"]), pulse(1, "2020-01-02T00:00:00", ["Aerospace", "Finance"]),
+              pulse(2, "2020-01-03T00:00:00", ["Finance"])]
+    for index, tags in enumerate([["ransomware"], ["ransomware", "apt"], ["ransomware"]]):
+        pulses[index]["tags"] = tags
+    pulses[1]["malware_families"] = [{"id": "Emotet", "display_name": "Emotet"}]
+    db.stream_pulses("allpulses", pulses)
+
+    found = db.find_pulses(tag="ransomware")
+    assert [row[0] for row in found] == [pulse(2)["id"], pulse(1)["id"], pulse(0)["id"]]
+    assert [row[0] for row in db.find_pulses(industry="Aerospace", tag="ransomware", since="2020-01-02")] \
+        == [pulse(1)["id"]]
+    assert db.get_pulse_attributes(pulse(1)["id"])["malware"] == ["Emotet"]
+    with pytest.raises(ValueError):
+        db.find_pulses(colour="red")
+
+    # A modified pulse has its attributes rebuilt
+    pulses[1].update(modified = "2020-01-04T00:00:00", tags = ["apt"])
+    db.stream_pulses("allpulses", [pulses[1]])
+    assert pulse(1)["id"] not in [row[0] for row in db.find_pulses(tag="ransomware")]
+
+
+def test_indicators_are_stored_once_and_linked(db):
+    shared = {"type": "IPv4", "indicator": "192.0.2.1"}
+    pulses = [pulse(0), pulse(1), pulse(2, "2020-01-02T00:00:00")]
+    pulses[0]["indicators"] = [shared, {"type": "domain", "indicator": "evil.example.com"}]
+    pulses[1]["indicators"] = [shared, {"type": "domain", "indicator": "192.0.2.1"}]
+    db.stream_pulses("allpulses", pulses)
+
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM indicator""").fetchone()[0] == 3
+    assert sorted(db.find_indicator("192.0.2.1")) == [("IPv4", pulse(0)["id"]), ("IPv4", pulse(1)["id"]),
+                                                     ("domain", pulse(1)["id"])]
+    assert db.find_indicator("192.0.2.1", "domain") == [("domain", pulse(1)["id"])]
+    assert sorted(db.get_pulse_indicators(pulse(0)["id"])) == [("IPv4", "192.0.2.1"), ("domain", "evil.example.com")]
+
+    # A modified pulse has its links rebuilt
+    pulses[0].update(modified = "2020-01-03T00:00:00", indicators = [])
+    db.stream_pulses("allpulses", [pulses[0]])
+    assert db.get_pulse_indicators(pulse(0)["id"]) == []
+
+
+def test_untyped_indicator_lookup_uses_the_unique_key(db):
+    plan = " ".join(row[-1] for row in db.currentCursor.execute("""EXPLAIN QUERY PLAN SELECT indicator_id FROM indicator 
+            WHERE indicator = ?""", ("192.0.2.1",)))
+    assert "SEARCH" in plan and "SCAN" not in plan
+
+
+def test_references_are_stored_once(db):
+    duplicated = pulse(0)
+    duplicated["references"] *= 2
+    db.stream_pulses("allpulses", [duplicated])
+    db.reset_table("allpulses")
+    db.stream_pulses("allpulses", [duplicated])
+    assert db.currentCursor.execute("""SELECT COUNT(*) FROM reference""").fetchone()[0] == 1
+
+
+def test_migration_removes_duplicate_references(db):
+    cursor = db.currentCursor
+    cursor.execute("""DROP INDEX idx_reference_pulse_reference""")
+    cursor.executemany("""INSERT INTO reference (pulse_id, reference) VALUES (?, ?)""",
+                       [("a", "https://example.com"), ("a", "https://example.com"), ("b", "https://example.com")])
+    cursor.execute("""PRAGMA user_version = 2""")
+    db.currentConnection.commit()
+    db.close()
+
+    migrated = otx.SQLiteDBHandler()
+    try:
+        assert sorted(migrated.currentCursor.execute("""SELECT pulse_id FROM reference""")) == [("a",), ("b",)]
+        assert migrated.currentCursor.execute("""PRAGMA user_version""").fetchone()[0] == otx.SCHEMA_VERSION
+    finally:
+        migrated.close()
+
+
+def test_epoch_seconds_reads_every_otx_timestamp_form():
+    assert otx.epoch_seconds("2020-01-01T00:00:00") == 1577836800
+    assert otx.epoch_seconds("2020-01-01T00:00:00.123456") == 1577836800
+    assert otx.epoch_seconds("2020-01-01T01:00:00Z") == 1577840400
+    assert otx.epoch_seconds("2020-01-01T01:00:00+01:00") == 1577836800
+    assert otx.epoch_seconds("yesterday") is None
+    assert otx.epoch_seconds(None) is None
+
+
+def test_baseline_database_is_migrated(workdir):
+    # The schema of the first release: pulses and references only
+    connection = sqlite3.connect(otx.database_path())
+    for table in ("allpulses", "relevantpulses"):
+        connection.execute(f"""CREATE TABLE {table} (pulse_id TEXT PRIMARY KEY NOT NULL, name TEXT, created TEXT,
+                modified TEXT, description TEXT, author TEXT)""")
+    connection.execute("""CREATE TABLE reference (pulse_id text NOT NULL, reference text)""")
+    rows = [("a", "Airport phishing", "2020-01-01T00:00:00", "2020-01-02T00:00:00", "d", "x"),
+            ("b", "Generic malware", "2020-01-01T00:00:00", "2020-01-02T00:00:00", "d", "x"),
+            ("c", "Espionage campaign", "2020-01-01T00:00:00", "2020-01-03T00:00:00", "d", "x")]
+    connection.executemany("""INSERT INTO allpulses VALUES (?, ?, ?, ?, ?, ?)""", rows)
+    connection.executemany("""INSERT INTO relevantpulses VALUES (?, ?, ?, ?, ?, ?)""", [rows[0], rows[2]])
+    connection.executemany("""INSERT INTO reference VALUES (?, ?)""", [("a", "https://a"), ("a", "https://a")])
+    connection.commit()
+    connection.close()
+
+    db = otx.SQLiteDBHandler()
+    try:
+        cursor = db.currentCursor
+        assert cursor.execute("""PRAGMA user_version""").fetchone()[0] == otx.SCHEMA_VERSION
+        assert {pulseId for (pulseId,) in cursor.execute("""SELECT pulse_id FROM relevantpulses""")} == {"a", "c"}
+        # Relevant pulses without stored attributes keep their relevance, whatever the profiles say about them
+        db.refresh_profiles()
+        assert {pulseId for (pulseId,) in cursor.execute("""SELECT pulse_id FROM relevantpulses""")} == {"a", "c"}
+        assert {pulseId for (pulseId,) in cursor.execute("""SELECT pulse_id FROM pulse_profile WHERE profile = ?""",
+                                                         (RELEVANT_PROFILE,))} == {"a", "c"}
+        assert cursor.execute("""SELECT modified_ts FROM allpulses WHERE pulse_id = 'c'""").fetchone() == (
+            otx.epoch_seconds("2020-01-03T00:00:00"),)
+        assert cursor.execute("""SELECT COUNT(*) FROM reference""").fetchone()[0] == 1
+        assert [row[0] for row in db.find_pulses(since = "2020-01-03T00:00:00")] == ["c"]
+    finally:
+        db.close()